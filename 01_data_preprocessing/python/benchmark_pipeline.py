@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Python preprocessing path on fixed synthetic cohorts.
+
+Each cohort size (see COHORTS) is generated once with
+generate_synthetic_cohort.py and cached. A benchmark case then runs
+detect_available_subjects and process_subject for every subject (MAT load,
+downsample_data, segmentation, labelling and flat-file writing) in a fresh
+worker process, with stage_profiler enabled to time each stage, and records:
+
+    runs_per_s, samples_per_s     throughput over the whole case
+    wall_s, <stage>_s             wall time of the case and of each stage
+    peak_rss_mb                   peak RSS of the worker process
+    output_bytes                  size of the flat files written
+
+Results are compared against stored baselines; a metric that got worse by
+more than --tolerance (relative) is a regression and the script exits with
+status 1, so it can gate a cohort rebuild.
+
+Usage:
+    python benchmark_pipeline.py --sizes small medium --save-baseline
+    python benchmark_pipeline.py --sizes small medium --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(SCRIPT_DIR, 'benchmark_baselines.json')
+COHORT_CACHE = os.path.join(tempfile.gettempdir(), 'bap_benchmark_cohorts')
+SEED = 20240101
+
+# name: (subjects, sessions, runs per session and task)
+COHORTS = {
+    'small': (1, (2,), 2),
+    'medium': (4, (2, 3), 3),
+    'large': (10, (2, 3), 5),
+}
+STAGES = ('detect', 'load_behavioral', 'load', 'resample', 'segment', 'write')
+DEFAULT_TOLERANCE = 0.25
+MIN_SECONDS = 0.05  # stage times below this on both sides are timer noise, not regressions
+
+# Direction in which each metric gets worse
+HIGHER_IS_WORSE = ('wall_s', 'peak_rss_mb') + tuple(f'{s}_s' for s in STAGES)
+LOWER_IS_WORSE = ('runs_per_s', 'samples_per_s')
+CHANGE_IS_WORSE = ('output_bytes',)
+
+
+def ensure_cohort(name, cache_dir=COHORT_CACHE):
+    """Generate the synthetic cohort for a size once; regenerate if its parameters changed"""
+    from generate_synthetic_cohort import generate_cohort
+
+    n_subjects, sessions, runs = COHORTS[name]
+    params = {'subjects': n_subjects, 'sessions': list(sessions), 'runs': runs, 'seed': SEED}
+    cohort_dir = os.path.join(cache_dir, name)
+    marker = os.path.join(cohort_dir, 'cohort.json')
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f).get('params') == params:
+                return cohort_dir
+    print(f"Generating {name} cohort in {cohort_dir}...")
+    stats = generate_cohort(cohort_dir, n_subjects, sessions, runs, seed=SEED)
+    with open(marker, 'w') as f:
+        json.dump({'params': params, 'stats': stats}, f, indent=2)
+    return cohort_dir
+
+
+def run_case(cohort_dir, work_dir):
+    """
+    One benchmark pass over a cohort; meant to run in a fresh process.
+
+    Returns:
+        dict of metrics
+    """
+    import stage_profiler
+    from create_flat_files_interactive import detect_available_subjects, process_subject
+
+    profile_dir = os.path.join(work_dir, 'profile')
+    output_dir = os.path.join(work_dir, 'flat')
+    os.makedirs(output_dir, exist_ok=True)
+    stage_profiler.enable(profile_dir)
+
+    t0 = time.perf_counter()
+    with stage_profiler.stage('detect'):
+        subjects = detect_available_subjects(os.path.join(cohort_dir, 'BAP_cleaned'))
+    beh_file = os.path.join(cohort_dir, 'bap_trial_data_grip_type1.csv')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for subject_id in sorted(subjects):
+            process_subject(subject_id, subjects, beh_data_file=beh_file, output_dir=output_dir)
+    wall = time.perf_counter() - t0
+    stage_profiler.flush()
+
+    with open(os.path.join(cohort_dir, 'cohort.json')) as f:
+        stats = json.load(f)['stats']
+    metrics = {
+        'wall_s': wall,
+        'runs_per_s': stats['n_runs'] / wall,
+        'samples_per_s': stats['n_samples'] / wall,
+        'peak_rss_mb': stage_profiler.peak_rss_mb(),
+        'output_bytes': sum(entry.stat().st_size for entry in os.scandir(output_dir)),
+    }
+    summary = stage_profiler.summary_table(stage_profiler.load_events(profile_dir))
+    for row in summary.itertuples():
+        metrics[f'{row.name}_s'] = row.wall_total_s
+    return metrics
+
+
+def benchmark(name, repeat=3, cache_dir=COHORT_CACHE):
+    """
+    Best-of-`repeat` metrics for one cohort size.
+
+    Every pass runs in its own spawned process so peak RSS is per pass and
+    no imports or caches carry over between passes.
+    """
+    cohort_dir = ensure_cohort(name, cache_dir)
+    passes = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix=f'bap_bench_{name}_') as work_dir:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                passes.append(pool.submit(run_case, cohort_dir, work_dir).result())
+
+    best = {}
+    for key in passes[0]:
+        values = [p.get(key, float('nan')) for p in passes]
+        best[key] = max(values) if key in LOWER_IS_WORSE else min(values)
+    with open(os.path.join(cohort_dir, 'cohort.json')) as f:
+        best.update({f'cohort_{k}': v for k, v in json.load(f)['stats'].items() if k != 'elapsed'})
+    return best
+
+
+def compare(results, baselines, tolerance):
+    """
+    Regressions of results against baselines.
+
+    Returns:
+        list of (cohort, metric, baseline, current, relative change)
+    """
+    regressions = []
+    for name, metrics in results.items():
+        base = baselines.get(name, {}).get('metrics')
+        if not base:
+            continue
+        for key, current in metrics.items():
+            old = base.get(key)
+            if old is None or not old:
+                continue
+            if key.endswith('_s') and max(old, current) < MIN_SECONDS:
+                continue
+            change = (current - old) / old
+            worse = ((key in HIGHER_IS_WORSE and change > tolerance) or
+                     (key in LOWER_IS_WORSE and change < -tolerance) or
+                     (key in CHANGE_IS_WORSE and abs(change) > tolerance))
+            if worse:
+                regressions.append((name, key, old, current, change))
+    return regressions
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(path, results, baselines):
+    machine = {'python': platform.python_version(), 'platform': platform.platform(),
+               'cpus': os.cpu_count(), 'recorded': datetime.now().isoformat(timespec='seconds')}
+    for name, metrics in results.items():
+        baselines[name] = {'metrics': metrics, 'machine': machine}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def print_results(name, metrics, baseline=None):
+    print(f"\n{name}: {metrics['cohort_n_runs']} runs, {metrics['cohort_n_samples'] / 1e6:.1f} M samples")
+    print(f"  {'metric':<18} {'current':>12} {'baseline':>12} {'change':>8}")
+    for key in ('wall_s', 'runs_per_s', 'samples_per_s', 'peak_rss_mb', 'output_bytes') + \
+               tuple(f'{s}_s' for s in STAGES):
+        if key not in metrics:
+            continue
+        old = (baseline or {}).get(key)
+        change = f"{100 * (metrics[key] - old) / old:+.1f}%" if old else ''
+        old = f"{old:>12.4g}" if old is not None else f"{'-':>12}"
+        print(f"  {key:<18} {metrics[key]:>12.4g} {old} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Python preprocessing pipeline")
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(COHORTS))
+    parser.add_argument('--repeat', type=int, default=3, help='Passes per size; best pass is kept')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'Allowed relative slowdown / growth (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--cohort-dir', default=COHORT_CACHE, help='Cache directory for synthetic cohorts')
+    parser.add_argument('--output', help='Write the results of this run to a JSON file')
+    args = parser.parse_args()
+
+    print("=== PREPROCESSING BENCHMARK ===")
+    baselines = load_baselines(args.baseline)
+    results = {}
+    for name in args.sizes:
+        results[name] = benchmark(name, args.repeat, args.cohort_dir)
+        print_results(name, results[name], baselines.get(name, {}).get('metrics'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        save_baselines(args.baseline, results, baselines)
+        print(f"\n✓ Baseline saved to: {args.baseline}")
+        return
+
+    if not baselines:
+        print(f"\n⚠ No baseline at {args.baseline}; run with --save-baseline to record one")
+        return
+    regressions = compare(results, baselines, args.tolerance)
+    if not regressions:
+        print(f"\n✅ No regressions beyond {args.tolerance:.0%}")
+        return
+    print(f"\n❌ {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+    for name, key, old, current, change in regressions:
+        print(f"  {name} {key}: {old:.4g} -> {current:.4g} ({change:+.1%})")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,13 @@ import glob
 from scipy import signal
 import re
 
+from flat_schema import apply_schema, phase_labels, write_flat
+from stage_profiler import stage, file_size, report as profile_report
+from trial_matching import index_runs, make_run_key
+
+BASE_DIR = '/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_cleaned'
+BEH_DATA_FILE = 'bap_trial_data_grip_type1.csv'
+
 def downsample_data(data, original_fs, target_fs):
     """
     Downsample data from original_fs to target_fs
@@ -27,25 +34,10 @@ def downsample_data(data, original_fs, target_fs):
     
     return downsampled_data
 
-def create_trial_label(duration_index):
-    """
-    Create descriptive trial labels based on duration index
-    """
-    label_mapping = {
-        1: "baseline",
-        2: "fixation", 
-        3: "squeeze",
-        4: "blank",
-        5: "response"
-    }
-    return label_mapping.get(duration_index, "unknown")
-
-def detect_available_subjects():
+def detect_available_subjects(base_dir=BASE_DIR):
     """
     Automatically detect available subjects and their files
     """
-    base_dir = '/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_cleaned'
-    
     # Find all cleaned eye tracking files
     pattern = 'subjectBAP*_*_session*_run*_eyetrack_cleaned.mat'
     files = glob.glob(os.path.join(base_dir, pattern))
@@ -125,40 +117,48 @@ def select_subject(subjects):
             print("\nExiting...")
             return None
 
-def process_subject(subject_id, subjects):
+def process_subject(subject_id, subjects, beh_data_file=BEH_DATA_FILE, output_dir='.'):
     """
     Process the selected subject
+
+    Flat files are written to output_dir as BAP{ID}_{task}_DS250.csv.
     """
     print(f"\nProcessing BAP{subject_id}...")
     
     # Define parameters
-    base_dir = '/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_cleaned'
     original_fs = 2000  # Original sampling rate
     target_fs = 250     # Target sampling rate
     
     # Load behavioral data
-    beh_data_file = 'bap_trial_data_grip_type1.csv'
     if not os.path.exists(beh_data_file):
         print(f"Error: Behavioral data file '{beh_data_file}' not found!")
         return
     
-    beh_data = pd.read_csv(beh_data_file, low_memory=False)
-    
-    # Filter for this subject
-    subject_beh_data = beh_data[beh_data['sub'] == f'BAP{subject_id}'].copy()
-    
-    if len(subject_beh_data) == 0:
-        print(f"Error: No behavioral data found for BAP{subject_id}!")
-        return
-    
     # Select only the specified columns
     selected_columns = ['sub', 'mvc', 'ses', 'task', 'run', 'trial', 'stimLev', 
                        'isOddball', 'isStrength', 'iscorr', 'resp1', 'resp1RT', 
                        'resp2', 'resp2RT', 'auc_rel_mvc', 'resp1_isdiff']
     
-    subject_beh_data = subject_beh_data[selected_columns].copy()
+    with stage('load_behavioral', file=beh_data_file) as st:
+        beh_data = pd.read_csv(beh_data_file, usecols=selected_columns, low_memory=False)
+        st.add_bytes(read=file_size(beh_data_file))
+    
+    # Index behavioral trials by packed (sub, task, ses, run) key once,
+    # instead of re-filtering the whole table for every run
+    beh_runs = index_runs(beh_data)
+    
+    subject_runs = {
+        task_name: {(int(f['session']), int(f['run'])): make_run_key(subject_id, task_name, f['session'], f['run'])
+                    for f in subjects[subject_id][task_name]}
+        for task_name in ('ADT', 'VDT')
+    }
+    n_subject_trials = sum(len(beh_runs.get(key, [])) for runs in subject_runs.values() for key in runs.values())
+    
+    if n_subject_trials == 0:
+        print(f"Error: No behavioral data found for BAP{subject_id}!")
+        return
     
-    print(f"Found {len(subject_beh_data)} behavioral trials")
+    print(f"Found {n_subject_trials} behavioral trials")
     
     # Process each task
     task_mappings = {
@@ -180,9 +180,8 @@ def process_subject(subject_id, subjects):
         print(f"\nProcessing {task_name}...")
         print(f"  Found {len(task_files)} files")
         
-        # Filter behavioral data for this task
-        task_beh_data = subject_beh_data[subject_beh_data['task'] == beh_task].copy()
-        print(f"  Behavioral trials: {len(task_beh_data)}")
+        task_run_keys = subject_runs[task_name]
+        print(f"  Behavioral trials: {sum(len(beh_runs.get(key, [])) for key in task_run_keys.values())}")
         
         # Initialize combined data
         all_data = []
@@ -195,11 +194,9 @@ def process_subject(subject_id, subjects):
             
             print(f"  Processing session {session}, run {run}: {file_info['filename']}")
             
-            # Filter behavioral data for this run
-            run_beh_data = task_beh_data[
-                (task_beh_data['ses'] == int(session)) & 
-                (task_beh_data['run'] == int(run))
-            ].copy()
+            # Behavioral trials for this run (index lookup)
+            run_rows = beh_runs.get(task_run_keys[(int(session), int(run))], [])
+            run_beh_data = beh_data.iloc[run_rows]
             
             if len(run_beh_data) == 0:
                 print(f"    Warning: No behavioral data for session {session}, run {run}")
@@ -207,18 +204,21 @@ def process_subject(subject_id, subjects):
             
             # Load eye tracking data
             try:
-                mat_data = scipy.io.loadmat(file_path, squeeze_me=False, struct_as_record=False)
-                S = mat_data['S'][0, 0]
-                output = S.output[0, 0]
-                
-                pupil_size = output.sample.flatten()
-                pupil_time = output.smp_timestamp.flatten()
+                with stage('load', file=os.path.basename(file_path)) as st:
+                    mat_data = scipy.io.loadmat(file_path, squeeze_me=False, struct_as_record=False)
+                    st.add_bytes(read=file_size(file_path))
+                    S = mat_data['S'][0, 0]
+                    output = S.output[0, 0]
+                    
+                    pupil_size = output.sample.flatten()
+                    pupil_time = output.smp_timestamp.flatten()
                 
                 print(f"    Original data: {len(pupil_size)} samples at {original_fs} Hz")
                 
                 # Downsample the data
-                pupil_size_ds = downsample_data(pupil_size, original_fs, target_fs)
-                pupil_time_ds = downsample_data(pupil_time, original_fs, target_fs)
+                with stage('resample', file=os.path.basename(file_path), n_samples=len(pupil_size)):
+                    pupil_size_ds = downsample_data(pupil_size, original_fs, target_fs)
+                    pupil_time_ds = downsample_data(pupil_time, original_fs, target_fs)
                 
                 print(f"    Downsampled data: {len(pupil_size_ds)} samples at {target_fs} Hz")
                 
@@ -228,74 +228,76 @@ def process_subject(subject_id, subjects):
                 
                 print(f"    Estimated {samples_per_trial_actual} samples per trial")
                 
-                # Process each trial
-                for trial_idx, trial_beh in run_beh_data.iterrows():
-                    # Calculate trial boundaries
-                    start_sample = int((trial_beh['trial'] - 1) * samples_per_trial_actual)
-                    end_sample = int(trial_beh['trial'] * samples_per_trial_actual)
+                # Segment and label each trial; one stage for the whole loop
+                # (per-trial stages would emit thousands of profiler events)
+                with stage('segment', file=os.path.basename(file_path), n_trials=total_trials):
+                    for trial_idx, trial_beh in run_beh_data.iterrows():
+                        # Calculate trial boundaries
+                        start_sample = int((trial_beh['trial'] - 1) * samples_per_trial_actual)
+                        end_sample = int(trial_beh['trial'] * samples_per_trial_actual)
                     
-                    # Ensure we don't go beyond the data
-                    if end_sample > len(pupil_size_ds):
-                        end_sample = len(pupil_size_ds)
+                        # Ensure we don't go beyond the data
+                        if end_sample > len(pupil_size_ds):
+                            end_sample = len(pupil_size_ds)
                     
-                    if start_sample >= len(pupil_size_ds):
-                        print(f"      Warning: Trial {trial_beh['trial']} starts beyond data range")
-                        continue
+                        if start_sample >= len(pupil_size_ds):
+                            print(f"      Warning: Trial {trial_beh['trial']} starts beyond data range")
+                            continue
                     
-                    # Extract trial data
-                    trial_pupil_size = pupil_size_ds[start_sample:end_sample].copy()
-                    trial_pupil_time = pupil_time_ds[start_sample:end_sample]
+                        # Extract trial data
+                        trial_pupil_size = pupil_size_ds[start_sample:end_sample].astype(np.float32)
+                        trial_pupil_time = pupil_time_ds[start_sample:end_sample]
                     
-                    # Convert 0 values to NaN
-                    trial_pupil_size[trial_pupil_size == 0] = np.nan
+                        # Convert 0 values to NaN
+                        trial_pupil_size[trial_pupil_size == 0] = np.nan
                     
-                    # Create trial parts based on relative timing
-                    trial_duration = len(trial_pupil_size)
-                    part1_end = int(trial_duration * 0.2)    # 0-20%: Pre-trial baseline
-                    part2_end = int(trial_duration * 0.4)    # 20-40%: Pre-squeeze fixation
-                    part3_end = int(trial_duration * 0.6)    # 40-60%: Squeeze period
-                    part4_end = int(trial_duration * 0.8)    # 60-80%: Post-squeeze blank
-                    part5_end = trial_duration               # 80-100%: Response period
+                        # Create trial parts based on relative timing
+                        trial_duration = len(trial_pupil_size)
+                        part1_end = int(trial_duration * 0.2)    # 0-20%: Pre-trial baseline
+                        part2_end = int(trial_duration * 0.4)    # 20-40%: Pre-squeeze fixation
+                        part3_end = int(trial_duration * 0.6)    # 40-60%: Squeeze period
+                        part4_end = int(trial_duration * 0.8)    # 60-80%: Post-squeeze blank
+                        part5_end = trial_duration               # 80-100%: Response period
                     
-                    # Create duration index
-                    duration_index = np.full(trial_duration, np.nan)
-                    duration_index[:part1_end] = 1      # Pre-trial baseline
-                    duration_index[part1_end:part2_end] = 2    # Pre-squeeze fixation
-                    duration_index[part2_end:part3_end] = 3    # Squeeze period
-                    duration_index[part3_end:part4_end] = 4    # Post-squeeze blank
-                    duration_index[part4_end:part5_end] = 5    # Response period
+                        # Create duration index (uint8 phase code, 0 = unknown)
+                        duration_index = np.zeros(trial_duration, dtype=np.uint8)
+                        duration_index[:part1_end] = 1      # Pre-trial baseline
+                        duration_index[part1_end:part2_end] = 2    # Pre-squeeze fixation
+                        duration_index[part2_end:part3_end] = 3    # Squeeze period
+                        duration_index[part3_end:part4_end] = 4    # Post-squeeze blank
+                        duration_index[part4_end:part5_end] = 5    # Response period
                     
-                    # Create trial labels
-                    trial_labels = [create_trial_label(int(d)) if not np.isnan(d) else "unknown" for d in duration_index]
+                        # Create trial labels
+                        trial_labels = phase_labels(duration_index)
                     
-                    # Create trial data with all behavioral columns
-                    trial_data = pd.DataFrame({
-                        'pupil': trial_pupil_size,
-                        'time': trial_pupil_time,
-                        'trial_index': trial_beh['trial'],
-                        'run_index': int(run),
-                        'session_index': int(session),
-                        'duration_index': duration_index,
-                        'trial_label': trial_labels,
-                        'sub': trial_beh['sub'],
-                        'mvc': trial_beh['mvc'],
-                        'ses': trial_beh['ses'],
-                        'task': trial_beh['task'],
-                        'run': trial_beh['run'],
-                        'trial': trial_beh['trial'],
-                        'stimLev': trial_beh['stimLev'],
-                        'isOddball': trial_beh['isOddball'],
-                        'isStrength': trial_beh['isStrength'],
-                        'iscorr': trial_beh['iscorr'],
-                        'resp1': trial_beh['resp1'],
-                        'resp1RT': trial_beh['resp1RT'],
-                        'resp2': trial_beh['resp2'],
-                        'resp2RT': trial_beh['resp2RT'],
-                        'auc_rel_mvc': trial_beh['auc_rel_mvc'],
-                        'resp1_isdiff': trial_beh['resp1_isdiff']
-                    })
+                        # Create trial data with all behavioral columns
+                        trial_data = pd.DataFrame({
+                            'pupil': trial_pupil_size,
+                            'time': trial_pupil_time,
+                            'trial_index': trial_beh['trial'],
+                            'run_index': int(run),
+                            'session_index': int(session),
+                            'duration_index': duration_index,
+                            'trial_label': trial_labels,
+                            'sub': trial_beh['sub'],
+                            'mvc': trial_beh['mvc'],
+                            'ses': trial_beh['ses'],
+                            'task': trial_beh['task'],
+                            'run': trial_beh['run'],
+                            'trial': trial_beh['trial'],
+                            'stimLev': trial_beh['stimLev'],
+                            'isOddball': trial_beh['isOddball'],
+                            'isStrength': trial_beh['isStrength'],
+                            'iscorr': trial_beh['iscorr'],
+                            'resp1': trial_beh['resp1'],
+                            'resp1RT': trial_beh['resp1RT'],
+                            'resp2': trial_beh['resp2'],
+                            'resp2RT': trial_beh['resp2RT'],
+                            'auc_rel_mvc': trial_beh['auc_rel_mvc'],
+                            'resp1_isdiff': trial_beh['resp1_isdiff']
+                        })
                     
-                    all_data.append(trial_data)
+                        all_data.append(trial_data)
                 
             except Exception as e:
                 print(f"    Error processing {file_path}: {e}")
@@ -303,11 +305,13 @@ def process_subject(subject_id, subjects):
         
         # Combine all data
         if all_data:
-            combined_data = pd.concat(all_data, ignore_index=True)
+            combined_data = apply_schema(pd.concat(all_data, ignore_index=True))
             
             # Save to CSV with the specified naming format
-            output_filename = f'BAP{subject_id}_{task_name}_DS{target_fs}.csv'
-            combined_data.to_csv(output_filename, index=False)
+            output_filename = os.path.join(output_dir, f'BAP{subject_id}_{task_name}_DS{target_fs}.csv')
+            with stage('write', file=output_filename, rows=len(combined_data)) as st:
+                write_flat(combined_data, output_filename)
+                st.add_bytes(written=file_size(output_filename))
             
             print(f"  Saved {output_filename}")
             print(f"  Total trials: {combined_data['trial_index'].nunique()}")
@@ -324,7 +328,7 @@ def process_subject(subject_id, subjects):
             # Print trial label distribution
             label_counts = combined_data['trial_label'].value_counts()
             print(f"  Trial label distribution:")
-            for label, count in label_counts.items():
+            for label, count in label_counts[label_counts > 0].items():
                 percentage = (count / len(combined_data)) * 100
                 print(f"    {label}: {count} samples ({percentage:.1f}%)")
         else:
@@ -353,6 +357,7 @@ def main():
     process_subject(selected_subject, subjects)
     
     print("\nProcessing complete!")
+    profile_report()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Compact dtype policy for sample-level flat files.
+
+One place that defines the in-memory dtype of every flat-file column:
+
+    pupil                   float32 (Eyelink units; float32 keeps ~7 digits)
+    time                    float64 (absolute PTB / tracker seconds need it)
+    duration_index          uint8 phase code, 0 = unknown (see PHASE_LABELS)
+    trial_label, sub, task  categorical
+    flags (isOddball, ...)  nullable Int8 (0 / 1 / missing)
+    run / session / trial   nullable small ints
+    behavioral floats       float32
+
+apply_schema() enforces it on a DataFrame (the builders call it when a
+trial table is constructed), write_flat() writes with it (CSV, or parquet
+when the path ends in .parquet, which also keeps the categoricals) and
+read_flat() reads a flat file straight into it.
+
+Usage:
+    python flat_schema.py BAP178_ADT_DS250.csv   # memory report, before vs after
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# duration_index code -> trial_label (1 baseline ... 5 response, 0 = outside any phase)
+PHASE_LABELS = ['unknown', 'baseline', 'fixation', 'squeeze', 'blank', 'response']
+PHASE_DTYPE = pd.CategoricalDtype(PHASE_LABELS)
+
+FLAGS = ['isOddball', 'isStrength', 'iscorr', 'resp1_isdiff']
+
+FLAT_SCHEMA = {
+    'pupil': 'float32',
+    'time': 'float64',
+    'trial_index': 'Int16',
+    'run_index': 'Int8',
+    'session_index': 'Int8',
+    'duration_index': 'uint8',
+    'trial_label': 'category',
+    'sub': 'category',
+    'mvc': 'float32',
+    'ses': 'Int8',
+    'task': 'category',
+    'run': 'Int8',
+    'trial': 'Int16',
+    'stimLev': 'float32',
+    'resp1': 'Int8',
+    'resp1RT': 'float32',
+    'resp2': 'Int8',
+    'resp2RT': 'float32',
+    'auc_rel_mvc': 'float32',
+    **{flag: 'Int8' for flag in FLAGS},
+}
+
+
+def _convert(series, dtype):
+    if dtype == 'category':
+        return series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype('category')
+    if dtype == 'uint8':
+        return series.fillna(0).astype(np.uint8) if series.isna().any() else series.astype(np.uint8)
+    if dtype.startswith('Int') and not pd.api.types.is_integer_dtype(series):
+        # Floats holding whole numbers (read from CSV with NaNs) round-trip exactly
+        series = pd.to_numeric(series, errors='coerce')
+    return series.astype(dtype)
+
+
+def apply_schema(df, schema=FLAT_SCHEMA):
+    """
+    Cast the columns of df that appear in schema, in place, and return df.
+
+    Columns not in the schema are left alone; categoricals that already have
+    their categories (e.g. trial_label built with PHASE_DTYPE) are kept.
+    """
+    for col, dtype in schema.items():
+        if col in df.columns and str(df[col].dtype) != dtype:
+            df[col] = _convert(df[col], dtype)
+    return df
+
+
+def phase_labels(duration_index):
+    """Categorical trial_label for a uint8 duration_index array"""
+    return pd.Categorical.from_codes(np.asarray(duration_index, dtype=np.int8), dtype=PHASE_DTYPE)
+
+
+def write_flat(df, path, schema=FLAT_SCHEMA):
+    """Write a flat table with the schema applied (.parquet keeps dtypes, CSV otherwise)"""
+    apply_schema(df, schema)
+    if str(path).endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def read_flat(path, columns=None, schema=FLAT_SCHEMA):
+    """Read a flat CSV / parquet file directly into the compact schema"""
+    if str(path).endswith('.parquet'):
+        return apply_schema(pd.read_parquet(path, columns=columns), schema)
+    header = pd.read_csv(path, nrows=0).columns
+    # Parse floats and categoricals straight into their narrow types; integer
+    # columns may be written as '1.0' and are finished by apply_schema
+    dtypes = {col: dtype for col, dtype in schema.items()
+              if col in header and (columns is None or col in columns)
+              and dtype in ('category', 'float32', 'float64')}
+    df = pd.read_csv(path, usecols=columns, dtype=dtypes, low_memory=False)
+    return apply_schema(df, schema)
+
+
+def memory_report(df):
+    """Per-column in-memory bytes (deep) as a DataFrame"""
+    usage = df.memory_usage(deep=True, index=False)
+    return pd.DataFrame({'column': usage.index, 'dtype': [str(df[c].dtype) for c in usage.index],
+                         'bytes': usage.to_numpy()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a flat file's memory footprint before / after the schema")
+    parser.add_argument('flat_file', help='Sample-level flat CSV')
+    args = parser.parse_args()
+
+    raw = pd.read_csv(args.flat_file, low_memory=False)
+    compact = read_flat(args.flat_file)
+    before = memory_report(raw).set_index('column')
+    after = memory_report(compact).set_index('column')
+    print(f"{'column':<16} {'before':>10} {'dtype':<10} {'after':>10} {'dtype':<10}")
+    for col in before.index:
+        print(f"{col:<16} {before.at[col, 'bytes'] / 2**20:>8.2f}MB {before.at[col, 'dtype']:<10} "
+              f"{after.at[col, 'bytes'] / 2**20:>8.2f}MB {after.at[col, 'dtype']:<10}")
+    total_before, total_after = before['bytes'].sum(), after['bytes'].sum()
+    print(f"\nTotal: {total_before / 2**20:.1f} MB -> {total_after / 2**20:.1f} MB "
+          f"({total_before / max(total_after, 1):.1f}x smaller)")
+    print(f"File size: {os.path.getsize(args.flat_file) / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
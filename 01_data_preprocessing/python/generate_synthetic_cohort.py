@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic BAP cohort for testing and benchmarking the preprocessing
+pipeline without access to the real data.
+
+Writes, under --output-dir:
+    BAP_cleaned/subjectBAP{ID}_{Aoddball|Voddball}_session{S}_run{R}_eyetrack_cleaned.mat
+        S.output.sample / S.output.smp_timestamp at 2000 Hz (column vectors)
+    data/sub-BAP{ID}/ses-{S}/InsideScanner/<same stem>_logP.txt
+        PTB event log (TrialST, blankST, fixST, fixOFSTP, A/V_ST, ... Resp2ET)
+    bap_trial_data_grip_type1.csv
+        behavioral table with the columns read by create_flat_files_interactive.py
+
+The trial structure follows CONFIG.phases in BAP_Pupillometry_Pipeline.m
+(3 s ITI baseline, squeeze at 0 s, ..., confidence 7.7-10.7 s). The pupil
+trace is a subject baseline plus slow drift, pupil responses to squeeze and
+stimulus onsets (Hoeks & Levelt kernel, larger for high grip), measurement
+noise, blinks and longer dropouts (both written as 0, as in the cleaned
+files). Pupil samples and logP share one clock in seconds.
+
+Every run is seeded from (seed, subject, task, session, run), so a cohort is
+reproducible regardless of the number of workers and a larger cohort
+contains the smaller one.
+
+Usage:
+    python generate_synthetic_cohort.py --output-dir /tmp/bap_synth --subjects 10
+    python generate_synthetic_cohort.py --output-dir /tmp/bap_synth_10x --subjects 650 --workers 8
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.io
+from scipy import signal
+
+FS = 2000  # Hz, as in the cleaned .mat files
+TRIALS_PER_RUN = 30
+SESSIONS = (2, 3)  # InsideScanner sessions
+RUNS_PER_SESSION = 5
+FIRST_SUBJECT_ID = 101
+TASKS = {'Aoddball': 'aud', 'Voddball': 'vis'}
+
+# Event onsets relative to squeeze onset (TrialST), BAP_Pupillometry_Pipeline.m CONFIG.phases
+ITI_BASELINE = 3.0
+ITI_JITTER = 0.2  # uniform extra ITI (s) so trials are not perfectly periodic
+BLANK_ST = 3.0
+FIX_ST = 3.25
+AV_ST = 3.75
+AV_CT = 4.35  # comparison stimulus onset within the 0.7 s stimulus pair
+RELAX_ST = 4.45
+RESP1_ST = 4.7
+RESP2_ST = 7.7
+TRIAL_END = 10.7
+
+# Oddball levels (Hard, Easy) per task; standard trials have stimLev 0
+STIM_LEVELS = {'aud': (8, 16, 32, 64), 'vis': (0.06, 0.12, 0.24, 0.48)}
+P_STANDARD = 0.2
+P_CORRECT = {0: 0.9, 1: 0.6, 2: 0.7, 3: 0.85, 4: 0.95}  # by level index (0 = standard)
+
+# Pupil signal (Eyelink area units)
+BASELINE_RANGE = (3000, 6000)
+NOISE_SD = 15
+DRIFT_SD = 400  # SD of the slow random-walk drift over a run
+SQUEEZE_AMPLITUDE = {0: 120, 1: 350}  # by isStrength (low / high grip)
+STIMULUS_AMPLITUDE = 150
+BLINK_RATE = 0.25  # per second
+BLINK_DURATION = (0.08, 0.4)  # s
+DROPOUT_RATE = 0.01  # per second
+DROPOUT_DURATION = (0.5, 3.0)  # s
+P_BAD_RUN = 0.05  # runs with many more dropouts
+
+BEHAVIOR_COLUMNS = ['sub', 'mvc', 'ses', 'task', 'run', 'trial', 'stimLev', 'isOddball', 'isStrength',
+                    'iscorr', 'resp1', 'resp1RT', 'resp2', 'resp2RT', 'auc_rel_mvc', 'resp1_isdiff']
+LOGP_COLUMNS = ['Trial#', 'TrialST', 'blankST', 'fixST', 'fixOFSTP', 'A/V_ST', 'A/V_CT', 'relaxST',
+                'Resp1ST', 'Resp1ET', 'Resp2ST', 'Resp2ET']
+
+
+def run_stem(subject_id, file_task, session, run):
+    return f'subjectBAP{subject_id}_{file_task}_session{session}_run{run}'
+
+
+def run_specs(n_subjects, sessions=SESSIONS, runs_per_session=RUNS_PER_SESSION, first_id=FIRST_SUBJECT_ID):
+    """(subject_id, file task, session, run) for every run of the cohort"""
+    return [(first_id + i, file_task, ses, run)
+            for i in range(n_subjects)
+            for file_task in TASKS
+            for ses in sessions
+            for run in range(1, runs_per_session + 1)]
+
+
+def pupil_kernel(fs=FS, n=10.1, t_max=0.93, duration=4.0):
+    """Pupil response function t^n exp(-n t / t_max), peak normalized to 1 (Hoeks & Levelt, 1993)"""
+    t = np.arange(int(duration * fs)) / fs
+    h = t ** n * np.exp(-n * t / t_max)
+    return h / h.max()
+
+
+def simulate_behavior(rng, subject_id, beh_task, session, run, mvc, n_trials=TRIALS_PER_RUN):
+    """One run of behavioral trials in the bap_trial_data_grip_type1.csv layout"""
+    levels = STIM_LEVELS[beh_task]
+    level_idx = np.where(rng.random(n_trials) < P_STANDARD, 0, rng.integers(1, len(levels) + 1, n_trials))
+    is_strength = rng.integers(0, 2, n_trials)
+    p_correct = np.array([P_CORRECT[i] for i in level_idx]) - 0.05 * is_strength
+    iscorr = (rng.random(n_trials) < p_correct).astype(int)
+    is_oddball = (level_idx > 0).astype(int)
+    resp1_isdiff = np.where(iscorr == 1, is_oddball, 1 - is_oddball)
+    return pd.DataFrame({
+        'sub': f'BAP{subject_id}',
+        'mvc': mvc,
+        'ses': session,
+        'task': beh_task,
+        'run': run,
+        'trial': np.arange(1, n_trials + 1),
+        'stimLev': np.where(level_idx > 0, np.asarray(levels)[np.maximum(level_idx - 1, 0)], 0),
+        'isOddball': is_oddball,
+        'isStrength': is_strength,
+        'iscorr': iscorr,
+        'resp1': np.where(resp1_isdiff == 1, 1, 2),
+        'resp1RT': np.round(0.25 + rng.lognormal(-0.6, 0.45, n_trials), 4).clip(max=2.9),
+        'resp2': rng.integers(1, 5, n_trials),
+        'resp2RT': np.round(0.3 + rng.lognormal(-0.8, 0.4, n_trials), 4).clip(max=2.9),
+        'auc_rel_mvc': np.round(np.where(is_strength == 1, 0.4, 0.05) + rng.normal(0, 0.03, n_trials), 4),
+        'resp1_isdiff': resp1_isdiff,
+    })
+
+
+def _gap_mask(rng, n_samples, rate, duration_range, fs=FS):
+    """Boolean mask of randomly placed gaps (Poisson onsets, uniform durations)"""
+    n_gaps = rng.poisson(rate * n_samples / fs)
+    starts = rng.integers(0, n_samples, n_gaps)
+    lengths = (rng.uniform(*duration_range, n_gaps) * fs).astype(int)
+    # +1 at each gap start, -1 at each end; cumulative sum > 0 inside any gap
+    edges = np.zeros(n_samples + 1, dtype=np.int32)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, np.minimum(starts + lengths, n_samples), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def simulate_run(rng, behavior, baseline, t_start, fs=FS):
+    """
+    Pupil trace and event log for one run.
+
+    Returns:
+        (sample, smp_timestamp, logP DataFrame)
+    """
+    n_trials = len(behavior)
+    iti = ITI_BASELINE + rng.uniform(0, ITI_JITTER, n_trials)
+    trial_st = t_start + np.cumsum(iti) + TRIAL_END * np.arange(n_trials)
+    t_end = trial_st[-1] + TRIAL_END + ITI_BASELINE
+    n_samples = int(np.ceil((t_end - t_start) * fs))
+    timestamp = t_start + np.arange(n_samples) / fs
+
+    # Impulses at squeeze and stimulus onsets, convolved with the pupil kernel
+    impulses = np.zeros(n_samples)
+    squeeze_idx = ((trial_st - t_start) * fs).astype(int)
+    stim_idx = ((trial_st + AV_ST - t_start) * fs).astype(int)
+    np.add.at(impulses, squeeze_idx, [SQUEEZE_AMPLITUDE[s] for s in behavior['isStrength']])
+    np.add.at(impulses, stim_idx, STIMULUS_AMPLITUDE * (1 + 0.5 * behavior['isOddball'].to_numpy()))
+    evoked = signal.fftconvolve(impulses, pupil_kernel(fs))[:n_samples]
+
+    # Slow drift: random walk at 1 Hz, interpolated to fs
+    n_knots = int(n_samples / fs) + 2
+    walk = np.cumsum(rng.normal(0, 1, n_knots))
+    walk = (walk - walk.mean()) / (walk.std() or 1) * DRIFT_SD / 2
+    drift = np.interp(np.arange(n_samples) / fs, np.arange(n_knots), walk)
+
+    sample = baseline + drift + evoked + rng.normal(0, NOISE_SD, n_samples)
+    dropout_rate = DROPOUT_RATE * (20 if rng.random() < P_BAD_RUN else 1)
+    lost = _gap_mask(rng, n_samples, BLINK_RATE, BLINK_DURATION, fs)
+    lost |= _gap_mask(rng, n_samples, dropout_rate, DROPOUT_DURATION, fs)
+    sample[lost] = 0
+
+    logP = pd.DataFrame({
+        'Trial#': np.arange(1, n_trials + 1),
+        'TrialST': trial_st,
+        'blankST': trial_st + BLANK_ST,
+        'fixST': trial_st + FIX_ST,
+        'fixOFSTP': trial_st + AV_ST,
+        'A/V_ST': trial_st + AV_ST,
+        'A/V_CT': trial_st + AV_CT,
+        'relaxST': trial_st + RELAX_ST,
+        'Resp1ST': trial_st + RESP1_ST,
+        'Resp1ET': trial_st + RESP1_ST + behavior['resp1RT'].to_numpy(),
+        'Resp2ST': trial_st + RESP2_ST,
+        'Resp2ET': trial_st + RESP2_ST + behavior['resp2RT'].to_numpy(),
+    })[LOGP_COLUMNS]
+    return sample, timestamp, logP
+
+
+def write_logP(path, logP, stem):
+    """Tab-separated PTB log with '%' header lines, as read by parse_logP_file.m"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(f'% Synthetic PTB log for {stem}\n')
+        f.write('% Times in seconds (same clock as S.output.smp_timestamp)\n')
+        f.write('\t'.join(LOGP_COLUMNS) + '\n')
+        logP.to_csv(f, sep='\t', header=False, index=False, float_format='%.4f')
+
+
+def generate_run(spec, output_dir, seed=0, compress=False):
+    """
+    Write the .mat and logP files of one run.
+
+    Returns:
+        (behavior DataFrame, n_samples, bytes written)
+    """
+    subject_id, file_task, session, run = spec
+    beh_task = TASKS[file_task]
+    # Subject-level traits are drawn from a subject-only stream so they match across runs
+    subject_rng = np.random.default_rng([seed, subject_id])
+    baseline = subject_rng.uniform(*BASELINE_RANGE)
+    mvc = round(float(subject_rng.uniform(20, 60)), 2)
+    rng = np.random.default_rng([seed, subject_id, list(TASKS).index(file_task), session, run])
+
+    behavior = simulate_behavior(rng, subject_id, beh_task, session, run, mvc)
+    t_start = rng.uniform(1000, 5000) + 3600 * (run + 10 * session)
+    sample, timestamp, logP = simulate_run(rng, behavior, baseline, t_start)
+
+    stem = run_stem(subject_id, file_task, session, run)
+    mat_path = os.path.join(output_dir, 'BAP_cleaned', f'{stem}_eyetrack_cleaned.mat')
+    logP_path = os.path.join(output_dir, 'data', f'sub-BAP{subject_id}', f'ses-{session}',
+                             'InsideScanner', f'{stem}_logP.txt')
+    os.makedirs(os.path.dirname(mat_path), exist_ok=True)
+    scipy.io.savemat(mat_path, {'S': {'output': {'sample': sample[:, None], 'smp_timestamp': timestamp[:, None]}}},
+                     do_compression=compress)
+    write_logP(logP_path, logP, stem)
+    return behavior, len(sample), os.path.getsize(mat_path) + os.path.getsize(logP_path)
+
+
+def generate_cohort(output_dir, n_subjects, sessions=SESSIONS, runs_per_session=RUNS_PER_SESSION,
+                    first_id=FIRST_SUBJECT_ID, seed=0, workers=None, compress=False):
+    """
+    Generate all runs in parallel and write the behavioral table.
+
+    Returns:
+        dict with n_runs, n_trials, n_samples, bytes and elapsed seconds
+    """
+    specs = run_specs(n_subjects, sessions, runs_per_session, first_id)
+    os.makedirs(output_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    behaviors, n_samples, n_bytes = [], 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(generate_run, spec, output_dir, seed, compress) for spec in specs]
+        for i, future in enumerate(futures, 1):
+            behavior, n, size = future.result()
+            behaviors.append(behavior)
+            n_samples += n
+            n_bytes += size
+            if i % 50 == 0 or i == len(futures):
+                print(f"  {i}/{len(futures)} runs written")
+
+    beh_path = os.path.join(output_dir, 'bap_trial_data_grip_type1.csv')
+    behavior = pd.concat(behaviors, ignore_index=True)[BEHAVIOR_COLUMNS]
+    behavior.to_csv(beh_path, index=False)
+    n_bytes += os.path.getsize(beh_path)
+    return {'n_runs': len(specs), 'n_trials': len(behavior), 'n_samples': n_samples,
+            'bytes': n_bytes, 'elapsed': time.perf_counter() - t0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic BAP cohort (.mat, logP, behavioral CSV)")
+    parser.add_argument('--output-dir', required=True, help='Cohort root directory')
+    parser.add_argument('--subjects', type=int, default=5, help='Number of subjects (default: 5)')
+    parser.add_argument('--sessions', default=','.join(map(str, SESSIONS)), help='Comma-separated sessions')
+    parser.add_argument('--runs', type=int, default=RUNS_PER_SESSION, help='Runs per session and task')
+    parser.add_argument('--first-id', type=int, default=FIRST_SUBJECT_ID, help='First subject number')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='Worker processes')
+    parser.add_argument('--compress', action='store_true', help='Write compressed .mat files')
+    args = parser.parse_args()
+
+    sessions = tuple(int(s) for s in args.sessions.split(','))
+    n_runs = args.subjects * len(TASKS) * len(sessions) * args.runs
+    print("=== SYNTHETIC BAP COHORT ===")
+    print(f"Subjects: {args.subjects}, sessions: {sessions}, runs/session: {args.runs} -> {n_runs} runs")
+
+    stats = generate_cohort(args.output_dir, args.subjects, sessions, args.runs, args.first_id,
+                            args.seed, args.workers, args.compress)
+    print(f"\n✓ {stats['n_runs']} runs, {stats['n_trials']} trials, {stats['n_samples'] / 1e6:.1f} M samples")
+    print(f"✓ {stats['bytes'] / 2**20:.1f} MB written in {stats['elapsed']:.1f} s")
+    print(f"✓ Cohort saved to: {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
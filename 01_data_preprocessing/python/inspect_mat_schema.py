@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Inspect the structure of every cleaned .mat file and group files by schema.
+
+Replaces the one-file examine/check/list scripts: each file's struct tree is
+walked down to a depth limit and reduced to a schema (field paths, shapes,
+dtypes) and a fingerprint. Files are scanned in parallel, schemas are cached
+by (size, mtime), and the report groups files by schema variant so drift
+across hundreds of runs is visible at a glance.
+
+v7.3 (HDF5) files are walked through h5py metadata without reading any data.
+v5 files have no field index: their top-level variables come from whosmat(),
+but walking a struct's fields means loadmat() decodes the whole variable,
+sample vectors included. Use --max-depth 1 for a whosmat-only scan.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.io
+from scipy.io.matlab import matfile_version
+
+# Configuration
+DEFAULT_BASE_DIR = '/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_cleaned'
+CACHE_FILENAME = '.mat_schema_cache.json'
+DEFAULT_MAX_DEPTH = 4
+SCHEMA_VERSION = 1  # Bump when the schema representation changes
+
+
+def shape_pattern(shape):
+    """
+    Shape with run-dependent lengths generalized.
+
+    (1, 734210) and (1, 812044) both become '1xN', so sample vectors of
+    different runs share a fingerprint while orientation changes do not.
+    """
+    return 'x'.join('1' if dim == 1 else ('0' if dim == 0 else 'N') for dim in shape) or 'scalar'
+
+
+def _numpy_class(array):
+    """MATLAB-like class name for a numpy array"""
+    if array.dtype.names:
+        return 'struct'
+    if array.dtype == object:
+        return 'cell'
+    if array.dtype.kind in ('U', 'S'):
+        return 'char'
+    return array.dtype.name
+
+
+def walk_numpy(value, path, depth, max_depth, entries):
+    """Append (path, class, shape) entries for a loadmat(struct_as_record=True) value"""
+    array = np.asarray(value)
+    cls = _numpy_class(array)
+    entries.append((path, cls, tuple(int(d) for d in array.shape)))
+    if depth >= max_depth or array.size == 0:
+        return
+
+    if cls == 'struct':
+        first = array.flat[0]
+        for name in array.dtype.names:
+            walk_numpy(first[name], f'{path}.{name}', depth + 1, max_depth, entries)
+    elif cls == 'cell':
+        # Cells are described by their first element
+        walk_numpy(array.flat[0], f'{path}{{1}}', depth + 1, max_depth, entries)
+
+
+def walk_hdf5(node, path, depth, max_depth, entries):
+    """Append (path, class, shape) entries for a v7.3 file without reading data"""
+    import h5py
+
+    matlab_class = node.attrs.get('MATLAB_class', b'')
+    matlab_class = matlab_class.decode() if isinstance(matlab_class, bytes) else str(matlab_class)
+
+    if isinstance(node, h5py.Group):
+        entries.append((path, matlab_class or 'struct', ()))
+        if depth >= max_depth:
+            return
+        for name in sorted(node.keys()):
+            if name.startswith('#'):
+                continue
+            walk_hdf5(node[name], f'{path}.{name}', depth + 1, max_depth, entries)
+    else:
+        # HDF5 stores MATLAB arrays transposed
+        entries.append((path, matlab_class or node.dtype.name, tuple(int(d) for d in node.shape[::-1])))
+
+
+def read_schema(filepath, max_depth=DEFAULT_MAX_DEPTH):
+    """
+    Extract the schema of one .mat file.
+
+    On v5 files, top-level variables are listed with whosmat(); with
+    max_depth > 1 every struct / cell variable is then fully decoded by
+    loadmat() to walk its fields.
+
+    Returns a list of (path, class, shape) tuples, ordered as walked.
+    """
+    with open(filepath, 'rb') as f:
+        major, _ = matfile_version(f)
+
+    entries = []
+    if major == 2:
+        import h5py
+        with h5py.File(filepath, 'r') as h5:
+            for name in sorted(h5.keys()):
+                if not name.startswith('#'):
+                    walk_hdf5(h5[name], name, 1, max_depth, entries)
+        return entries
+
+    variables = scipy.io.whosmat(filepath)
+    struct_names = [name for name, _, cls in variables if cls in ('struct', 'cell')]
+    for name, shape, cls in variables:
+        if name not in struct_names:
+            entries.append((name, cls, tuple(shape)))
+
+    if struct_names and max_depth > 1:
+        mat_data = scipy.io.loadmat(filepath, variable_names=struct_names,
+                                    squeeze_me=False, struct_as_record=True)
+        for name in struct_names:
+            walk_numpy(mat_data[name], name, 1, max_depth, entries)
+    else:
+        for name, shape, cls in variables:
+            if name in struct_names:
+                entries.append((name, cls, tuple(shape)))
+
+    return entries
+
+
+def fingerprint(entries):
+    """Stable fingerprint over field paths, classes and generalized shapes"""
+    digest = hashlib.sha1()
+    for path, cls, shape in sorted(entries):
+        digest.update(f'{path}|{cls}|{shape_pattern(shape)}\n'.encode())
+    return digest.hexdigest()[:12]
+
+
+def _inspect_file(args):
+    """Worker: schema + fingerprint for one file"""
+    filepath, max_depth = args
+    try:
+        entries = read_schema(filepath, max_depth)
+        return os.path.basename(filepath), {
+            'schema': [[path, cls, list(shape)] for path, cls, shape in entries],
+            'fingerprint': fingerprint(entries),
+        }
+    except Exception as e:
+        return os.path.basename(filepath), {'error': f'{type(e).__name__}: {e}'}
+
+
+def load_cache(cache_path):
+    """Load the schema cache ({filename: entry})"""
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache.get('version') == SCHEMA_VERSION:
+                return cache.get('files', {})
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def save_cache(cache_path, files):
+    """Write the schema cache atomically"""
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': SCHEMA_VERSION, 'files': files}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def scan_directory(base_dir, pattern_suffix='.mat', max_depth=DEFAULT_MAX_DEPTH,
+                   workers=None, cache_path=None, force=False):
+    """
+    Schema-scan every .mat file in base_dir.
+
+    Args:
+        base_dir: Directory with cleaned .mat files
+        pattern_suffix: Only files ending in this suffix are scanned
+        max_depth: Struct depth limit (1 = top-level variables only)
+        workers: Process pool size (default: CPU count)
+        cache_path: Schema cache file (default: base_dir/.mat_schema_cache.json)
+        force: Ignore the cache
+
+    Returns:
+        (results, n_scanned): results is {filename: {'schema', 'fingerprint'}
+        or {'error'}}, n_scanned the number of files read (not from the cache).
+        Files that failed are not cached, so they are retried on the next run.
+    """
+    cache_path = cache_path or os.path.join(base_dir, CACHE_FILENAME)
+    cache = {} if force else load_cache(cache_path)
+
+    results = {}
+    to_scan = []
+    for name in sorted(os.listdir(base_dir)):
+        if not name.endswith(pattern_suffix):
+            continue
+        st = os.stat(os.path.join(base_dir, name))
+        entry = cache.get(name)
+        if (entry and entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns
+                and entry.get('max_depth') == max_depth):
+            results[name] = entry
+        else:
+            to_scan.append((name, st))
+
+    if to_scan:
+        jobs = [(os.path.join(base_dir, name), max_depth) for name, _ in to_scan]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scanned = dict(pool.map(_inspect_file, jobs, chunksize=4))
+        for name, st in to_scan:
+            entry = scanned[name]
+            entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns, max_depth=max_depth)
+            results[name] = entry
+
+    try:
+        save_cache(cache_path, {name: entry for name, entry in results.items() if 'error' not in entry})
+    except OSError as e:
+        print(f"Warning: could not write schema cache: {e}")
+
+    return results, len(to_scan)
+
+
+def group_by_variant(results):
+    """{fingerprint: [filenames]}, most common variant first"""
+    groups = defaultdict(list)
+    for name, entry in results.items():
+        groups[entry.get('fingerprint', 'ERROR')].append(name)
+    return dict(sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])))
+
+
+def schema_lines(entry):
+    """Human-readable schema lines for one file"""
+    return [f"{path}  [{cls}]  {'x'.join(map(str, shape)) or 'scalar'}"
+            for path, cls, shape in entry['schema']]
+
+
+def diff_schemas(reference, other):
+    """Paths added, removed or changed (class / shape pattern) relative to reference"""
+    ref = {path: (cls, shape_pattern(shape)) for path, cls, shape in reference['schema']}
+    new = {path: (cls, shape_pattern(shape)) for path, cls, shape in other['schema']}
+    added = sorted(set(new) - set(ref))
+    removed = sorted(set(ref) - set(new))
+    changed = sorted(path for path in set(ref) & set(new) if ref[path] != new[path])
+    return added, removed, changed
+
+
+def print_report(results, show_schema=True):
+    """Print files grouped by schema variant"""
+    groups = group_by_variant(results)
+    print(f"\n{'='*60}")
+    print(f"SCHEMA VARIANTS: {len(groups)} across {len(results)} files")
+    print(f"{'='*60}")
+
+    reference, reference_index = None, None
+    for i, (fp, names) in enumerate(groups.items(), 1):
+        example = results[names[0]]
+        print(f"\nVariant {i} [{fp}]: {len(names)} file(s)")
+        for name in names[:5]:
+            print(f"  {name}")
+        if len(names) > 5:
+            print(f"  ... and {len(names) - 5} more")
+
+        if 'error' in example:
+            for name in names:
+                print(f"  ✗ {name}: {results[name]['error']}")
+            continue
+
+        if reference is None:
+            reference, reference_index = example, i
+            if show_schema:
+                print("  Schema:")
+                for line in schema_lines(example):
+                    print(f"    {line}")
+        else:
+            added, removed, changed = diff_schemas(reference, example)
+            print(f"  Differences from variant {reference_index}:")
+            for path in added:
+                print(f"    + {path}")
+            for path in removed:
+                print(f"    - {path}")
+            for path in changed:
+                print(f"    ~ {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Group cleaned .mat files by struct schema")
+    parser.add_argument('base_dir', nargs='?', default=DEFAULT_BASE_DIR, help='Directory with cleaned .mat files')
+    parser.add_argument('--max-depth', type=int, default=DEFAULT_MAX_DEPTH, help='Struct depth limit (default: 4)')
+    parser.add_argument('--workers', type=int, help='Number of worker processes')
+    parser.add_argument('--cache', help='Schema cache path')
+    parser.add_argument('--force', action='store_true', help='Ignore cached schemas')
+    parser.add_argument('--show', help='Print the full schema of one file and exit')
+    parser.add_argument('--json', help='Write {filename: schema entry} to this JSON file')
+    args = parser.parse_args()
+
+    if args.show:
+        entries = read_schema(args.show, args.max_depth)
+        print(f"Schema of {os.path.basename(args.show)} [{fingerprint(entries)}]:")
+        for path, cls, shape in entries:
+            print(f"  {path}  [{cls}]  {'x'.join(map(str, shape)) or 'scalar'}")
+        return
+
+    if not os.path.isdir(args.base_dir):
+        print(f"Error: directory not found: {args.base_dir}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results, n_scanned = scan_directory(args.base_dir, max_depth=args.max_depth, workers=args.workers,
+                                        cache_path=args.cache, force=args.force)
+    elapsed = time.perf_counter() - start
+
+    print(f"Found {len(results)} .mat files ({n_scanned} scanned, {len(results) - n_scanned} cached) "
+          f"in {elapsed:.2f} s")
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved schema report to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Migrate legacy sample-level flat CSVs to partitioned parquet.
+
+Converts BAP{ID}_{task}_DS250.csv (Python builder) and *_flat.csv (MATLAB
+pipeline) files without reprocessing from the .mat files:
+
+1. The header is matched against COL_MAP (the col_map alternatives of
+   make_quick_share_v7.R: time_ptb / trial_pupilTime -> time, pupilSize ->
+   pupil, ses -> session_used, ...) to detect the file's schema variant;
+   matched columns are written under their canonical names.
+2. The CSV is streamed in --chunk-rows chunks with explicit dtypes (the
+   flat_schema policy for known columns, types inferred from the first rows
+   for the rest), so memory stays bounded regardless of file size.
+3. Each chunk is appended as a row group to
+   <out>/participant=BAP{ID}/modality={ADT|VDT}/<stem>.parquet (hive
+   layout, readable with arrow::open_dataset; the partition keys do not
+   clash with the sub / task columns kept in each file), written to a
+   temporary file first.
+4. Verification: the source record count, the parsed row count and the
+   parquet row count must agree, and a digest of per-row hashes computed
+   while writing must match the digest of the parquet file read back.
+   Only then is the temporary file moved into place.
+
+Files are converted in parallel; a manifest (source size / mtime / sha256,
+variant, rows, digest) lets reruns skip files that are already migrated.
+
+Usage:
+    python migrate_flat_csvs.py --input-dir .../BAP_processed --output-dir .../BAP_processed_parquet
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from flat_schema import FLAT_SCHEMA, apply_schema
+
+PROCESSED_DIR = "/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_processed"
+PATTERNS = ('*_flat.csv', 'BAP*_DS250.csv')
+CHUNK_ROWS = 500_000
+INFER_ROWS = 10_000  # rows used to infer dtypes of columns outside the schema
+MANIFEST_NAME = 'migration_manifest.csv'
+
+# Canonical column -> alternatives, first match wins (make_quick_share_v7.R col_map)
+COL_MAP = {
+    'sub': ['sub', 'subject', 'subject_id'],
+    'task': ['task', 'task_name', 'task_modality'],
+    'session_used': ['session_used', 'ses', 'session', 'session_num'],
+    'run_used': ['run_used', 'run', 'run_num'],
+    'trial_index': ['trial_index', 'trial_in_run_raw', 'trial_in_run', 'trial_num'],
+    'time': ['time', 'time_ptb', 'trial_pupilTime', 'time_sec'],
+    'pupil': ['pupil', 'pupilSize', 'pupil_diameter'],
+    'trial_label': ['trial_label', 'phase', 'label', 'phase_label'],
+    'trial_start_time_ptb': ['trial_start_time_ptb', 'trialStartTime_ptb', 'trial_start_ptb'],
+}
+
+MIGRATION_SCHEMA = {
+    **FLAT_SCHEMA,
+    'session_used': 'Int8',
+    'run_used': 'Int8',
+    'trial_in_run_raw': 'Int16',
+    'trial_in_run': 'Int16',
+    'trial_start_time_ptb': 'float64',
+}
+
+TASK_NAMES = {'aoddball': 'ADT', 'adt': 'ADT', 'aud': 'ADT', 'voddball': 'VDT', 'vdt': 'VDT', 'vis': 'VDT'}
+FILENAME_PATTERNS = [
+    re.compile(r'BAP(?P<sub>\d+)_(?P<task>ADT|VDT)_DS\d+', re.IGNORECASE),
+    re.compile(r'(?:subject)?BAP(?P<sub>\d+)_(?P<task>[AV]oddball|ADT|VDT)', re.IGNORECASE),
+]
+
+
+def detect_variant(columns):
+    """
+    Map a CSV header onto COL_MAP.
+
+    Returns:
+        (rename dict source -> canonical, variant label). The label lists the
+        non-canonical source names used, or 'canonical'.
+    """
+    columns = list(columns)
+    rename, used = {}, []
+    for target, candidates in COL_MAP.items():
+        source = next((c for c in candidates if c in columns), None)
+        if source is None or source == target:
+            continue
+        # keep an existing canonical column rather than overwriting it
+        if target in columns:
+            continue
+        rename[source] = target
+        used.append(f'{source}->{target}')
+    return rename, '+'.join(used) if used else 'canonical'
+
+
+def partition_of(path, first_chunk=None):
+    """(sub, task) partition values from the file name, or from the data"""
+    name = os.path.basename(path)
+    for pattern in FILENAME_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            return f"BAP{match.group('sub')}", TASK_NAMES.get(match.group('task').lower(), match.group('task'))
+    if first_chunk is not None and len(first_chunk):
+        sub = str(first_chunk['sub'].iloc[0]) if 'sub' in first_chunk else 'unknown'
+        task = str(first_chunk['task'].iloc[0]) if 'task' in first_chunk else 'unknown'
+        sub = sub if sub.upper().startswith('BAP') else f'BAP{sub}'
+        return sub, TASK_NAMES.get(task.lower(), task)
+    return 'unknown', 'unknown'
+
+
+def read_dtypes(path, rename):
+    """
+    Explicit read_csv dtypes for every column of a file.
+
+    Schema columns get their float / categorical type (integers are read as
+    float64 and narrowed after parsing, since legacy files write '1.0');
+    other columns get the type inferred from the first INFER_ROWS rows,
+    widened so later chunks cannot disagree (int -> float64, object or
+    all-missing -> str).
+    """
+    sample = pd.read_csv(path, nrows=INFER_ROWS, low_memory=False)
+    dtypes = {}
+    for col in sample.columns:
+        target = MIGRATION_SCHEMA.get(rename.get(col, col))
+        if target in ('float32', 'float64', 'category'):
+            dtypes[col] = target
+        elif target is not None:
+            dtypes[col] = 'float64'
+        elif sample[col].isna().all():
+            dtypes[col] = str  # empty so far; text holds whatever comes later
+        elif pd.api.types.is_bool_dtype(sample[col]):
+            dtypes[col] = 'boolean'
+        elif pd.api.types.is_numeric_dtype(sample[col]):
+            dtypes[col] = 'float64'
+        else:
+            dtypes[col] = str
+    return dtypes
+
+
+def count_records(path):
+    """
+    Number of CSV data records, counted by an independent csv-module pass.
+
+    Quoted fields may contain newlines and blank lines are not records (the
+    same rules as pandas' reader), so this counts rows, not newlines.
+    """
+    with open(path, newline='') as f:
+        n = sum(1 for record in csv.reader(f) if record)
+    return max(n - 1, 0)
+
+
+def file_sha256(path, block_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _arrow_schema(table):
+    """Chunk-independent schema: dictionary columns with int32 indices"""
+    fields = []
+    for field in table.schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _update_digest(digest, df):
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+
+def convert_file(path, output_dir, chunk_rows=CHUNK_ROWS):
+    """
+    Stream one CSV into a verified parquet file.
+
+    Returns:
+        manifest row (dict); 'status' is 'ok' or starts with 'error'
+    """
+    t0 = time.perf_counter()
+    stat = os.stat(path)
+    row = {'source': os.path.abspath(path), 'source_bytes': stat.st_size, 'source_mtime': stat.st_mtime}
+    tmp_path = None
+    try:
+        header = pd.read_csv(path, nrows=0).columns
+        rename, variant = detect_variant(header)
+        dtypes = read_dtypes(path, rename)
+        row['variant'] = variant
+
+        writer, schema, n_rows, digest = None, None, 0, hashlib.blake2b(digest_size=16)
+        try:
+            for chunk in pd.read_csv(path, dtype=dtypes, chunksize=chunk_rows, low_memory=False):
+                chunk = apply_schema(chunk.rename(columns=rename), MIGRATION_SCHEMA)
+                if writer is None:
+                    sub, task = partition_of(path, chunk)
+                    out_dir = os.path.join(output_dir, f'participant={sub}', f'modality={task}')
+                    os.makedirs(out_dir, exist_ok=True)
+                    out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '.parquet')
+                    tmp_path = out_path + '.tmp'
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    schema = _arrow_schema(table).with_metadata({
+                        **(table.schema.metadata or {}),
+                        b'bap_source': os.path.basename(path).encode(),
+                        b'bap_variant': variant.encode(),
+                    })
+                    writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                _update_digest(digest, chunk)
+                n_rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            raise ValueError('no data rows')
+
+        # Verify: record count, parsed rows, parquet rows and content digest
+        n_records = count_records(path)
+        parquet_file = pq.ParquetFile(tmp_path)
+        n_parquet = parquet_file.metadata.num_rows
+        check = hashlib.blake2b(digest_size=16)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            _update_digest(check, apply_schema(batch.to_pandas(), MIGRATION_SCHEMA))
+        if not n_records == n_rows == n_parquet:
+            raise ValueError(f'row counts differ: records={n_records} parsed={n_rows} parquet={n_parquet}')
+        if check.hexdigest() != digest.hexdigest():
+            raise ValueError('content digest of parquet does not match the parsed CSV')
+
+        os.replace(tmp_path, out_path)
+        row.update(output=out_path, rows=n_rows, output_bytes=os.path.getsize(out_path),
+                   source_sha256=file_sha256(path), content_digest=digest.hexdigest(), status='ok')
+    except Exception as e:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        row['status'] = f'error: {type(e).__name__}: {e}'
+    row['seconds'] = time.perf_counter() - t0
+    return row
+
+
+def load_manifest(path):
+    return pd.read_csv(path) if os.path.exists(path) else pd.DataFrame()
+
+
+def up_to_date(manifest, path):
+    """True if the manifest has a verified conversion of this exact source file"""
+    if manifest.empty:
+        return False
+    stat = os.stat(path)
+    entry = manifest[(manifest['source'] == os.path.abspath(path)) & (manifest['status'] == 'ok')]
+    return bool(len(entry)) and entry['source_bytes'].iloc[-1] == stat.st_size \
+        and np.isclose(entry['source_mtime'].iloc[-1], stat.st_mtime) and os.path.exists(entry['output'].iloc[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate flat CSVs to partitioned, verified parquet")
+    parser.add_argument('--input-dir', default=PROCESSED_DIR, help='Directory with legacy flat CSVs')
+    parser.add_argument('--output-dir', required=True, help='Root of the parquet dataset')
+    parser.add_argument('--patterns', nargs='+', default=list(PATTERNS), help='File patterns to migrate')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='Rows per streamed chunk / row group')
+    parser.add_argument('--workers', type=int, help='Parallel file conversions')
+    parser.add_argument('--force', action='store_true', help='Reconvert files already in the manifest')
+    args = parser.parse_args()
+
+    files = sorted({p for pattern in args.patterns for p in glob.glob(os.path.join(args.input_dir, pattern))})
+    if not files:
+        print(f"❌ No files matching {', '.join(args.patterns)} in {args.input_dir}")
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    todo = files if args.force else [p for p in files if not up_to_date(manifest, p)]
+    print("=== FLAT CSV -> PARQUET MIGRATION ===")
+    print(f"{len(files)} files found, {len(files) - len(todo)} already migrated, {len(todo)} to convert\n")
+    if not todo:
+        print("✓ Nothing to convert")
+        return
+
+    t0 = time.perf_counter()
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(convert_file, path, args.output_dir, args.chunk_rows): path for path in todo}
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            name = os.path.basename(row['source'])
+            if row['status'] == 'ok':
+                print(f"  ✓ {name}: {row['rows']} rows [{row['variant']}] "
+                      f"{row['source_bytes'] / 2**20:.1f} MB -> {row['output_bytes'] / 2**20:.1f} MB")
+            else:
+                print(f"  ✗ {name}: {row['status']}")
+
+    if rows:
+        new = pd.DataFrame(rows)
+        if not manifest.empty:
+            manifest = manifest[~manifest['source'].isin(new['source'])]
+        pd.concat([manifest, new], ignore_index=True).to_csv(manifest_path, index=False)
+
+    ok = [r for r in rows if r['status'] == 'ok']
+    src = sum(r['source_bytes'] for r in ok)
+    out = sum(r['output_bytes'] for r in ok)
+    print(f"\n✓ {len(ok)}/{len(rows)} files converted in {time.perf_counter() - t0:.1f} s")
+    if ok:
+        print(f"  {src / 2**20:.1f} MB CSV -> {out / 2**20:.1f} MB parquet ({src / max(out, 1):.1f}x smaller)")
+    print(f"✓ Manifest saved to: {manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Shared-memory transport for NumPy arrays between pipeline processes.
+
+Instead of pickling 2000 Hz sample arrays and 250 Hz trial matrices into
+and out of every worker, a stage writes its arrays once into a
+multiprocessing.shared_memory block and passes on a small picklable
+ArrayDescriptor (block name plus offset / shape / dtype of each array).
+The next stage attaches by name and works on NumPy views of the same pages.
+
+Ownership: the coordinating process keeps a SharedArrayRegistry. Blocks it
+publishes itself, or adopts from a worker that created them, are reference
+counted; release() drops a reference and the block is unlinked when the
+count reaches zero. Closing the registry unlinks whatever is left, so an
+exception in the pipeline does not leak /dev/shm segments.
+
+run_pipeline() chains decode -> resample -> segment -> features per run
+this way, keeping at most --max-inflight runs resident at once.
+
+Usage:
+    python shared_arrays.py --cleaned-dir /tmp/bap_synth/BAP_cleaned --workers 4
+"""
+
+import argparse
+import glob
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+ALIGNMENT = 64  # byte alignment of each array inside a block
+ORIGINAL_FS = 2000
+TARGET_FS = 250
+TRIALS_PER_RUN = 30
+
+# fields: tuple of (key, offset, shape, dtype str)
+ArrayDescriptor = namedtuple('ArrayDescriptor', ['name', 'fields', 'nbytes'])
+
+
+def _layout(arrays):
+    """Aligned offsets for a dict of arrays; returns (fields, total bytes)"""
+    fields, offset = [], 0
+    for key, arr in arrays.items():
+        arr = np.asarray(arr)
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        fields.append((key, offset, arr.shape, arr.dtype.str))
+        offset += arr.nbytes
+    return tuple(fields), max(offset, 1)
+
+
+def _views(shm, descriptor, writeable=False):
+    views = {}
+    for key, offset, shape, dtype in descriptor.fields:
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        view.flags.writeable = writeable
+        views[key] = view
+    return views
+
+
+def create_segment(arrays):
+    """
+    Copy a dict of arrays into a new shared block and detach from it.
+
+    For use in workers: the block stays alive after this process lets go of
+    it, and the coordinator must adopt() the returned descriptor so it is
+    eventually unlinked.
+
+    Returns:
+        ArrayDescriptor
+    """
+    fields, size = _layout(arrays)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    descriptor = ArrayDescriptor(shm.name, fields, size)
+    try:
+        for (key, offset, shape, dtype), arr in zip(fields, arrays.values()):
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)[...] = arr
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return descriptor
+
+
+@contextmanager
+def attach(descriptor, writeable=False):
+    """
+    Views of the arrays in a shared block, valid inside the with-block.
+
+    Copy anything that must outlive the block; the mapping is closed on exit
+    (or left to the garbage collector if views are still referenced).
+    """
+    # Workers share the coordinator's resource tracker (see
+    # SharedArrayRegistry), so attaching here does not hand cleanup of the
+    # block to this process.
+    shm = shared_memory.SharedMemory(name=descriptor.name)
+    views = _views(shm, descriptor, writeable)
+    try:
+        yield views
+    finally:
+        views.clear()
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+class SharedArrayRegistry:
+    """
+    Reference-counted owner of shared blocks in the coordinating process.
+
+    Use as a context manager; everything still registered is unlinked on exit.
+    """
+
+    def __init__(self):
+        # Start the resource tracker before any worker pool is created so that
+        # workers inherit it instead of starting their own, which would treat
+        # every block they created or attached as leaked when they exit.
+        resource_tracker.ensure_running()
+        self._blocks = {}  # name -> [SharedMemory, refcount, nbytes]
+        self.bytes_live = 0
+        self.bytes_peak = 0
+        self.bytes_published = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _register(self, shm, descriptor, refs):
+        self._blocks[descriptor.name] = [shm, refs, descriptor.nbytes]
+        self.bytes_live += descriptor.nbytes
+        self.bytes_published += descriptor.nbytes
+        self.bytes_peak = max(self.bytes_peak, self.bytes_live)
+        return descriptor
+
+    def publish(self, arrays, refs=1):
+        """Copy arrays into a new block owned by this registry"""
+        fields, size = _layout(arrays)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        descriptor = ArrayDescriptor(shm.name, fields, size)
+        for key, view in _views(shm, descriptor, writeable=True).items():
+            view[...] = arrays[key]
+        return self._register(shm, descriptor, refs)
+
+    def adopt(self, descriptor, refs=1):
+        """Take ownership of a block created by a worker with create_segment()"""
+        shm = shared_memory.SharedMemory(name=descriptor.name)
+        return self._register(shm, descriptor, refs)
+
+    def acquire(self, descriptor, n=1):
+        """Add n references (e.g. one per additional consumer)"""
+        self._blocks[descriptor.name][1] += n
+
+    def release(self, descriptor):
+        """Drop one reference; unlink the block when none are left"""
+        entry = self._blocks.get(descriptor.name)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            self._unlink(descriptor.name)
+
+    def views(self, descriptor):
+        """Read-only views in the owning process"""
+        return _views(self._blocks[descriptor.name][0], descriptor)
+
+    def _unlink(self, name):
+        shm, _, nbytes = self._blocks.pop(name)
+        self.bytes_live -= nbytes
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        for name in list(self._blocks):
+            self._unlink(name)
+        self.bytes_live = 0
+
+
+# ---------------------------------------------------------------------------
+# Pipeline stages (run in worker processes; exchange descriptors only)
+# ---------------------------------------------------------------------------
+
+def decode_stage(mat_path):
+    """Load a cleaned .mat file and publish its sample / smp_timestamp arrays"""
+    import scipy.io
+
+    mat_data = scipy.io.loadmat(mat_path, squeeze_me=False, struct_as_record=False)
+    output = mat_data['S'][0, 0].output[0, 0]
+    return create_segment({'sample': output.sample.ravel(), 'time': output.smp_timestamp.ravel()})
+
+
+def resample_stage(descriptor, original_fs=ORIGINAL_FS, target_fs=TARGET_FS):
+    """Downsample a decoded run to target_fs with the pipeline's decimate"""
+    from create_flat_files_interactive import downsample_data
+
+    with attach(descriptor) as arrays:
+        sample = downsample_data(arrays['sample'], original_fs, target_fs)
+        time_ds = downsample_data(arrays['time'], original_fs, target_fs)
+    return create_segment({'sample': sample, 'time': time_ds})
+
+
+def segment_stage(descriptor, n_trials=TRIALS_PER_RUN):
+    """
+    Split a 250 Hz run into a trials x samples matrix.
+
+    Equal-length split of the run as in process_subject(); zeros become NaN.
+    """
+    with attach(descriptor) as arrays:
+        n_per_trial = len(arrays['sample']) // n_trials
+        n_used = n_per_trial * n_trials
+        pupil = arrays['sample'][:n_used].reshape(n_trials, n_per_trial).astype(np.float32)
+        time_rel = arrays['time'][:n_used].reshape(n_trials, n_per_trial)
+        time_rel = time_rel - time_rel[:, :1]
+    pupil[pupil == 0] = np.nan
+    return create_segment({'pupil': pupil, 'time': time_rel.astype(np.float32)})
+
+
+def feature_stage(descriptor, run_id):
+    """Per-trial summary features from a trial matrix (small result, returned by value)"""
+    with attach(descriptor) as arrays:
+        pupil = arrays['pupil']
+        valid = np.isfinite(pupil)
+        n_valid = valid.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(pupil, axis=1) / n_valid
+        peak = np.where(n_valid > 0, np.nanmax(np.where(valid, pupil, -np.inf), axis=1), np.nan)
+        return pd.DataFrame({'run_id': run_id, 'trial': np.arange(1, len(pupil) + 1),
+                             'mean_pupil': mean, 'peak_pupil': peak,
+                             'valid_fraction': n_valid / pupil.shape[1]})
+
+
+STAGE_ORDER = ('decode', 'resample', 'segment', 'features')
+
+
+def run_pipeline(mat_files, workers=None, max_inflight=None, n_trials=TRIALS_PER_RUN):
+    """
+    Run decode -> resample -> segment -> features for every file.
+
+    Each run moves to its next stage as soon as the previous one finishes;
+    the block a stage consumed is released right after, so at most
+    max_inflight runs (default 2 x workers) hold shared memory at a time.
+
+    Returns:
+        (features DataFrame, {file: error}, registry stats dict)
+    """
+    workers = workers or os.cpu_count() or 1
+    max_inflight = max_inflight or 2 * workers
+    files = iter(mat_files)
+    features, errors = [], {}
+
+    with SharedArrayRegistry() as registry, ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def start_next():
+            path = next(files, None)
+            if path is not None:
+                pending[pool.submit(decode_stage, path)] = (path, 'decode', None)
+
+        for _ in range(max_inflight):
+            start_next()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, stage_name, consumed = pending.pop(future)
+                if consumed is not None:
+                    registry.release(consumed)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors[path] = f'{stage_name}: {type(e).__name__}: {e}'
+                    start_next()
+                    continue
+
+                if stage_name == 'features':
+                    features.append(result)
+                    start_next()
+                    continue
+                descriptor = registry.adopt(result)
+                next_stage = STAGE_ORDER[STAGE_ORDER.index(stage_name) + 1]
+                if next_stage == 'resample':
+                    next_future = pool.submit(resample_stage, descriptor)
+                elif next_stage == 'segment':
+                    next_future = pool.submit(segment_stage, descriptor, n_trials)
+                else:
+                    next_future = pool.submit(feature_stage, descriptor, os.path.basename(path))
+                pending[next_future] = (path, next_stage, descriptor)
+
+        stats = {'bytes_published': registry.bytes_published, 'bytes_peak': registry.bytes_peak,
+                 'blocks_left': len(registry)}
+
+    features = pd.concat(features, ignore_index=True) if features else pd.DataFrame()
+    return features, errors, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run decode/resample/segment/features over shared memory")
+    parser.add_argument('--cleaned-dir', required=True, help='Directory with *_eyetrack_cleaned.mat files')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: all CPUs)')
+    parser.add_argument('--max-inflight', type=int, help='Runs resident in shared memory at once')
+    parser.add_argument('--trials', type=int, default=TRIALS_PER_RUN, help='Trials per run')
+    parser.add_argument('--output', help='Write per-trial features to this CSV')
+    args = parser.parse_args()
+
+    mat_files = sorted(glob.glob(os.path.join(args.cleaned_dir, '*_eyetrack_cleaned.mat')))
+    if not mat_files:
+        print(f"❌ No cleaned .mat files in {args.cleaned_dir}")
+        return
+
+    t0 = time.perf_counter()
+    features, errors, stats = run_pipeline(mat_files, args.workers, args.max_inflight, args.trials)
+    elapsed = time.perf_counter() - t0
+
+    for path, error in errors.items():
+        print(f"  ✗ {os.path.basename(path)}: {error}")
+    print(f"✓ {len(mat_files) - len(errors)}/{len(mat_files)} runs in {elapsed:.1f} s "
+          f"({len(mat_files) / elapsed:.2f} runs/s)")
+    print(f"  Shared memory: {stats['bytes_published'] / 2**20:.1f} MB published, "
+          f"peak {stats['bytes_peak'] / 2**20:.1f} MB resident, {stats['blocks_left']} blocks left")
+    if args.output and not features.empty:
+        features.to_csv(args.output, index=False)
+        print(f"✓ Features saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Lightweight per-stage profiler for the preprocessing scripts.
+
+Wrap each pipeline stage (load, resample, segment, write) in
+``stage(name)`` or decorate a function with ``@profiled(name)``. Every
+stage records wall time, CPU time, bytes read / written (reported by the
+caller through ``add_bytes``) and the process peak RSS when it finished.
+
+Profiling is off unless the BAP_PROFILE environment variable names an
+output directory (or ``enable(dir)`` is called, which also sets it for
+worker processes). When off, ``stage()`` returns a shared no-op object, so
+the instrumented code pays one global lookup per stage.
+
+Each process appends its events to ``<dir>/events_<pid>.jsonl``; ``report()``
+(or this script's CLI) merges all processes into a Chrome trace-event file
+(open in chrome://tracing or https://ui.perfetto.dev) and a per-stage
+summary table. Stage times are inclusive of nested stages. Use a fresh
+directory per run; events from earlier runs in the same directory are merged.
+
+Usage:
+    BAP_PROFILE=profile_out python create_flat_files_interactive.py
+    python stage_profiler.py profile_out
+"""
+
+import argparse
+import atexit
+import functools
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_ENV = 'BAP_PROFILE'
+FLUSH_EVERY = 1000  # buffered events per process before appending to disk
+
+_profile_dir = os.environ.get(PROFILE_ENV) or None
+_events = []
+_lock = threading.Lock()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (NaN if unavailable)"""
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def file_size(path):
+    """Size of a file in bytes, 0 if it does not exist"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def enabled():
+    return _profile_dir is not None
+
+
+def enable(profile_dir):
+    """Turn profiling on for this process and any worker processes it starts"""
+    global _profile_dir
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = str(profile_dir)
+    os.environ[PROFILE_ENV] = _profile_dir
+
+
+class _NullStage:
+    """Shared stand-in returned by stage() while profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, read=0, written=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add_bytes(self, read=0, written=0):
+        self.bytes_read += int(read)
+        self.bytes_written += int(written)
+
+    def __enter__(self):
+        self._cpu = time.process_time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t1 = time.perf_counter()
+        event = {
+            'name': self.name,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'ts': self._t0,
+            'wall': t1 - self._t0,
+            'cpu': time.process_time() - self._cpu,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss_mb': peak_rss_mb(),
+            'error': exc_type.__name__ if exc_type else None,
+            'args': self.args,
+        }
+        with _lock:
+            _events.append(event)
+            if len(_events) >= FLUSH_EVERY:
+                _flush_locked()
+        return False
+
+
+def stage(name, **args):
+    """
+    Context manager timing one unit of work.
+
+    Args:
+        name: stage name (load, resample, segment, write, ...)
+        **args: JSON-serialisable details shown in the trace (file, run, ...)
+
+    Returns:
+        Object with ``add_bytes(read=, written=)`` to report I/O volume.
+    """
+    if _profile_dir is None:
+        return _NULL_STAGE
+    return _Stage(name, args)
+
+
+def profiled(name=None):
+    """Decorator form of stage(); the name defaults to the function name"""
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*a, **kw):
+            if _profile_dir is None:
+                return func(*a, **kw)
+            with _Stage(stage_name, {}):
+                return func(*a, **kw)
+        return wrapper
+    return decorator
+
+
+def _flush_locked():
+    if not _events or _profile_dir is None:
+        return
+    os.makedirs(_profile_dir, exist_ok=True)
+    path = os.path.join(_profile_dir, f'events_{os.getpid()}.jsonl')
+    with open(path, 'a') as f:
+        for event in _events:
+            f.write(json.dumps(event, default=str) + '\n')
+    _events.clear()
+
+
+def flush():
+    """Append buffered events of this process to its events file"""
+    with _lock:
+        _flush_locked()
+
+
+atexit.register(flush)
+
+
+def load_events(profile_dir):
+    """All events written by all processes under profile_dir"""
+    rows = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, 'events_*.jsonl'))):
+        with open(path) as f:
+            rows.extend(json.loads(line) for line in f if line.strip())
+    return rows
+
+
+def chrome_trace(events):
+    """Chrome trace-event JSON ("X" complete events, microseconds)"""
+    if not events:
+        return {'traceEvents': []}
+    t_min = min(e['ts'] for e in events)
+    trace = []
+    for e in events:
+        args = dict(e.get('args') or {})
+        args.update(cpu_s=round(e['cpu'], 6), bytes_read=e['bytes_read'],
+                    bytes_written=e['bytes_written'], peak_rss_mb=round(e['peak_rss_mb'], 1))
+        if e.get('error'):
+            args['error'] = e['error']
+        trace.append({'name': e['name'], 'cat': 'stage', 'ph': 'X', 'pid': e['pid'], 'tid': e['tid'],
+                      'ts': (e['ts'] - t_min) * 1e6, 'dur': e['wall'] * 1e6, 'args': args})
+    # perf_counter is per-process; on macOS / Linux it shares the system
+    # monotonic clock, so events from different workers line up
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def summary_table(events):
+    """Per-stage totals: calls, wall / CPU time, bytes and max peak RSS"""
+    if not events:
+        return pd.DataFrame()
+    df = pd.DataFrame(events)
+    summary = df.groupby('name').agg(
+        calls=('wall', 'size'), processes=('pid', 'nunique'),
+        wall_total_s=('wall', 'sum'), wall_mean_ms=('wall', 'mean'), wall_max_ms=('wall', 'max'),
+        cpu_total_s=('cpu', 'sum'), bytes_read=('bytes_read', 'sum'),
+        bytes_written=('bytes_written', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+        errors=('error', 'count'),
+    )
+    summary[['wall_mean_ms', 'wall_max_ms']] *= 1000
+    summary['cpu_util'] = summary['cpu_total_s'] / summary['wall_total_s']
+    summary['mb_per_s'] = (summary['bytes_read'] + summary['bytes_written']) / 2**20 / summary['wall_total_s']
+    return summary.sort_values('wall_total_s', ascending=False).reset_index()
+
+
+def print_summary(summary):
+    print(f"{'stage':<16} {'calls':>6} {'wall s':>9} {'mean ms':>9} {'cpu s':>9} "
+          f"{'MB read':>9} {'MB written':>11} {'peak RSS MB':>12}")
+    for row in summary.itertuples():
+        print(f"{row.name:<16} {row.calls:>6} {row.wall_total_s:>9.2f} {row.wall_mean_ms:>9.1f} "
+              f"{row.cpu_total_s:>9.2f} {row.bytes_read / 2**20:>9.1f} {row.bytes_written / 2**20:>11.1f} "
+              f"{row.peak_rss_mb:>12.1f}")
+
+
+def export(profile_dir, trace_path=None, summary_path=None):
+    """Merge all process event files into trace.json and stage_summary.csv"""
+    events = load_events(profile_dir)
+    trace_path = trace_path or os.path.join(profile_dir, 'trace.json')
+    summary_path = summary_path or os.path.join(profile_dir, 'stage_summary.csv')
+    with open(trace_path, 'w') as f:
+        json.dump(chrome_trace(events), f)
+    summary = summary_table(events)
+    summary.to_csv(summary_path, index=False)
+    return summary, trace_path, summary_path
+
+
+def report():
+    """Flush and export at the end of a script run; no-op when profiling is off"""
+    if _profile_dir is None:
+        return None
+    flush()
+    summary, trace_path, summary_path = export(_profile_dir)
+    if summary.empty:
+        return summary
+    print("\nStage profile:")
+    print_summary(summary)
+    print(f"✓ Trace saved to: {trace_path}")
+    print(f"✓ Summary saved to: {summary_path}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge stage profiler events into a Chrome trace and summary")
+    parser.add_argument('profile_dir', help='Directory the profiled run wrote events_<pid>.jsonl files to')
+    parser.add_argument('--trace', help='Trace output (default: <profile_dir>/trace.json)')
+    parser.add_argument('--summary', help='Summary CSV output (default: <profile_dir>/stage_summary.csv)')
+    args = parser.parse_args()
+
+    summary, trace_path, summary_path = export(args.profile_dir, args.trace, args.summary)
+    if summary.empty:
+        print(f"No events found in {args.profile_dir}")
+        return
+    print_summary(summary)
+    print(f"\n✓ Trace saved to: {trace_path}")
+    print(f"✓ Summary saved to: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
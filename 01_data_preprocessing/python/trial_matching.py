@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Match pupil trials to behavioral trials for the whole cohort at once.
+
+Python replacement for fix_matching_properly.R, thorough_matching_diagnosis.R
+and diagnose_matching_issue.R. Both tables are normalized to the same keys
+(sub, task, ses, run, trial), the keys are packed into a single int64 and the
+tables are joined through a hash index instead of filtering per subject/run.
+
+Trials whose numbers disagree (cumulative trial_index, renumbered runs, ...)
+can be recovered with a second pass that matches trial onset timestamps within
+each run using merge_asof and a tolerance. Everything that still does not
+match ends up in a mismatch report indexed by (sub, task, ses, run).
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Task labels used across pipeline versions -> task code
+TASK_CODES = {
+    'adt': 1, 'aud': 1, 'aoddball': 1, 'auditory': 1,
+    'vdt': 2, 'vis': 2, 'voddball': 2, 'visual': 2,
+}
+TASK_NAMES = {1: 'ADT', 2: 'VDT'}
+TRIALS_PER_RUN = 30
+
+# Column name alternatives (first match wins), as in the R col_map helpers
+KEY_COLUMNS = {
+    'sub': ['sub', 'subject_id', 'subject'],
+    'task': ['task', 'task_modality'],
+    'ses': ['ses', 'session_num', 'session_used', 'session'],
+    'run': ['run', 'run_num', 'run_used'],
+    'trial': ['trial', 'trial_num', 'trial_in_run', 'trial_index'],
+}
+
+# Bit layout of a packed key: | sub (31) | task (4) | ses (8) | run (8) | trial (12) |
+TRIAL_BITS = 12
+RUN_BITS = 8
+SES_BITS = 8
+TASK_BITS = 4
+RUN_SHIFT = TRIAL_BITS
+SES_SHIFT = RUN_SHIFT + RUN_BITS
+TASK_SHIFT = SES_SHIFT + SES_BITS
+SUB_SHIFT = TASK_SHIFT + TASK_BITS
+
+
+def resolve_columns(df, overrides=None):
+    """Map each key field to the column of df that holds it"""
+    overrides = overrides or {}
+    columns = {}
+    for field, candidates in KEY_COLUMNS.items():
+        if field in overrides:
+            columns[field] = overrides[field]
+            continue
+        found = next((c for c in candidates if c in df.columns), None)
+        if found is None:
+            raise KeyError(f"No column for '{field}' (tried {', '.join(candidates)})")
+        columns[field] = found
+    return columns
+
+
+def normalize_keys(df, columns=None, trials_per_run=None):
+    """
+    Integer key fields for a trial table.
+
+    Subjects like 'BAP178', '178' and 178 all become 178; task labels
+    (ADT/aud/Aoddball/auditory, ...) become 1 or 2. With trials_per_run set,
+    cumulative trial numbers are folded back into the run
+    (((trial - 1) % trials_per_run) + 1), as in make_quick_share_v7.R.
+
+    Returns:
+        DataFrame with int64 columns sub, task, ses, run, trial (-1 = missing)
+    """
+    columns = columns or resolve_columns(df)
+
+    # String parsing runs on the few unique labels, not on every row
+    codes, uniques = pd.factorize(df[columns['sub']])
+    sub_ids = pd.to_numeric(pd.Series(uniques).astype(str).str.extract(r'(\d+)', expand=False),
+                            errors='coerce').to_numpy()
+    sub = np.where(codes >= 0, sub_ids[codes] if len(uniques) else np.nan, np.nan)
+    codes, uniques = pd.factorize(df[columns['task']])
+    task_ids = pd.Series(uniques).astype(str).str.strip().str.lower().map(TASK_CODES).to_numpy(dtype=float)
+    task = np.where(codes >= 0, task_ids[codes] if len(uniques) else np.nan, np.nan)
+
+    keys = pd.DataFrame({
+        'sub': sub,
+        'task': task,
+        'ses': pd.to_numeric(df[columns['ses']], errors='coerce'),
+        'run': pd.to_numeric(df[columns['run']], errors='coerce'),
+        'trial': pd.to_numeric(df[columns['trial']], errors='coerce'),
+    }, index=df.index)
+    keys = keys.fillna(-1).astype(np.int64)
+
+    if trials_per_run:
+        valid = keys['trial'] > 0
+        keys.loc[valid, 'trial'] = (keys.loc[valid, 'trial'] - 1) % trials_per_run + 1
+    return keys
+
+
+def pack_keys(sub, task, ses, run, trial=0):
+    """
+    Pack key fields into one int64 per row.
+
+    Any field that is negative (missing) or too wide for its bits gives -1,
+    so malformed rows can never collide with a real key.
+    """
+    sub, task, ses, run, trial = (np.asarray(x, dtype=np.int64) for x in (sub, task, ses, run, trial))
+    packed = ((sub << SUB_SHIFT) | (task << TASK_SHIFT) | (ses << SES_SHIFT)
+              | (run << RUN_SHIFT) | trial)
+    ok = ((sub >= 0) & (sub < (1 << 31))
+          & (task >= 0) & (task < (1 << TASK_BITS))
+          & (ses >= 0) & (ses < (1 << SES_BITS))
+          & (run >= 0) & (run < (1 << RUN_BITS))
+          & (trial >= 0) & (trial < (1 << TRIAL_BITS)))
+    return np.where(ok, packed, -1)
+
+
+def unpack_keys(packed):
+    """Inverse of pack_keys -> DataFrame with sub, task, ses, run, trial"""
+    packed = np.asarray(packed, dtype=np.int64)
+    return pd.DataFrame({
+        'sub': packed >> SUB_SHIFT,
+        'task': (packed >> TASK_SHIFT) & ((1 << TASK_BITS) - 1),
+        'ses': (packed >> SES_SHIFT) & ((1 << SES_BITS) - 1),
+        'run': (packed >> RUN_SHIFT) & ((1 << RUN_BITS) - 1),
+        'trial': packed & ((1 << TRIAL_BITS) - 1),
+    })
+
+
+def trial_keys(df, columns=None, trials_per_run=None):
+    """Packed (sub, task, ses, run, trial) key per row"""
+    k = normalize_keys(df, columns, trials_per_run)
+    return pack_keys(k['sub'], k['task'], k['ses'], k['run'], k['trial'])
+
+
+def run_keys(df, columns=None):
+    """Packed (sub, task, ses, run) key per row (trial bits zero)"""
+    k = normalize_keys(df, columns)
+    return pack_keys(k['sub'], k['task'], k['ses'], k['run'], 0)
+
+
+def index_runs(df, columns=None):
+    """
+    {packed run key: row positions} for a trial table.
+
+    Lets callers pull one run's trials with an O(1) lookup instead of
+    re-filtering the whole table with boolean masks for every run.
+    """
+    keys = run_keys(df, columns)
+    return pd.Series(np.arange(len(df))).groupby(keys).indices
+
+
+def make_run_key(subject_id, task, session, run):
+    """Packed run key for scalar identifiers (e.g. from a parsed filename)"""
+    sub = int(''.join(ch for ch in str(subject_id) if ch.isdigit()))
+    return int(pack_keys(sub, TASK_CODES[str(task).lower()], int(session), int(run), 0))
+
+
+def match_trials(pupil, beh, pupil_columns=None, beh_columns=None, trials_per_run=None,
+                 pupil_time=None, beh_time=None, tolerance=0.5):
+    """
+    Match pupil trials to behavioral trials.
+
+    Pass 1 joins on packed (sub, task, ses, run, trial) keys through a hash
+    index. If pupil_time and beh_time name trial onset columns (same clock,
+    seconds), pupil trials left over are matched within their run to the
+    nearest unused behavioral trial onset within `tolerance` (pass 2).
+
+    Args:
+        pupil: One row per pupil trial
+        beh: One row per behavioral trial
+        pupil_columns / beh_columns: Optional {field: column} overrides
+        trials_per_run: Fold cumulative pupil trial numbers into the run
+        pupil_time / beh_time: Trial onset columns for the timestamp fallback
+        tolerance: Maximum onset difference for the fallback (s)
+
+    Returns:
+        (matches, unmatched_pupil, unmatched_beh, report) where matches has
+        pupil_row, beh_row (positions), key and method ('key' | 'time');
+        report is indexed by (sub, task, ses, run).
+    """
+    p_fields = normalize_keys(pupil, resolve_columns(pupil, pupil_columns), trials_per_run)
+    b_fields = normalize_keys(beh, resolve_columns(beh, beh_columns))
+    p_keys = pack_keys(*(p_fields[f] for f in KEY_COLUMNS))
+    b_keys = pack_keys(*(b_fields[f] for f in KEY_COLUMNS))
+    p_runs = pack_keys(p_fields['sub'], p_fields['task'], p_fields['ses'], p_fields['run'])
+    b_runs = pack_keys(b_fields['sub'], b_fields['task'], b_fields['ses'], b_fields['run'])
+
+    # Hash join; duplicated behavioral keys resolve to their first row
+    b_valid = np.flatnonzero(b_keys >= 0)
+    b_index = pd.Index(b_keys[b_valid])
+    duplicated_beh = b_index.duplicated()
+    b_unique = pd.Index(b_keys[b_valid][~duplicated_beh])
+    b_rows = b_valid[~duplicated_beh]
+
+    hit = b_unique.get_indexer(p_keys)
+    hit[p_keys < 0] = -1
+    p_rows = np.flatnonzero(hit >= 0)
+    matches = pd.DataFrame({
+        'pupil_row': p_rows,
+        'beh_row': b_rows[hit[p_rows]],
+        'key': p_keys[p_rows],
+        'method': 'key',
+    })
+    # A behavioral trial is consumed once; later pupil rows with the same key are unmatched
+    matches = matches[~matches['beh_row'].duplicated()]
+
+    if pupil_time is not None and beh_time is not None:
+        time_matches = _match_on_time(pupil, beh, p_runs, b_runs, matches,
+                                      pupil_time, beh_time, tolerance, b_keys)
+        matches = pd.concat([matches, time_matches], ignore_index=True)
+
+    matches = matches.sort_values('pupil_row', ignore_index=True)
+    unmatched_pupil = _unused(len(pupil), matches['pupil_row'])
+    unmatched_beh = _unused(len(beh), matches['beh_row'])
+
+    report = mismatch_report(
+        p_runs, b_runs, matches,
+        unmatched_pupil, unmatched_beh, duplicated_beh_keys=b_keys[b_valid][duplicated_beh],
+    )
+    return matches, unmatched_pupil, unmatched_beh, report
+
+
+def _unused(n_rows, used_rows):
+    """Row positions in range(n_rows) not in used_rows"""
+    used = np.zeros(n_rows, dtype=bool)
+    used[np.asarray(used_rows, dtype=np.int64)] = True
+    return np.flatnonzero(~used)
+
+
+def _match_on_time(pupil, beh, p_runs, b_runs, matches, pupil_time, beh_time, tolerance, b_keys):
+    """Pass 2: nearest onset within each run for trials the key join left over"""
+    p_left = _unused(len(pupil), matches['pupil_row'])
+    b_left = _unused(len(beh), matches['beh_row'])
+    empty = pd.DataFrame({'pupil_row': np.array([], dtype=np.int64), 'beh_row': np.array([], dtype=np.int64),
+                          'key': np.array([], dtype=np.int64), 'method': np.array([], dtype=object)})
+    if len(p_left) == 0 or len(b_left) == 0:
+        return empty
+
+    left = pd.DataFrame({
+        'pupil_row': p_left,
+        'run_key': p_runs[p_left],
+        'onset': pd.to_numeric(pupil[pupil_time], errors='coerce').to_numpy()[p_left],
+    })
+    right = pd.DataFrame({
+        'beh_row': b_left,
+        'run_key': b_runs[b_left],
+        'onset': pd.to_numeric(beh[beh_time], errors='coerce').to_numpy()[b_left],
+    })
+    left = left[(left['run_key'] >= 0) & left['onset'].notna()].sort_values('onset')
+    right = right[(right['run_key'] >= 0) & right['onset'].notna()].sort_values('onset')
+    if left.empty or right.empty:
+        return empty
+
+    joined = pd.merge_asof(left, right, on='onset', by='run_key', tolerance=tolerance,
+                           direction='nearest')
+    joined = joined.dropna(subset=['beh_row'])
+    joined['beh_row'] = joined['beh_row'].astype(np.int64)
+    # Two pupil trials can pick the same behavioral trial; keep the closer one
+    joined['gap'] = np.abs(joined['onset'] - right.set_index('beh_row').loc[joined['beh_row'], 'onset'].to_numpy())
+    joined = joined.sort_values('gap').drop_duplicates('beh_row')
+
+    return pd.DataFrame({
+        'pupil_row': joined['pupil_row'].to_numpy(),
+        'beh_row': joined['beh_row'].to_numpy(),
+        'key': b_keys[joined['beh_row'].to_numpy()],
+        'method': 'time',
+    })
+
+
+def mismatch_report(pupil_run_keys, beh_run_keys, matches, unmatched_pupil, unmatched_beh,
+                    duplicated_beh_keys=()):
+    """
+    Per-run match counts, indexed by (sub, task, ses, run).
+
+    Columns: n_pupil, n_beh, matched_key, matched_time, unmatched_pupil,
+    unmatched_beh, duplicate_beh. Runs missing on one side show up with zero
+    trials on that side.
+    """
+    def _count(keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        return pd.Series(keys).value_counts()
+
+    methods = matches['method'].to_numpy()
+    match_runs = pupil_run_keys[matches['pupil_row'].to_numpy()] if len(matches) else np.array([], dtype=np.int64)
+    duplicated_runs = np.asarray(duplicated_beh_keys, dtype=np.int64) & ~np.int64((1 << TRIAL_BITS) - 1)
+
+    counts = pd.DataFrame({
+        'n_pupil': _count(pupil_run_keys),
+        'n_beh': _count(beh_run_keys),
+        'matched_key': _count(match_runs[methods == 'key']),
+        'matched_time': _count(match_runs[methods == 'time']),
+        'unmatched_pupil': _count(pupil_run_keys[unmatched_pupil]),
+        'unmatched_beh': _count(beh_run_keys[unmatched_beh]),
+        'duplicate_beh': _count(duplicated_runs),
+    }).fillna(0).astype(np.int64)
+    counts = counts[counts.index >= 0]
+
+    fields = unpack_keys(counts.index.to_numpy())
+    fields['task'] = fields['task'].map(TASK_NAMES)
+    fields['sub'] = 'BAP' + fields['sub'].astype(str).str.zfill(3)
+    counts.index = pd.MultiIndex.from_frame(fields[['sub', 'task', 'ses', 'run']])
+    return counts.sort_index()
+
+
+def print_report(report, matches, elapsed=None):
+    """Print a matching summary and the runs with mismatches"""
+    print("=" * 60)
+    print("TRIAL MATCHING")
+    print("=" * 60)
+    n_key = int((matches['method'] == 'key').sum())
+    n_time = int((matches['method'] == 'time').sum())
+    print(f"Pupil trials:       {report['n_pupil'].sum()}")
+    print(f"Behavioral trials:  {report['n_beh'].sum()}")
+    print(f"Matched on keys:    {n_key}")
+    print(f"Matched on onsets:  {n_time}")
+    print(f"Unmatched pupil:    {report['unmatched_pupil'].sum()}")
+    print(f"Unmatched behavior: {report['unmatched_beh'].sum()}")
+    if elapsed is not None:
+        print(f"Elapsed:            {elapsed:.2f} s")
+
+    problems = report[(report['unmatched_pupil'] > 0) | (report['unmatched_beh'] > 0)
+                      | (report['duplicate_beh'] > 0)]
+    if problems.empty:
+        print("\n✓ All runs matched completely")
+    else:
+        print(f"\n⚠ {len(problems)} run(s) with mismatches:")
+        print(problems.to_string())
+
+
+def read_table(path):
+    """Read a CSV or parquet trial table"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, low_memory=False)
+
+
+def parse_overrides(specs):
+    """['trial=trial_index', ...] -> {'trial': 'trial_index'}"""
+    overrides = {}
+    for spec in specs or []:
+        field, _, column = spec.partition('=')
+        if field not in KEY_COLUMNS or not column:
+            print(f"Error: invalid column override '{spec}' (expected FIELD=COLUMN)")
+            sys.exit(1)
+        overrides[field] = column
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match pupil trials to behavioral trials")
+    parser.add_argument('pupil', help='Pupil trial table (CSV or parquet, one row per trial)')
+    parser.add_argument('behavioral', help='Behavioral trial table (CSV or parquet)')
+    parser.add_argument('--pupil-col', action='append', metavar='FIELD=COLUMN', help='Pupil key column override')
+    parser.add_argument('--beh-col', action='append', metavar='FIELD=COLUMN', help='Behavioral key column override')
+    parser.add_argument('--trials-per-run', type=int, help=f'Fold cumulative trial numbers (e.g. {TRIALS_PER_RUN})')
+    parser.add_argument('--pupil-time', help='Pupil trial onset column for the timestamp fallback')
+    parser.add_argument('--beh-time', help='Behavioral trial onset column for the timestamp fallback')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Onset tolerance in seconds (default: 0.5)')
+    parser.add_argument('--out', help='Write the joined table to this CSV')
+    parser.add_argument('--report', help='Write the per-run mismatch report to this CSV')
+    args = parser.parse_args()
+
+    pupil = read_table(args.pupil)
+    beh = read_table(args.behavioral)
+
+    start = time.perf_counter()
+    matches, _, _, report = match_trials(
+        pupil, beh, parse_overrides(args.pupil_col), parse_overrides(args.beh_col),
+        trials_per_run=args.trials_per_run, pupil_time=args.pupil_time, beh_time=args.beh_time,
+        tolerance=args.tolerance,
+    )
+    elapsed = time.perf_counter() - start
+    print_report(report, matches, elapsed)
+
+    if args.out:
+        joined = pd.concat([
+            pupil.iloc[matches['pupil_row']].reset_index(drop=True),
+            beh.iloc[matches['beh_row']].reset_index(drop=True).add_prefix('beh_'),
+        ], axis=1)
+        joined['match_method'] = matches['method'].to_numpy()
+        joined.to_csv(args.out, index=False)
+        print(f"\nSaved {len(joined)} matched trials to {args.out}")
+    if args.report:
+        report.to_csv(args.report)
+        print(f"Saved mismatch report to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
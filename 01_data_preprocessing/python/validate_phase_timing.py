@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Phase-duration timing validation over all processed flat files.
+
+Python counterpart of timing_sanity_check.m. Only the time, phase and trial
+key columns are read from each *_flat.csv, in a process pool; each worker
+reduces its file to one row per (run, trial, phase) with grouped min / max /
+count, and every check (phase duration, phase onset relative to squeeze
+onset, total trial duration) is then one vectorized comparison of the
+combined table against the tolerance table.
+
+Expected values follow the EXPECTED struct of timing_sanity_check.m and the
+phase boundaries of BAP_Pupillometry_Pipeline.m (time is relative to
+squeeze onset). Durations are max(time) - min(time) per phase, as in MATLAB.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PROCESSED_DIR = "/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_processed"
+FLAT_PATTERN = "*_flat.csv"
+
+EXPECTED_TOTAL_TRIAL = 13.7  # 3 s baseline + 10.7 s trial
+TOTAL_TRIAL_TOLERANCE = 2.0
+
+# phase: (expected duration s, expected start s rel. squeeze; NaN = not validated)
+EXPECTED = {
+    'ITI_Baseline': (np.nan, -3.0),
+    'Squeeze': (3.0, 0.0),
+    'Post_Squeeze_Blank': (0.25, 3.0),
+    'Pre_Stimulus_Fixation': (0.5, 3.25),
+    'Stimulus': (0.7, 3.75),
+    'Post_Stimulus_Fixation': (0.25, 4.45),
+    'Response_Different': (3.0, 4.7),
+    'Confidence': (3.0, 7.7),
+    'Post_Trial': (np.nan, np.nan),
+}
+# Relative duration deviations reported as CAUTION / WARNING (timing_sanity_check.m)
+CAUTION_PCT = 20
+WARNING_PCT = 50
+START_TOLERANCE = 0.5  # s
+
+# Column name alternatives (first match wins)
+COLUMNS = {
+    'time': ['time', 'time_rel', 'trial_pupilTime', 'time_sec'],
+    'phase': ['trial_label', 'phase', 'phase_label'],
+    'ses': ['ses', 'session', 'session_used', 'session_index'],
+    'run': ['run', 'run_used', 'run_index'],
+    'trial': ['trial_index', 'trial_in_run_raw', 'trial_in_run'],
+}
+
+
+def tolerance_table(path=None):
+    """
+    Per-phase expectations and tolerances.
+
+    Columns: phase, expected_duration, expected_start, caution_pct,
+    warning_pct, start_tolerance. A CSV with any subset of these columns
+    (keyed by phase) overrides the defaults.
+    """
+    table = pd.DataFrame([(phase, dur, start) for phase, (dur, start) in EXPECTED.items()],
+                         columns=['phase', 'expected_duration', 'expected_start'])
+    table['caution_pct'] = CAUTION_PCT
+    table['warning_pct'] = WARNING_PCT
+    table['start_tolerance'] = START_TOLERANCE
+    if path:
+        override = pd.read_csv(path).set_index('phase')
+        table = table.set_index('phase')
+        table = override.combine_first(table).reset_index()
+    return table
+
+
+def reduce_flat_file(path):
+    """
+    One row per (run, trial, phase) of a flat file with start, end and sample count.
+
+    Returns (path, DataFrame or None, error or None, sampling interval).
+    """
+    try:
+        header = pd.read_csv(path, nrows=0).columns
+        cols = {key: next((c for c in alts if c in header), None) for key, alts in COLUMNS.items()}
+        if not cols['time'] or not cols['phase'] or not cols['trial']:
+            return path, None, 'missing time / phase / trial column', np.nan
+        usecols = [c for c in cols.values() if c]
+        df = pd.read_csv(path, usecols=usecols, dtype={cols['phase']: 'category'}, low_memory=False)
+        df = df.rename(columns={v: k for k, v in cols.items() if v})
+
+        keys = [k for k in ('ses', 'run', 'trial') if cols[k]]
+        grouped = df.groupby(keys + ['phase'], observed=True, sort=False)['time']
+        out = grouped.agg(start='min', end='max', n_samples='size').reset_index()
+        out['phase'] = out['phase'].astype(str)
+        for k in ('ses', 'run'):
+            if k not in out.columns:
+                out[k] = np.nan
+        out['file'] = os.path.basename(path)
+
+        dt = np.diff(df['time'].to_numpy()[:1000])
+        dt = np.median(dt[dt > 0]) if (dt > 0).any() else np.nan
+        return path, out, None, dt
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}', np.nan
+
+
+def reduce_all(flat_files, workers=None):
+    """Reduce all files in parallel; returns (phases, per-file info, errors)"""
+    frames, info, errors = [], [], {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, out, error, dt in pool.map(reduce_flat_file, flat_files, chunksize=4):
+            if error:
+                errors[path] = error
+                continue
+            frames.append(out)
+            info.append({'file': os.path.basename(path), 'sampling_interval': dt,
+                         'sampling_rate_hz': 1 / dt if dt else np.nan})
+    phases = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return phases, pd.DataFrame(info), errors
+
+
+def validate(phases, tolerances):
+    """
+    Flag every (trial, phase) row against the tolerance table in one pass.
+
+    Adds duration, start_rel_squeeze (start minus the trial's squeeze start,
+    falling back to the raw start), duration_diff_pct, duration_status
+    ('ok' | 'caution' | 'warning' | 'not_validated') and start_ok.
+
+    Returns (phases, trials) where trials has total duration per trial.
+    """
+    trial_keys = ['file', 'ses', 'run', 'trial']
+    phases = phases.merge(tolerances, on='phase', how='left')
+    phases['duration'] = phases['end'] - phases['start']
+
+    # Squeeze start per trial as the time reference
+    squeeze = phases.loc[phases['phase'] == 'Squeeze', trial_keys + ['start']]
+    squeeze = squeeze.rename(columns={'start': 'squeeze_start'})
+    phases = phases.merge(squeeze, on=trial_keys, how='left')
+    phases['start_rel_squeeze'] = phases['start'] - phases['squeeze_start'].fillna(0.0)
+
+    expected = phases['expected_duration']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff_pct = 100 * (phases['duration'] - expected) / expected
+    phases['duration_diff_pct'] = diff_pct
+    abs_pct = diff_pct.abs()
+    phases['duration_status'] = np.select(
+        [expected.isna() | (expected <= 0), abs_pct > phases['warning_pct'], abs_pct > phases['caution_pct']],
+        ['not_validated', 'warning', 'caution'], default='ok')
+    start_dev = (phases['start_rel_squeeze'] - phases['expected_start']).abs()
+    phases['start_ok'] = start_dev.le(phases['start_tolerance']) | phases['expected_start'].isna()
+
+    trials = phases.groupby(trial_keys, dropna=False).agg(start=('start', 'min'), end=('end', 'max'),
+                                                          n_phases=('phase', 'size')).reset_index()
+    trials['duration'] = trials['end'] - trials['start']
+    trials['duration_ok'] = (trials['duration'] - EXPECTED_TOTAL_TRIAL).abs() <= TOTAL_TRIAL_TOLERANCE
+    return phases, trials
+
+
+def phase_summary(phases):
+    """Per-phase observed vs expected durations with the MATLAB status wording"""
+    summary = phases.groupby('phase').agg(
+        n=('duration', 'size'), expected=('expected_duration', 'first'),
+        mean_duration=('duration', 'mean'), sd_duration=('duration', 'std'),
+        mean_start=('start_rel_squeeze', 'mean'), expected_start=('expected_start', 'first'),
+        n_caution=('duration_status', lambda s: int((s == 'caution').sum())),
+        n_warning=('duration_status', lambda s: int((s == 'warning').sum())),
+        n_start_off=('start_ok', lambda s: int((~s).sum())),
+        caution_pct=('caution_pct', 'first'), warning_pct=('warning_pct', 'first'),
+    ).reset_index()
+    order = {phase: i for i, phase in enumerate(EXPECTED)}
+    summary = summary.sort_values('phase', key=lambda s: s.map(order).fillna(len(order)), ignore_index=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['diff_pct'] = 100 * (summary['mean_duration'] - summary['expected']) / summary['expected']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate phase timing of processed flat files")
+    parser.add_argument('--processed-dir', default=PROCESSED_DIR, help='Directory with *_flat.csv files')
+    parser.add_argument('--pattern', default=FLAT_PATTERN, help=f'File pattern (default: {FLAT_PATTERN})')
+    parser.add_argument('--tolerances', help='CSV overriding the per-phase tolerance table')
+    parser.add_argument('--workers', type=int, help='Worker processes')
+    parser.add_argument('--output-dir', help='Where to write the reports (default: <processed-dir>/qc_timing)')
+    args = parser.parse_args()
+
+    print("=== BAP PUPILLOMETRY TIMING VALIDATION ===\n")
+    flat_files = sorted(str(p) for p in Path(args.processed_dir).glob(args.pattern))
+    if not flat_files:
+        print(f"❌ No files matching {args.pattern} in {args.processed_dir}")
+        return
+
+    t0 = time.perf_counter()
+    phases, info, errors = reduce_all(flat_files, args.workers)
+    for path, error in errors.items():
+        print(f"  ✗ {os.path.basename(path)}: {error}")
+    if phases.empty:
+        print("No timing data to analyze")
+        return
+    phases, trials = validate(phases, tolerance_table(args.tolerances))
+    elapsed = time.perf_counter() - t0
+    print(f"Validated {len(trials)} trials / {len(phases)} phases from {len(info)} files in {elapsed:.1f} s\n")
+
+    print("TOTAL TRIAL DURATION:")
+    print(f"  Expected: {EXPECTED_TOTAL_TRIAL:.2f} seconds")
+    print(f"  Observed: {trials['duration'].mean():.2f} ± {trials['duration'].std():.2f} seconds")
+    n_bad_trials = int((~trials['duration_ok']).sum())
+    print(f"  {'⚠' if n_bad_trials else '✓'} {n_bad_trials} trials differ by more than {TOTAL_TRIAL_TOLERANCE:.1f} s\n")
+
+    print("PHASE DURATION ANALYSIS:")
+    summary = phase_summary(phases)
+    for row in summary.itertuples():
+        line = f"  {row.phase}: observed {row.mean_duration:.2f} ± {row.sd_duration:.2f} s"
+        if np.isfinite(row.expected) and row.expected > 0:
+            line += f", expected {row.expected:.2f} s ({row.diff_pct:+.1f}%)"
+            if abs(row.diff_pct) > row.warning_pct:
+                line += " ⚠ WARNING"
+            elif abs(row.diff_pct) > row.caution_pct:
+                line += " ⚠ CAUTION"
+            else:
+                line += " ✓"
+        if row.n_caution or row.n_warning or row.n_start_off:
+            line += f"  [{row.n_caution} caution, {row.n_warning} warning, {row.n_start_off} onset off]"
+        print(line)
+
+    off_rate = info['sampling_rate_hz'].sub(250).abs().gt(10)
+    if off_rate.any():
+        print(f"\n⚠ {int(off_rate.sum())} files with sampling rate away from 250 Hz")
+    else:
+        print(f"\n✓ Sampling rate ~250 Hz in all {len(info)} files")
+
+    output_dir = Path(args.output_dir or Path(args.processed_dir) / 'qc_timing')
+    output_dir.mkdir(parents=True, exist_ok=True)
+    flagged = phases[(phases['duration_status'].isin(['caution', 'warning'])) | ~phases['start_ok']]
+    phases.to_csv(output_dir / 'timing_phase_durations.csv.gz', index=False)
+    summary.to_csv(output_dir / 'timing_phase_summary.csv', index=False)
+    trials.to_csv(output_dir / 'timing_trial_durations.csv.gz', index=False)
+    flagged.to_csv(output_dir / 'timing_flagged_phases.csv', index=False)
+    info.to_csv(output_dir / 'timing_file_sampling.csv', index=False)
+    print(f"\n{len(flagged)} flagged phase rows")
+    print(f"✓ Reports saved to: {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
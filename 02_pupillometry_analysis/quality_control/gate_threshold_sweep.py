@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+QC gate threshold sweep over per-trial valid fractions, sorted once.
+
+build_pupil_trial_coverage_prefilter.R and audit_analysis_ready.R rebuild the
+gates and regroup the trial coverage table once per threshold. A gate passes
+when every window it needs has a valid fraction >= threshold, i.e. when the
+trial's gate score (the minimum of those fractions; missing -> never passes)
+is >= threshold. Scores are sorted once per gate x cell, where a cell is
+subject x task x effort x difficulty; the number of retained trials for any
+threshold is then cell size minus one binary search, so retention, subject
+retention and condition balance for hundreds of thresholds come out of a
+single searchsorted call.
+
+Gates (as in 01_trial_coverage_prefilter.csv.gz):
+    gate_stimlocked  ITI and pre-stimulus fixation windows
+    gate_total_auc   total-AUC window
+    gate_cog_auc     500 ms baseline and cognitive-AUC window
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+QC_DIR = REPO_ROOT / "02_pupillometry_analysis" / "quality_control" / "exports"
+TRIAL_COVERAGE_FILE = QC_DIR / "01_trial_coverage_prefilter.csv.gz"
+THRESHOLD_SWEEP_FILE = "03_threshold_sweep_long.csv.gz"
+SUBJECT_RETENTION_FILE = "03_threshold_sweep_subject_retention.csv.gz"
+CONDITION_BALANCE_FILE = "03_threshold_sweep_condition_balance.csv.gz"
+
+# Threshold grid for retention curves (audit_analysis_ready.R)
+THRESHOLD_GRID = (0.50, 0.60, 0.70, 0.80, 0.85, 0.90, 0.95)
+
+# Gate -> validity windows; each window lists its column spellings (first match wins)
+GATES = {
+    'gate_stimlocked': (['valid_prop_iti_full', 'valid_iti'],
+                        ['valid_prop_prestim', 'valid_prestim_fix_interior', 'valid_prestim']),
+    'gate_total_auc': (['valid_prop_total_auc', 'valid_total_auc_window'],),
+    'gate_cog_auc': (['valid_prop_baseline_500ms', 'valid_baseline500'],
+                     ['valid_prop_cognitive_auc', 'valid_cognitive_window']),
+}
+# Deprecated nested-gate names still present in the legacy sweep file
+LEGACY_ALIASES = {'gate_A': 'gate_stimlocked', 'gate_B': 'gate_total_auc', 'gate_C': 'gate_cog_auc'}
+
+CELL_COLS = ('subject_id', 'task', 'effort_condition', 'difficulty_level')
+CONDITION_COLS = ('effort_condition', 'difficulty_level')
+BIAS_FLAG = 0.10  # Pass-rate spread across conditions flagged as biased (audit_trial_level.R)
+
+
+class GateSweep:
+    """
+    Gate scores sorted per (gate, cell) for threshold queries.
+
+    Args:
+        coverage: Trial coverage table (one row per trial)
+        gates: {gate name: tuple of window column alternatives}
+        cell_cols: Columns defining a cell; missing values form their own cell
+    """
+
+    def __init__(self, coverage, gates=GATES, cell_cols=CELL_COLS):
+        self.cell_cols = [c for c in cell_cols if c in coverage.columns]
+        self.gates = []
+        scores = []
+        for gate, windows in gates.items():
+            columns = [next((c for c in alts if c in coverage.columns), None) for alts in windows]
+            if None in columns:
+                print(f"  ⚠ {gate}: validity column missing, skipped")
+                continue
+            values = coverage[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+            score = values.min(axis=1)  # NaN if any window is missing
+            scores.append(np.where(np.isnan(score), -1.0, score))
+            self.gates.append(gate)
+        if not scores:
+            raise ValueError("No gate has all of its validity columns")
+
+        cells = pd.MultiIndex.from_frame(coverage[self.cell_cols].astype(object))
+        codes, self.cells = cells.factorize(sort=True)
+        self.cells.names = self.cell_cols
+        n_cells = len(self.cells)
+        self.n_total = np.bincount(codes, minlength=n_cells)
+
+        # One sorted axis: (gate, cell) blocks laid end to end, score inside each block
+        self._span = 4.0
+        block = np.arange(len(self.gates))[:, None] * n_cells + codes[None, :]
+        key = np.sort((block * self._span + np.vstack(scores)).ravel(), kind='stable')
+        self._key = key
+        self._block_stop = np.cumsum(np.tile(self.n_total, len(self.gates))).reshape(len(self.gates), n_cells)
+
+    def retained(self, thresholds):
+        """Retained trials, shape (n_gates, n_cells, n_thresholds)"""
+        thresholds = np.asarray(thresholds, dtype=float)
+        n_cells = len(self.cells)
+        block = np.arange(len(self.gates) * n_cells).reshape(len(self.gates), n_cells, 1)
+        first_pass = np.searchsorted(self._key, block * self._span + thresholds[None, None, :], side='left')
+        return self._block_stop[:, :, None] - first_pass
+
+    def _cell_frame(self):
+        return self.cells.to_frame(index=False)
+
+    def long_table(self, thresholds, legacy_aliases=True):
+        """03_threshold_sweep_long format: one row per cell x threshold x gate"""
+        thresholds = np.asarray(thresholds, dtype=float)
+        retained = self.retained(thresholds)
+        gates = list(self.gates)
+        if legacy_aliases:
+            aliases = [(alias, gate) for alias, gate in LEGACY_ALIASES.items() if gate in self.gates]
+            retained = np.concatenate([retained[[self.gates.index(g) for _, g in aliases]], retained])
+            gates = [alias for alias, _ in aliases] + gates
+
+        n_gates, n_cells, n_thr = retained.shape
+        cells = self._cell_frame()
+        table = cells.iloc[np.repeat(np.arange(n_cells), n_thr * n_gates)].reset_index(drop=True)
+        table['threshold'] = np.tile(np.repeat(thresholds, n_gates), n_cells)
+        table['gate'] = np.tile(gates, n_cells * n_thr)
+        table['n_trials_retained'] = retained.transpose(1, 2, 0).ravel()
+        return table.sort_values(self.cell_cols + ['threshold', 'gate'], kind='mergesort', ignore_index=True)
+
+    def _collapse(self, retained, by):
+        """Sum (gate, cell, threshold) counts over cells sharing the `by` columns"""
+        groups = self._cell_frame()[list(by)]
+        codes, keys = pd.MultiIndex.from_frame(groups.astype(object)).factorize(sort=True)
+        keys.names = list(by)
+        out = np.zeros((retained.shape[0], len(keys), retained.shape[2]), dtype=np.int64)
+        np.add.at(out, (slice(None), codes), retained)
+        totals = np.bincount(codes, weights=self.n_total, minlength=len(keys)).astype(np.int64)
+        return keys, out, totals
+
+    def trial_summary(self, thresholds):
+        """gate_trial_summary format: retained trials per threshold and gate"""
+        retained = self.retained(thresholds).sum(axis=1)
+        table = pd.DataFrame({'threshold': np.asarray(thresholds, dtype=float)})
+        for i, gate in enumerate(self.gates):
+            table[f'n_trials_{gate.removeprefix("gate_")}'] = retained[i]
+        table['n_trials_total'] = int(self.n_total.sum())
+        return table
+
+    def subject_retention(self, thresholds):
+        """gate_subject_summary format: per subject x task retained trials and % per gate"""
+        thresholds = np.asarray(thresholds, dtype=float)
+        by = [c for c in ('subject_id', 'task') if c in self.cell_cols]
+        keys, retained, totals = self._collapse(self.retained(thresholds), by)
+        n_keys, n_thr = len(keys), len(thresholds)
+        table = keys.to_frame(index=False).iloc[np.repeat(np.arange(n_keys), n_thr)].reset_index(drop=True)
+        table['threshold'] = np.tile(thresholds, n_keys)
+        table['n_trials_total'] = np.repeat(totals, n_thr)
+        for i, gate in enumerate(self.gates):
+            name = gate.removeprefix('gate_')
+            table[f'n_trials_{name}'] = retained[i].ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for gate in self.gates:
+                name = gate.removeprefix('gate_')
+                table[f'pct_{name}'] = 100 * table[f'n_trials_{name}'] / table['n_trials_total']
+        return table
+
+    def condition_balance(self, thresholds, by_task=True):
+        """
+        Pass rate per condition and its spread across conditions, per gate x threshold.
+
+        Returns (per-condition table, spread table with a bias flag when the
+        max - min pass rate exceeds BIAS_FLAG).
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        by = ([c for c in ('task',) if by_task and c in self.cell_cols]
+              + [c for c in CONDITION_COLS if c in self.cell_cols])
+        keys, retained, totals = self._collapse(self.retained(thresholds), by)
+        keys_frame = keys.to_frame(index=False)
+        rows = []
+        for i, gate in enumerate(self.gates):
+            part = keys_frame.iloc[np.repeat(np.arange(len(keys)), len(thresholds))].reset_index(drop=True)
+            part['gate'] = gate
+            part['threshold'] = np.tile(thresholds, len(keys))
+            part['n_total'] = np.repeat(totals, len(thresholds))
+            part['n_retained'] = retained[i].ravel()
+            rows.append(part)
+        table = pd.concat(rows, ignore_index=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table['pass_rate'] = table['n_retained'] / table['n_total']
+
+        conditions = table.dropna(subset=[c for c in CONDITION_COLS if c in table.columns])
+        spread_by = ['gate', 'threshold'] + (['task'] if 'task' in by else [])
+        spread = (conditions.groupby(spread_by)['pass_rate']
+                  .agg(max_pass_rate='max', min_pass_rate='min').reset_index())
+        spread['difference_pct'] = 100 * (spread['max_pass_rate'] - spread['min_pass_rate'])
+        spread['flagged'] = spread['difference_pct'] > 100 * BIAS_FLAG
+        return table, spread
+
+
+def parse_grid(args):
+    if args.grid:
+        start, stop, step = args.grid
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.asarray(args.thresholds or THRESHOLD_GRID, dtype=float)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gate retention over a threshold grid")
+    parser.add_argument('--coverage', default=str(TRIAL_COVERAGE_FILE), help='Trial coverage table')
+    parser.add_argument('--output-dir', default=str(QC_DIR))
+    grid = parser.add_mutually_exclusive_group()
+    grid.add_argument('--thresholds', nargs='+', type=float, help='Explicit thresholds')
+    grid.add_argument('--grid', nargs=3, type=float, metavar=('START', 'STOP', 'STEP'),
+                      help='Dense grid, e.g. 0.30 1.00 0.005')
+    parser.add_argument('--no-legacy', action='store_true', help='Omit gate_A/B/C rows from the long table')
+    args = parser.parse_args()
+
+    coverage_path = Path(args.coverage)
+    if not coverage_path.exists():
+        print(f"❌ Trial coverage file not found: {coverage_path}")
+        return
+    thresholds = parse_grid(args)
+
+    print("=== GATE THRESHOLD SWEEP ===\n")
+    coverage = pd.read_csv(coverage_path, low_memory=False)
+    t0 = time.perf_counter()
+    sweep = GateSweep(coverage)
+    t_build = time.perf_counter() - t0
+    print(f"Indexed {len(coverage)} trials, {len(sweep.cells)} cells, gates: {', '.join(sweep.gates)} "
+          f"({t_build * 1000:.1f} ms)")
+
+    t0 = time.perf_counter()
+    sweep.retained(thresholds)
+    print(f"Retention for {len(thresholds)} thresholds in {(time.perf_counter() - t0) * 1000:.1f} ms\n")
+
+    summary = sweep.trial_summary(thresholds)
+    print(summary.to_string(index=False, max_rows=20))
+
+    balance, spread = sweep.condition_balance(thresholds)
+    n_flagged = int(spread['flagged'].sum())
+    if n_flagged:
+        print(f"\n⚠ {n_flagged} gate × threshold × task combinations with > {100 * BIAS_FLAG:.0f} pp "
+              f"pass-rate spread across conditions")
+    else:
+        print("\n✓ No condition imbalance above the bias flag")
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    outputs = {
+        THRESHOLD_SWEEP_FILE: sweep.long_table(thresholds, legacy_aliases=not args.no_legacy),
+        SUBJECT_RETENTION_FILE: sweep.subject_retention(thresholds),
+        CONDITION_BALANCE_FILE: balance.merge(spread, on=[c for c in spread.columns if c in balance.columns],
+                                              how='left'),
+    }
+    print()
+    for name, table in outputs.items():
+        table.to_csv(output_dir / name, index=False)
+        print(f"✓ Saved {name} ({len(table)} rows)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,682 @@
+#!/usr/bin/env python3
+"""
+Build the merged trial-level dataset and quick-share CSVs from flat files.
+
+Python counterpart of make_quick_share_v7.R, make_merged_quickshare_v4.R and
+qc_build_quickshare_v5.R. Each *_{ADT|VDT}_flat.csv is reduced to one row of
+features per trial (baselines, AUCs, window quality, timing anchor) in a
+process pool, with all trials of a file handled as one NaN-padded matrix
+instead of a group_map per trial. Per-file results are cached by
+(size, mtime), so after a sync that touches one subject only that subject's
+files are recomputed; the reduction into BAP_triallevel_merged and the
+quick-share tables then takes seconds.
+
+Feature definitions follow process_flat_file_v7(): t_rel is rebuilt from the
+sample index on the [-3, 10.7] s squeeze-locked window, B0 = [-0.5, 0) before
+squeeze, b0 = [-0.5, 0) before target onset (4.35 s), and AUCs are trapezoids
+over valid samples (gaps bridged), like compute_auc().
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "01_data_preprocessing" / "python"))
+
+from trial_matching import match_trials  # noqa: E402
+
+# Timing constants (seconds relative to squeeze onset), as in make_quick_share_v7.R
+FS_TARGET = 250
+TRIAL_START_REL = -3.0
+TRIAL_END_REL = 10.7
+TRIALS_PER_RUN = 30
+MIN_BASELINE_SAMPLES = 10
+B0_WIN = (-0.5, 0.0)  # Pre-trial baseline (before squeeze onset)
+B1_WIN = (-0.5, 0.0)  # Pre-target baseline (before target onset)
+TARGET_ONSET_DEFAULT = 4.35
+RESP_START_DEFAULT = 4.70
+RESP_END_DEFAULT = 7.70
+COG_WIN_POST_TARGET = (0.3, 1.3)
+BASELINE_QUALITY_WIN = (-3.0, 0.0)  # Window for baseline_quality (quickshare_build_triallevel.R)
+GATE_THRESHOLDS = (0.50, 0.60, 0.70)
+SESSIONS = (2, 3)
+
+FLAT_SUFFIXES = ('_ADT_flat.csv', '_VDT_flat.csv')
+CACHE_DIRNAME = '.triallevel_cache'
+CACHE_VERSION = 1  # Bump when per-file features change
+
+# Column name alternatives (first match wins), as in process_flat_file_v7()
+COL_MAP = {
+    'sub': ['sub', 'subject', 'subject_id'],
+    'task': ['task', 'task_name', 'task_modality'],
+    'session_used': ['session_used', 'ses', 'session', 'session_num'],
+    'run_used': ['run_used', 'run', 'run_num'],
+    'trial_index': ['trial_index', 'trial_in_run_raw', 'trial_in_run', 'trial_num'],
+    'time': ['time', 'time_ptb', 'trial_pupilTime', 'time_sec'],
+    'pupil': ['pupil', 'pupilSize', 'pupil_diameter'],
+    'trial_label': ['trial_label', 'phase', 'label', 'phase_label'],
+}
+TRIAL_KEYS = ['sub', 'task', 'session_used', 'run_used', 'trial_index']
+SQUEEZE_LABELS = ('squeeze', 'handgrip', 'grip', 'squeeze_onset')
+ITI_LABELS = ('iti', 'baseline', 'iti_baseline')
+
+KEY_OVERRIDES = {'sub': 'sub', 'task': 'task', 'ses': 'session_used', 'run': 'run_used', 'trial': 'trial_index'}
+
+
+def find_flat_files(processed_dir):
+    """All *_{ADT|VDT}_flat.csv files below processed_dir"""
+    return sorted(str(p) for p in Path(processed_dir).rglob('*_flat.csv') if p.name.endswith(FLAT_SUFFIXES))
+
+
+def read_flat_file(flat_path):
+    """
+    Read only the columns the features need, renamed to standard names.
+
+    Also keeps trial_in_run_raw when present, which takes precedence over a
+    global trial_index for the per-run trial number.
+    """
+    header = pd.read_csv(flat_path, nrows=0).columns
+    rename = {}
+    for target, candidates in COL_MAP.items():
+        found = next((c for c in candidates if c in header), None)
+        if found is not None and found not in rename:
+            rename[found] = target
+    usecols = list(rename)
+    if 'trial_in_run_raw' in header and 'trial_in_run_raw' not in usecols:
+        usecols.append('trial_in_run_raw')
+
+    df = pd.read_csv(flat_path, usecols=usecols, low_memory=False)
+    df = df.rename(columns=rename)
+    missing = [c for c in ('sub', 'task', 'session_used', 'run_used', 'trial_index', 'time', 'pupil')
+               if c not in df.columns]
+    if missing:
+        raise KeyError(f"missing columns: {', '.join(missing)}")
+    return df
+
+
+def infer_time_unit(time_values):
+    """('sec' | 'ms', sample interval in seconds) from the median positive step"""
+    steps = np.diff(np.unique(time_values[np.isfinite(time_values)]))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        return 'sec', np.nan
+    dt_median = float(np.median(steps))
+    if 1 <= dt_median <= 10:
+        return 'ms', dt_median / 1000.0
+    return 'sec', dt_median
+
+
+def _window(t, start, end, inclusive_end=True):
+    """Window mask on a t_rel matrix"""
+    return (t >= start) & ((t <= end) if inclusive_end else (t < end))
+
+
+def _bridged_auc(t, y, use):
+    """
+    Trapezoid AUC per row over the samples in `use`, bridging gaps.
+
+    Each used sample contributes the trapezoid back to the previous used
+    sample of its row, which equals compute_auc() on the valid samples.
+    Rows with fewer than two used samples are NaN.
+    """
+    columns = np.arange(use.shape[1])
+    last_used = np.maximum.accumulate(np.where(use, columns, -1), axis=1)
+    prev = np.full_like(last_used, -1)
+    prev[:, 1:] = last_used[:, :-1]
+    pair = use & (prev >= 0)
+    prev = np.maximum(prev, 0)
+    t_prev = np.take_along_axis(t, prev, axis=1)
+    y_prev = np.take_along_axis(y, prev, axis=1)
+    with np.errstate(invalid='ignore'):
+        area = np.where(pair, (t - t_prev) * (y + y_prev) / 2.0, 0.0).sum(axis=1)
+    return np.where(use.sum(axis=1) >= 2, area, np.nan)
+
+
+def _window_mean(y, use):
+    """Mean of y over `use` per row (NaN when empty)"""
+    n = use.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, np.where(use, y, 0.0).sum(axis=1) / n, np.nan)
+
+
+def _label_hits(labels, position_ok, names):
+    """Mask of samples whose label contains any of names (case-insensitive)"""
+    lowered = np.char.lower(labels.astype(str))
+    hit = np.zeros(labels.shape, dtype=bool)
+    for name in names:
+        hit |= np.char.find(lowered, name) >= 0
+    return hit & position_ok
+
+
+def summarize_flat_file(flat_path):
+    """
+    Trial-level features for one flat file.
+
+    Returns one row per (sub, task, session_used, run_used, trial_index) with
+    trial_index the per-run trial number (1-30).
+    """
+    df = read_flat_file(flat_path)
+    df['sub'] = df['sub'].astype(str)
+    df['task'] = df['task'].astype(str)
+    for col in ('session_used', 'run_used', 'trial_index'):
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df = df[df['session_used'].isin(SESSIONS)]
+
+    # trial_index in flat files is global (1-150 per session); fold it into the run
+    if 'trial_in_run_raw' in df.columns:
+        df['trial_index'] = pd.to_numeric(df['trial_in_run_raw'], errors='coerce')
+    else:
+        df['trial_index'] = (df['trial_index'] - 1) % TRIALS_PER_RUN + 1
+    df = df.dropna(subset=['session_used', 'run_used', 'trial_index'])
+    if df.empty:
+        return pd.DataFrame()
+    for col in ('session_used', 'run_used', 'trial_index'):
+        df[col] = df[col].astype(np.int64)
+
+    time_values = pd.to_numeric(df['time'], errors='coerce').to_numpy(dtype=float)
+    unit, dt = infer_time_unit(time_values)
+    if unit == 'ms':
+        time_values = time_values / 1000.0
+    if not np.isfinite(dt):
+        dt = 1.0 / FS_TARGET
+    df['time'] = time_values
+    df['pupil'] = pd.to_numeric(df['pupil'], errors='coerce')
+
+    # One NaN-padded matrix row per trial, samples ordered by time
+    df = df.sort_values(TRIAL_KEYS + ['time'], kind='mergesort')
+    grouped = df.groupby(TRIAL_KEYS, sort=False)
+    trial_id = grouped.ngroup().to_numpy()
+    position = grouped.cumcount().to_numpy()
+    n_trials = trial_id.max() + 1
+    n_cols = position.max() + 1
+
+    lengths = np.bincount(trial_id, minlength=n_trials)
+    pupil = np.full((n_trials, n_cols), np.nan)
+    pupil[trial_id, position] = df['pupil'].to_numpy(dtype=float)
+    times = np.full((n_trials, n_cols), np.nan)
+    times[trial_id, position] = df['time'].to_numpy()
+
+    columns = np.arange(n_cols)
+    in_trial = columns[None, :] < lengths[:, None]
+
+    # t_rel from the sample index; recalibrate to [-3, 10.7] when dt gives an implausible span
+    t_rel = np.broadcast_to(TRIAL_START_REL + columns * dt, (n_trials, n_cols)).copy()
+    span_end = TRIAL_START_REL + (lengths - 1) * dt
+    recalibrate = ((span_end < 8) | (span_end > 15)) & (lengths > 1)
+    if recalibrate.any():
+        step = (TRIAL_END_REL - TRIAL_START_REL) / np.maximum(lengths[recalibrate] - 1, 1)
+        t_rel[recalibrate] = TRIAL_START_REL + columns[None, :] * step[:, None]
+    t_rel[~in_trial] = np.nan
+
+    valid = in_trial & np.isfinite(pupil)
+
+    # Timing anchor: absolute PTB time -> first sample + 3 s; relative time -> labels
+    time_min = np.nanmin(np.where(in_trial, times, np.inf), axis=1)
+    squeeze_onset = time_min + 3.0
+    timing_source = np.full(n_trials, 'ptb', dtype=object)
+    relative = time_min < 0
+    if relative.any():
+        squeeze_onset[relative] = 0.0
+        timing_source[relative] = 'default'
+        if 'trial_label' in df.columns:
+            labels = np.full((n_trials, n_cols), '', dtype=object)
+            labels[trial_id, position] = df['trial_label'].fillna('').astype(str).to_numpy()
+            hit = _label_hits(labels, in_trial, SQUEEZE_LABELS)
+            has_squeeze = hit.any(axis=1) & relative
+            first_hit = hit.argmax(axis=1)
+            squeeze_onset[has_squeeze] = times[has_squeeze, first_hit[has_squeeze]]
+            timing_source[has_squeeze] = 'label'
+
+            # Fallback: first sample after the last ITI/baseline sample
+            iti = _label_hits(labels, in_trial, ITI_LABELS)
+            last_iti = np.where(iti.any(axis=1), n_cols - 1 - iti[:, ::-1].argmax(axis=1), -1)
+            after = last_iti + 1
+            use_iti = relative & ~has_squeeze & (last_iti >= 0) & (after < lengths)
+            squeeze_onset[use_iti] = times[use_iti, after[use_iti]]
+            timing_source[use_iti] = 'label'
+    timing_anchor_found = np.isfinite(squeeze_onset)
+
+    # Baselines
+    b0_use = valid & _window(t_rel, *B0_WIN, inclusive_end=False)
+    b1_use = valid & _window(t_rel, TARGET_ONSET_DEFAULT + B1_WIN[0], TARGET_ONSET_DEFAULT + B1_WIN[1],
+                             inclusive_end=False)
+    n_valid_B0 = b0_use.sum(axis=1)
+    n_valid_b0 = b1_use.sum(axis=1)
+    enough_samples = lengths >= 2
+    B0_ok = enough_samples & (n_valid_B0 >= MIN_BASELINE_SAMPLES)
+    b0_ok = B0_ok & (n_valid_b0 >= MIN_BASELINE_SAMPLES)
+    baseline_B0_mean = np.where(B0_ok, _window_mean(pupil, b0_use), np.nan)
+    baseline_b0_mean = np.where(b0_ok, _window_mean(pupil, b1_use), np.nan)
+
+    full_corrected = pupil - baseline_B0_mean[:, None]
+    partial_corrected = pupil - baseline_b0_mean[:, None]
+
+    def _auc(values, start, end):
+        if end <= start:
+            return np.full(n_trials, np.nan)
+        return np.where(b0_ok, _bridged_auc(t_rel, values, valid & _window(t_rel, start, end)), np.nan)
+
+    cog_start = TARGET_ONSET_DEFAULT + COG_WIN_POST_TARGET[0]
+    total_auc = _auc(full_corrected, 0.0, RESP_START_DEFAULT)
+    cog_auc = _auc(partial_corrected, cog_start,
+                   min(TARGET_ONSET_DEFAULT + COG_WIN_POST_TARGET[1], RESP_START_DEFAULT))
+    cog_auc_w3 = _auc(partial_corrected, cog_start, min(TARGET_ONSET_DEFAULT + 3.3, RESP_END_DEFAULT))
+    cog_auc_respwin = _auc(partial_corrected, cog_start, RESP_END_DEFAULT)
+    w1p3_end = TARGET_ONSET_DEFAULT + 1.3
+    cog_auc_w1p3 = _auc(partial_corrected, cog_start, w1p3_end)
+    cog_mean_w1p3 = cog_auc_w1p3 / (w1p3_end - cog_start)
+
+    auc_available_total = np.isfinite(total_auc)
+    auc_available_cog = np.isfinite(cog_auc)
+    auc_missing_reason = np.select(
+        [~enough_samples, ~B0_ok, ~b0_ok, ~auc_available_total, ~auc_available_cog],
+        ['insufficient_samples', 'B0_insufficient_samples', 'b0_insufficient_samples',
+         'total_auc_failed', 'cog_auc_failed'],
+        default='ok',
+    )
+
+    # Window quality (share of valid samples in the window)
+    def _quality(start, end):
+        in_window = in_trial & _window(t_rel, start, end)
+        n = in_window.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, (valid & in_window).sum(axis=1) / n, np.nan)
+
+    first_rows = np.unique(trial_id, return_index=True)[1]
+    out = df.iloc[first_rows][TRIAL_KEYS].reset_index(drop=True)
+    out['n_samples'] = lengths
+    out['time_unit_inferred'] = unit
+    out['dt_median'] = dt
+    out['squeeze_onset_time'] = np.where(timing_anchor_found, squeeze_onset, np.nan)
+    out['timing_anchor_found'] = timing_anchor_found
+    out['timing_source'] = timing_source
+    out['t_target_onset_rel'] = TARGET_ONSET_DEFAULT
+    out['t_resp_start_rel'] = RESP_START_DEFAULT
+    out['total_auc'] = total_auc
+    out['cog_auc'] = cog_auc
+    out['cog_auc_w3'] = cog_auc_w3
+    out['cog_auc_respwin'] = cog_auc_respwin
+    out['cog_auc_w1p3'] = cog_auc_w1p3
+    out['cog_mean_w1p3'] = cog_mean_w1p3
+    out['n_valid_B0'] = np.where(enough_samples, n_valid_B0, 0)
+    out['n_valid_b0'] = np.where(B0_ok, n_valid_b0, 0)
+    out['baseline_B0_mean'] = baseline_B0_mean
+    out['baseline_b0_mean'] = baseline_b0_mean
+    out['auc_available_total'] = auc_available_total
+    out['auc_available_cog'] = auc_available_cog
+    out['auc_available_both'] = auc_available_total & auc_available_cog
+    out['auc_available'] = out['auc_available_both']
+    out['auc_missing_reason'] = auc_missing_reason
+    out['baseline_quality'] = _quality(*BASELINE_QUALITY_WIN)
+    out['cog_quality'] = _quality(cog_start, w1p3_end)
+    out['overall_quality'] = valid.sum(axis=1) / np.maximum(lengths, 1)
+    out['source_file'] = os.path.basename(flat_path)
+    return out
+
+
+def _summarize_job(flat_path):
+    """Worker: (path, features or None, error or None)"""
+    try:
+        return flat_path, summarize_flat_file(flat_path), None
+    except Exception as e:
+        return flat_path, None, f'{type(e).__name__}: {e}'
+
+
+class ResultCache:
+    """
+    Per-file feature cache: one pickle per flat file plus a JSON index of
+    (size, mtime_ns) so unchanged files are never re-read.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / 'index.json'
+        self.index = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path) as f:
+                    data = json.load(f)
+                if data.get('version') == CACHE_VERSION:
+                    self.index = data.get('files', {})
+            except (OSError, ValueError):
+                pass
+
+    def _entry_path(self, flat_path):
+        return self.cache_dir / (hashlib.sha1(os.path.abspath(flat_path).encode()).hexdigest()[:16] + '.pkl')
+
+    def load(self, flat_path):
+        """Cached features for an unchanged file, else None"""
+        entry = self.index.get(os.path.abspath(flat_path))
+        st = os.stat(flat_path)
+        if not entry or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            return None
+        try:
+            return pd.read_pickle(self._entry_path(flat_path))
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def store(self, flat_path, features):
+        st = os.stat(flat_path)
+        features.to_pickle(self._entry_path(flat_path))
+        self.index[os.path.abspath(flat_path)] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def prune(self, flat_paths):
+        """Drop entries for files that no longer exist in the input set"""
+        keep = {os.path.abspath(p) for p in flat_paths}
+        for path in [p for p in self.index if p not in keep]:
+            self._entry_path(path).unlink(missing_ok=True)
+            del self.index[path]
+
+    def save(self):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'files': self.index}, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def summarize_all(flat_files, cache_dir=None, workers=None, force=False):
+    """
+    Features for all flat files, computing only uncached ones in a process pool.
+
+    Returns (features, n_computed, errors) where errors is {path: message}.
+    """
+    cache = ResultCache(cache_dir) if cache_dir else None
+    results = {}
+    to_compute = []
+    for path in flat_files:
+        cached = None if (force or cache is None) else cache.load(path)
+        if cached is None:
+            to_compute.append(path)
+        else:
+            results[path] = cached
+
+    errors = {}
+    if to_compute:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, features, error in pool.map(_summarize_job, to_compute):
+                if error:
+                    errors[path] = error
+                    print(f"  ✗ {os.path.basename(path)}: {error}")
+                    continue
+                results[path] = features
+                if cache is not None:
+                    cache.store(path, features)
+
+    if cache is not None:
+        cache.prune(flat_files)
+        cache.save()
+
+    frames = [results[p] for p in flat_files if p in results and len(results[p])]
+    features = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=TRIAL_KEYS)
+    return features, len(to_compute), errors
+
+
+def _first_column(df, candidates):
+    return next((df[c] for c in candidates if c in df.columns), pd.Series(np.nan, index=df.index))
+
+
+def load_behavioral(behavioral_file):
+    """Standardized behavioral trials (keys + rt/choice/correct/...), as in make_merged_quickshare_v4.R"""
+    raw = pd.read_csv(behavioral_file, low_memory=False)
+
+    sub = _first_column(raw, ['subject_id', 'sub', 'subject']).astype(str)
+    digits = sub.str.extract(r'(\d+)', expand=False)
+    task = _first_column(raw, ['task', 'task_modality']).astype(str).replace({'aud': 'ADT', 'vis': 'VDT'})
+
+    effort = _first_column(raw, ['effort'])
+    if effort.isna().all():
+        grip = _first_column(raw, ['grip_targ_prop_mvc', 'gf_trPer'])
+        effort = pd.Series(np.select([np.isclose(grip, 0.05), np.isclose(grip, 0.40)], ['Low', 'High'], default=None),
+                           index=raw.index)
+
+    beh = pd.DataFrame({
+        'sub': np.where(digits.notna(), 'BAP' + digits.fillna('').str.zfill(3), sub),
+        'task': task,
+        'session_used': pd.to_numeric(_first_column(raw, ['session_used', 'session', 'session_num', 'ses']),
+                                      errors='coerce'),
+        'run_used': pd.to_numeric(_first_column(raw, ['run_used', 'run', 'run_num']), errors='coerce'),
+        'trial_index': pd.to_numeric(_first_column(raw, ['trial_index', 'trial_in_run', 'trial_num', 'trial']),
+                                     errors='coerce'),
+        'rt': _first_column(raw, ['rt', 'same_diff_resp_secs', 'resp1RT']),
+        'choice': _first_column(raw, ['choice', 'resp_is_diff', 'resp1']),
+        'correct': _first_column(raw, ['correct', 'resp_is_correct', 'iscorr']),
+        'stimulus_intensity': _first_column(raw, ['stimulus_intensity', 'intensity', 'stimLev', 'stim_level_index']),
+        'effort': effort,
+        'isOddball': _first_column(raw, ['isOddball', 'stim_is_diff']),
+    })
+    beh = beh.dropna(subset=['session_used', 'run_used', 'trial_index'])
+    beh = beh[beh['session_used'].isin(SESSIONS) & beh['task'].isin(['ADT', 'VDT'])]
+    for col in ('session_used', 'run_used', 'trial_index'):
+        beh[col] = beh[col].astype(np.int64)
+
+    n_before = len(beh)
+    beh = beh.drop_duplicates(TRIAL_KEYS).reset_index(drop=True)
+    if len(beh) < n_before:
+        print(f"  ⚠ {n_before - len(beh)} duplicate behavioral trials (kept first occurrence)")
+    return beh
+
+
+def trial_uid(df):
+    """sub:task:session:run:trial identifier"""
+    return (df['sub'].astype(str) + ':' + df['task'].astype(str) + ':' + df['session_used'].astype(str)
+            + ':' + df['run_used'].astype(str) + ':' + df['trial_index'].astype(str))
+
+
+def build_merged(features, beh):
+    """
+    Deduplicate trial features, join behavior and add gates.
+
+    Returns (merged, matching_report, unmatched_beh_uids).
+    """
+    # Keep the best copy of a trial seen in more than one flat file
+    features = (features.sort_values(TRIAL_KEYS + ['timing_anchor_found', 'n_valid_B0', 'n_valid_b0'],
+                                     ascending=[True] * len(TRIAL_KEYS) + [False, False, False], kind='mergesort')
+                .drop_duplicates(TRIAL_KEYS)
+                .reset_index(drop=True))
+    features['sub'] = 'BAP' + features['sub'].str.extract(r'(\d+)', expand=False).str.zfill(3)
+
+    beh_cols = ['rt', 'choice', 'correct', 'stimulus_intensity', 'effort', 'isOddball']
+    matches, _, unmatched_beh, report = match_trials(features, beh, KEY_OVERRIDES, KEY_OVERRIDES)
+
+    merged = features.copy()
+    for col in beh_cols:
+        values = np.full(len(merged), np.nan, dtype=object)
+        values[matches['pupil_row'].to_numpy()] = beh[col].to_numpy()[matches['beh_row'].to_numpy()]
+        merged[col] = pd.Series(values, index=merged.index).infer_objects()
+    merged['has_behavioral_data'] = merged['rt'].notna() & merged['choice'].notna()
+    merged.insert(len(TRIAL_KEYS), 'trial_uid', trial_uid(merged))
+
+    # Derived behavioral columns (STEP 4 of make_quick_share_v7.R)
+    choice = pd.to_numeric(merged['choice'].replace({'DIFFERENT': 1, 'SAME': 0, True: 1, False: 0}), errors='coerce')
+    merged['choice_num'] = choice.astype('Int64')
+    merged['choice_label'] = choice.map({0: 'SAME', 1: 'DIFFERENT'})
+    odd = pd.to_numeric(merged['isOddball'], errors='coerce')
+    merged['correct_final'] = (choice == odd).astype('Int64').where(choice.notna() & odd.notna())
+
+    # Gates (flags only; no rows are dropped)
+    baseline_q = merged['baseline_quality']
+    cog_q = merged['cog_quality']
+    merged['gate_baseline_60'] = baseline_q.ge(0.60).fillna(False)
+    merged['gate_cog_60'] = cog_q.ge(0.60).fillna(False)
+    merged['gate_baseline_50'] = baseline_q.ge(0.50).fillna(False)
+    merged['gate_auc_both'] = merged['auc_available_both']
+    merged['found_in_flat_run'] = True
+    merged['gate_pupil_primary'] = (merged['gate_baseline_60'] & merged['gate_cog_60']
+                                    & merged['gate_auc_both'] & merged['found_in_flat_run'])
+    merged['ddm_ready'] = merged['has_behavioral_data'] & (baseline_q.ge(0.50) | baseline_q.isna())
+
+    unmatched_uids = trial_uid(beh.iloc[unmatched_beh]).tolist()
+    return merged, report, unmatched_uids
+
+
+def quick_share_tables(merged, unmatched_beh_uids):
+    """The make_merged_quickshare_v4.R quick-share tables as {filename: DataFrame}"""
+    tables = {}
+    has_beh = merged['has_behavioral_data']
+
+    rows = []
+    for task, group in list(merged.groupby('task')) + [('ALL', merged)]:
+        rows.append({'task': task, 'n_pupil_trials': len(group),
+                     'n_matched': int(group['has_behavioral_data'].sum()),
+                     'match_rate_pct': 100 * group['has_behavioral_data'].mean() if len(group) else np.nan})
+    diagnostics = pd.DataFrame(rows)
+    unmatched_pupil = merged.loc[~has_beh, 'trial_uid'].head(20).tolist()
+    is_all = diagnostics['task'] == 'ALL'
+    diagnostics['n_unmatched_pupil'] = pd.Series(np.where(is_all, len(unmatched_pupil), np.nan)).astype('Int64')
+    diagnostics['n_unmatched_beh'] = pd.Series(np.where(is_all, min(len(unmatched_beh_uids), 20), np.nan)).astype('Int64')
+    diagnostics['unmatched_pupil_sample'] = np.where(is_all, '; '.join(unmatched_pupil) or None, None)
+    diagnostics['unmatched_beh_sample'] = np.where(is_all, '; '.join(unmatched_beh_uids[:20]) or None, None)
+    tables['01_merge_diagnostics.csv'] = diagnostics
+
+    per_ses = merged.groupby(['sub', 'task', 'session_used']).agg(
+        n_runs=('run_used', 'nunique'), n_trials=('trial_uid', 'size'),
+        n_trials_with_behavior=('has_behavioral_data', 'sum')).reset_index()
+    per_ses['expected_runs'] = 5
+    per_ses['missing_runs'] = (per_ses['expected_runs'] - per_ses['n_runs']).clip(lower=0)
+    tables['02_trials_per_subject_task_ses.csv'] = per_ses
+
+    matched = merged[has_beh].copy()
+    for th, name in zip(GATE_THRESHOLDS, ('lenient', 'primary', 'strict')):
+        matched[f'n_trials_valid_{name}'] = matched['baseline_quality'].ge(th) & matched['cog_quality'].ge(th)
+    tables['03_condition_cell_counts.csv'] = matched.groupby(
+        ['sub', 'task', 'effort', 'stimulus_intensity'], dropna=False).agg(
+        n_trials_total=('trial_uid', 'size'),
+        n_trials_valid_primary=('n_trials_valid_primary', 'sum'),
+        n_trials_valid_lenient=('n_trials_valid_lenient', 'sum'),
+        n_trials_valid_strict=('n_trials_valid_strict', 'sum')).reset_index()
+
+    tables['04_run_level_counts.csv'] = merged.groupby(['sub', 'task', 'session_used', 'run_used']).agg(
+        n_trials=('trial_uid', 'size'), n_trials_with_behavior=('has_behavioral_data', 'sum'),
+        mean_baseline_quality=('baseline_quality', 'mean'), mean_cog_quality=('cog_quality', 'mean'),
+        mean_overall_quality=('overall_quality', 'mean')).reset_index()
+
+    matched['effort'] = matched['effort'].fillna('Unknown')
+    tables['05_window_validity_summary.csv'] = matched.groupby(['task', 'effort']).agg(
+        n_trials=('trial_uid', 'size'),
+        baseline_mean=('baseline_quality', 'mean'), baseline_median=('baseline_quality', 'median'),
+        cog_mean=('cog_quality', 'mean'), cog_median=('cog_quality', 'median'),
+        overall_mean=('overall_quality', 'mean'), overall_median=('overall_quality', 'median')).reset_index()
+
+    rows = []
+    for th in GATE_THRESHOLDS:
+        passed = matched['baseline_quality'].ge(th) & matched['cog_quality'].ge(th)
+        for task, mask in passed.groupby(matched['task']):
+            rows.append({'task': task, 'threshold': th, 'n_trials_total': len(mask),
+                         'n_trials_pass': int(mask.sum()), 'pass_rate': mask.mean(),
+                         'pass_rate_pct': 100 * mask.mean()})
+    tables['06_gate_pass_rates_by_threshold.csv'] = pd.DataFrame(rows)
+    return tables
+
+
+def analysis_ready_tables(merged):
+    """ch2/ch3 analysis-ready exports (make_quick_share_v7.R STEP 4)"""
+    behavior = [c for c in ('effort', 'stimulus_intensity', 'isOddball', 'choice_num', 'choice_label',
+                            'rt', 'correct_final', 'choice', 'correct') if c in merged.columns]
+    quality = ['baseline_quality', 'cog_quality', 'overall_quality']
+    baselines = ['n_valid_B0', 'n_valid_b0', 'baseline_B0_mean', 'baseline_b0_mean']
+    timing = ['t_target_onset_rel', 't_resp_start_rel', 'timing_source', 'found_in_flat_run']
+    keys = TRIAL_KEYS + ['trial_uid']
+
+    ch2 = merged[keys + behavior + quality
+                 + ['total_auc', 'cog_auc', 'auc_available_total', 'auc_available_cog', 'auc_available_both',
+                    'auc_available', 'auc_missing_reason'] + baselines + timing
+                 + ['gate_baseline_60', 'gate_cog_60', 'gate_baseline_50', 'gate_auc_both', 'gate_pupil_primary']]
+    ch3 = merged[keys + behavior + quality
+                 + ['total_auc', 'cog_auc', 'cog_auc_w3', 'cog_auc_respwin', 'cog_auc_w1p3', 'cog_mean_w1p3',
+                    'auc_available_total', 'auc_available_cog', 'auc_available_both', 'auc_available',
+                    'auc_missing_reason'] + baselines + timing
+                 + ['gate_baseline_60', 'gate_cog_60', 'gate_baseline_50', 'gate_auc_both', 'ddm_ready']]
+    return {'ch2_triallevel.csv': ch2, 'ch3_triallevel.csv': ch3}
+
+
+def load_config_paths():
+    """(processed_dir, behavioral_csv) from config/data_paths.yaml or environment variables"""
+    config_file = REPO_ROOT / 'config' / 'data_paths.yaml'
+    if config_file.exists():
+        try:
+            import yaml
+            with open(config_file) as f:
+                config = yaml.safe_load(f) or {}
+            return config.get('processed_dir'), config.get('behavioral_csv')
+        except ImportError:
+            print("⚠ PyYAML not installed; falling back to environment variables")
+    return os.environ.get('PUPIL_PROCESSED_DIR'), os.environ.get('BEHAVIORAL_CSV')
+
+
+def main():
+    config_processed, config_behavioral = load_config_paths()
+    parser = argparse.ArgumentParser(description="Build BAP_triallevel_merged and quick-share CSVs from flat files")
+    parser.add_argument('--processed-dir', default=config_processed, help='Directory with *_flat.csv files')
+    parser.add_argument('--behavioral', default=config_behavioral, help='Behavioral trial-level CSV')
+    parser.add_argument('--out-dir', default=str(REPO_ROOT / 'data' / 'pupil_processed'), help='Output root')
+    parser.add_argument('--workers', type=int, help='Worker processes for per-file features')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the per-file result cache')
+    parser.add_argument('--force', action='store_true', help='Recompute all files (refreshes the cache)')
+    parser.add_argument('--allow-partial', action='store_true',
+                        help='Write outputs even if some flat files failed (default: abort)')
+    args = parser.parse_args()
+
+    if not args.processed_dir or not os.path.isdir(args.processed_dir):
+        print(f"Error: processed dir not found: {args.processed_dir} (set config/data_paths.yaml or --processed-dir)")
+        sys.exit(1)
+    if not args.behavioral or not os.path.exists(args.behavioral):
+        print(f"Error: behavioral file not found: {args.behavioral}")
+        sys.exit(1)
+
+    out_dir = Path(args.out_dir)
+    dirs = {name: out_dir / name for name in ('merged', 'quick_share', 'analysis_ready', 'qc')}
+    for path in dirs.values():
+        path.mkdir(parents=True, exist_ok=True)
+
+    print("=== BUILDING MERGED TRIAL-LEVEL DATASET ===\n")
+    start = time.perf_counter()
+    flat_files = find_flat_files(args.processed_dir)
+    if not flat_files:
+        print(f"Error: no flat CSV files found in {args.processed_dir}")
+        sys.exit(1)
+
+    cache_dir = None if args.no_cache else out_dir / CACHE_DIRNAME
+    features, n_computed, errors = summarize_all(flat_files, cache_dir, args.workers, args.force)
+    print(f"STEP 1: {len(features)} trials from {len(flat_files)} flat files "
+          f"({n_computed} computed, {len(flat_files) - n_computed} cached, {len(errors)} failed)")
+    if errors:
+        print(f"\n{len(errors)} flat file(s) failed:")
+        for path, error in sorted(errors.items()):
+            print(f"  ✗ {path}: {error}")
+        if not args.allow_partial:
+            print("\n❌ Not writing outputs from a partial cohort (rerun with --allow-partial to override)")
+            sys.exit(1)
+        print("⚠ --allow-partial: outputs will be missing the trials of the failed files\n")
+
+    beh = load_behavioral(args.behavioral)
+    print(f"STEP 2: {len(beh)} behavioral trials")
+
+    merged, report, unmatched_beh = build_merged(features, beh)
+    print(f"STEP 3: {len(merged)} merged trials, {int(merged['has_behavioral_data'].sum())} with behavior")
+
+    merged.to_csv(dirs['merged'] / 'BAP_triallevel_merged.csv', index=False)
+    report.to_csv(dirs['qc'] / 'trial_matching_report.csv')
+    for name, table in quick_share_tables(merged, unmatched_beh).items():
+        table.to_csv(dirs['quick_share'] / name, index=False)
+    for name, table in analysis_ready_tables(merged).items():
+        table.to_csv(dirs['analysis_ready'] / name, index=False)
+
+    print(f"\n✓ Saved: {dirs['merged'] / 'BAP_triallevel_merged.csv'}")
+    print(f"✓ Saved: quick_share/01-06, analysis_ready/ch2_triallevel.csv, ch3_triallevel.csv")
+    print(f"  Primary gate pass: {100 * merged['gate_pupil_primary'].mean():.1f}% | "
+          f"DDM-ready: {100 * merged['ddm_ready'].mean():.1f}%")
+    print(f"  Elapsed: {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
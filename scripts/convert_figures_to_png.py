@@ -2,13 +2,29 @@
 """
 Convert PDF figures to high-quality PNG for HTML output.
 Uses pdf2image library which requires poppler.
+
+PDFs are discovered recursively (figures/ppc, figures/tonic, ...). Only the
+first page of each PDF is rasterized, once, at the highest requested DPI;
+every other target (lower DPI, capped width, optimized PNG or WebP under a
+byte budget) is derived from that render. Figures are converted across a
+worker pool and skipped when the PDF's content hash matches the render
+manifest, so touching a PDF does not trigger a re-render.
 """
+import argparse
+import io
+import json
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent / "utilities"))
+from verify_file_hashes import hash_file
+
 try:
     from pdf2image import convert_from_path
+    from PIL import Image
 except ImportError:
     print("ERROR: pdf2image not installed.")
     print("Install with: pip install pdf2image")
@@ -18,69 +34,308 @@ except ImportError:
 # Configuration
 FIG_DIR = Path("output/figures")
 DPI = 600  # High quality
-QUALITY = 95  # PNG compression quality (0-100)
+MANIFEST_FILENAME = "render_manifest.json"
+
+# Output formats: lossless PNG, size-optimized PNG, or WebP
+FORMATS = {"png": ".png", "optpng": ".png", "webp": ".webp"}
+WEBP_QUALITIES = (90, 80, 70, 60, 50)
+BUDGET_SCALE_STEP = 0.85  # Downscale factor per step when still over budget
+MIN_BUDGET_WIDTH = 400  # Never shrink below this width to meet a budget
+
+# Default output: <name>.png at 600 DPI
+# Target fields: (suffix, dpi, max_width_px, format, max_bytes)
+DEFAULT_TARGETS = [("", DPI, None, "png", None)]
+
+
+def parse_target(spec):
+    """
+    Parse a target spec SUFFIX:DPI[:MAX_WIDTH[:FORMAT[:MAX_KB]]].
+
+    ':600' writes <name>.png at 600 DPI (the default);
+    '_html:150:1600:webp:300' writes <name>_html.webp at 150 DPI, at most
+    1600 px wide and 300 KB.
+    """
+    parts = spec.split(":")
+    if not 2 <= len(parts) <= 5:
+        raise argparse.ArgumentTypeError(
+            f"Invalid target '{spec}' (expected SUFFIX:DPI[:MAX_WIDTH[:FORMAT[:MAX_KB]]])"
+        )
+    parts += [""] * (5 - len(parts))
+    suffix, dpi, max_width, fmt, max_kb = parts
+    fmt = fmt or "png"
+    if fmt not in FORMATS:
+        raise argparse.ArgumentTypeError(f"Unknown format '{fmt}' (choose from {', '.join(FORMATS)})")
+    return (
+        suffix,
+        int(dpi),
+        int(max_width) if max_width else None,
+        fmt,
+        int(float(max_kb) * 1024) if max_kb else None,
+    )
+
+
+def target_path(pdf_file, suffix, fmt="png"):
+    """Output path for a PDF and target suffix/format"""
+    return pdf_file.with_name(f"{pdf_file.stem}{suffix}{FORMATS[fmt]}")
+
+
+def duplicate_outputs(targets):
+    """Output names (suffix + extension) written by more than one target"""
+    seen, duplicates = set(), []
+    for suffix, _, _, fmt, _ in targets:
+        name = f"{suffix}{FORMATS[fmt]}"
+        if name in seen and name not in duplicates:
+            duplicates.append(name)
+        seen.add(name)
+    return duplicates
 
-if not FIG_DIR.exists():
-    print(f"ERROR: Figure directory not found: {FIG_DIR}")
-    sys.exit(1)
 
-# Find all PDF files
-pdf_files = list(FIG_DIR.glob("*.pdf"))
-
-if not pdf_files:
-    print(f"No PDF files found in {FIG_DIR}")
-    sys.exit(0)
-
-print(f"Found {len(pdf_files)} PDF file(s) to convert at {DPI} DPI...\n")
-
-success_count = 0
-for pdf_file in pdf_files:
-    png_file = pdf_file.with_suffix(".png")
-    
-    # Skip if PNG exists and is newer
-    if png_file.exists() and png_file.stat().st_mtime > pdf_file.stat().st_mtime:
-        print(f"⏭  Skipping {pdf_file.name} (PNG already exists and is newer)")
-        success_count += 1
-        continue
-    
-    print(f"🔄 Converting: {pdf_file.name}")
-    
+def resize_for_target(image, render_dpi, dpi, max_width):
+    """Downscale a page rendered at render_dpi to a target DPI / width"""
+    scale = dpi / render_dpi
+    if max_width is not None:
+        scale = min(scale, max_width / image.width)
+    if scale >= 1:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def encode_image(image, fmt, quality=None):
+    """Encode an image to bytes in one of FORMATS"""
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        image.save(buffer, "WEBP", quality=quality or WEBP_QUALITIES[0], method=6)
+    elif fmt == "optpng":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.save(buffer, "PNG", optimize=False)  # Don't optimize (faster, better quality)
+    return buffer.getvalue()
+
+
+def encode_within_budget(image, fmt, max_bytes):
+    """
+    Encode an image, shrinking it until it fits max_bytes.
+
+    WebP steps down through WEBP_QUALITIES; optimized PNG falls back to a
+    256-color palette. If that is still too large the image is downscaled in
+    BUDGET_SCALE_STEP steps (not below MIN_BUDGET_WIDTH). Returns the
+    smallest encoding found, which may exceed the budget.
+    """
+    data = encode_image(image, fmt)
+    if max_bytes is None or len(data) <= max_bytes or fmt == "png":
+        return data
+
+    current = image
+    while True:
+        if fmt == "webp":
+            candidates = (encode_image(current, fmt, quality) for quality in WEBP_QUALITIES)
+        else:
+            candidates = (encode_image(current, fmt),
+                          encode_image(current.convert("RGB").quantize(colors=256), fmt))
+        for candidate in candidates:
+            if len(candidate) < len(data):
+                data = candidate
+            if len(candidate) <= max_bytes:
+                return candidate
+
+        width = round(current.width * BUDGET_SCALE_STEP)
+        if width < MIN_BUDGET_WIDTH:
+            return data
+        height = max(1, round(current.height * BUDGET_SCALE_STEP))
+        current = current.resize((width, height), Image.LANCZOS)
+
+
+def render_pdf(pdf_file, targets):
+    """
+    Rasterize page 1 of a PDF once and write every target from that render.
+
+    Returns a dict with the written files, their sizes and the render time;
+    runs inside a worker, so errors are returned rather than raised.
+    """
+    start = time.perf_counter()
+    render_dpi = max(target[1] for target in targets)
     try:
-        # Convert PDF to image at high DPI
         images = convert_from_path(
             pdf_file,
-            dpi=DPI,
+            dpi=render_dpi,
             fmt='png',
+            first_page=1,
+            last_page=1,
             thread_count=1
         )
-        
         if not images:
-            print(f"    ✗ Failed: No images extracted\n")
-            continue
-        
-        # Save first page (PDFs should be single page)
-        if len(images) > 1:
-            print(f"    ⚠  Warning: PDF has {len(images)} pages, using first page")
-        
-        # Save with high quality
-        images[0].save(
-            png_file,
-            'PNG',
-            optimize=False,  # Don't optimize (faster, better quality)
-            quality=QUALITY
-        )
-        
-        file_size = png_file.stat().st_size / 1024
-        print(f"    ✓ Success ({file_size:.1f} KB)\n")
-        success_count += 1
-        
+            return {"pdf": str(pdf_file), "error": "No images extracted"}
+
+        page = images[0]
+        outputs = {}
+        for suffix, dpi, max_width, fmt, max_bytes in targets:
+            out_file = target_path(pdf_file, suffix, fmt)
+            data = encode_within_budget(resize_for_target(page, render_dpi, dpi, max_width), fmt, max_bytes)
+            out_file.write_bytes(data)
+            outputs[out_file.name] = {
+                "bytes": len(data),
+                "over_budget": max_bytes is not None and len(data) > max_bytes,
+            }
+
+        return {"pdf": str(pdf_file), "outputs": outputs, "seconds": time.perf_counter() - start}
+
     except Exception as e:
-        print(f"    ✗ Failed: {e}\n")
+        return {"pdf": str(pdf_file), "error": str(e)}
+
+
+def load_manifest(manifest_file):
+    """Load the {relative_pdf_path: entry} render manifest"""
+    if manifest_file.exists():
+        try:
+            with open(manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"⚠  Ignoring unreadable manifest: {manifest_file}")
+    return {}
+
+
+def save_manifest(manifest_file, manifest):
+    """Write the render manifest atomically"""
+    tmp_file = manifest_file.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def is_up_to_date(entry, digest, targets, pdf_file):
+    """True if the manifest entry matches the PDF content and all targets exist"""
+    return (
+        entry is not None
+        and entry.get("source_hash") == digest
+        and entry.get("targets") == [list(t) for t in targets]
+        and all(target_path(pdf_file, t[0], t[3]).exists() for t in targets)
+    )
+
+
+def find_pdfs(fig_dir, recursive=True):
+    """All PDFs under fig_dir (recursively by default)"""
+    return sorted(fig_dir.rglob("*.pdf") if recursive else fig_dir.glob("*.pdf"))
+
+
+def convert_figures(fig_dir, targets, workers=None, executor="process", force=False, recursive=True):
+    """
+    Convert all PDFs under fig_dir, skipping those whose content hash is in the manifest.
+
+    The manifest (fig_dir/render_manifest.json) records, per PDF, the source
+    hash, the targets, each output's size and the render time.
+
+    Returns (n_converted, n_skipped, failed_pdf_paths).
+    """
+    manifest_file = fig_dir / MANIFEST_FILENAME
+    manifest = load_manifest(manifest_file)
+    pdf_files = find_pdfs(fig_dir, recursive)
+
+    jobs = []
+    digests = {}
+    n_skipped = 0
+    for pdf_file in pdf_files:
+        rel_path = pdf_file.relative_to(fig_dir).as_posix()
+        digest = hash_file(pdf_file)
+        digests[rel_path] = digest
+        if not force and is_up_to_date(manifest.get(rel_path), digest, targets, pdf_file):
+            print(f"⏭  Skipping {rel_path} (unchanged since last conversion)")
+            n_skipped += 1
+        else:
+            jobs.append(pdf_file)
+
+    n_converted = 0
+    failed = []
+    if jobs:
+        print(f"\n🔄 Converting {len(jobs)} PDF(s) with {workers or os.cpu_count()} {executor} worker(s)...\n")
+        pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+
+        with pool_cls(max_workers=workers) as pool:
+            for result in pool.map(render_pdf, jobs, [targets] * len(jobs)):
+                rel_path = Path(result["pdf"]).relative_to(fig_dir).as_posix()
+                if "error" in result:
+                    print(f"    ✗ Failed: {rel_path}: {result['error']}")
+                    failed.append(rel_path)
+                    continue
+                sizes = ", ".join(
+                    f"{out} {info['bytes'] / 1024:.1f} KB" + (" ⚠ over budget" if info["over_budget"] else "")
+                    for out, info in result["outputs"].items()
+                )
+                print(f"    ✓ {rel_path} ({result['seconds']:.1f} s): {sizes}")
+                manifest[rel_path] = {
+                    "source_hash": digests[rel_path],
+                    "targets": [list(t) for t in targets],
+                    "outputs": result["outputs"],
+                    "render_seconds": round(result["seconds"], 3),
+                    "rendered_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                n_converted += 1
+
+    # Forget PDFs that were deleted (not ones outside a --no-recursive scan)
+    for rel_path in set(manifest) - set(digests):
+        if not (fig_dir / rel_path).exists():
+            del manifest[rel_path]
+    save_manifest(manifest_file, manifest)
+
+    return n_converted, n_skipped, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert PDF figures to PNG/WebP (first page only)")
+    parser.add_argument("--fig-dir", default=str(FIG_DIR), help="Figure directory (default: output/figures)")
+    parser.add_argument("--target", action="append", type=parse_target, dest="targets",
+                        help="Output SUFFIX:DPI[:MAX_WIDTH[:FORMAT[:MAX_KB]]], repeatable; "
+                             "FORMAT is png, optpng or webp (default: ':600')")
+    parser.add_argument("--html", action="store_true",
+                        help="Also write a report-sized <name>_html.webp (150 DPI, ≤1600 px, ≤300 KB)")
+    parser.add_argument("--no-recursive", action="store_true", help="Only convert PDFs directly in --fig-dir")
+    parser.add_argument("--workers", type=int, help="Number of workers (default: CPU count)")
+    parser.add_argument("--executor", choices=("process", "thread"), default="process",
+                        help="Worker pool type (default: process)")
+    parser.add_argument("--force", action="store_true", help="Re-render even if unchanged")
+    args = parser.parse_args()
+
+    fig_dir = Path(args.fig_dir)
+    targets = list(args.targets or DEFAULT_TARGETS)
+    if args.html:
+        targets.append(parse_target("_html:150:1600:webp:300"))
+    duplicates = duplicate_outputs(targets)
+    if duplicates:
+        # png and optpng share the .png extension; give such targets distinct suffixes
+        parser.error(f"Several targets write <name>{', <name>'.join(duplicates)}; use distinct suffixes")
+    recursive = not args.no_recursive
+
+    if not fig_dir.exists():
+        print(f"ERROR: Figure directory not found: {fig_dir}")
+        sys.exit(1)
+
+    n_pdfs = len(find_pdfs(fig_dir, recursive))
+    if not n_pdfs:
+        print(f"No PDF files found in {fig_dir}")
+        sys.exit(0)
+
+    target_desc = ", ".join(
+        f"{suffix or '<name>'}{FORMATS[fmt]}@{dpi}dpi" + (f"≤{w}px" if w else "")
+        + (f"≤{b // 1024}KB" if b else "")
+        for suffix, dpi, w, fmt, b in targets
+    )
+    print(f"Found {n_pdfs} PDF file(s) to convert ({target_desc})...\n")
+
+    n_converted, n_skipped, failed = convert_figures(
+        fig_dir, targets, workers=args.workers, executor=args.executor,
+        force=args.force, recursive=recursive
+    )
+
+    print("=" * 50)
+    print(f"Conversion complete: {n_converted + n_skipped}/{n_pdfs} files converted successfully "
+          f"({n_converted} rendered, {n_skipped} cached)")
+    print(f"Manifest: {fig_dir / MANIFEST_FILENAME}")
 
-print("=" * 50)
-print(f"Conversion complete: {success_count}/{len(pdf_files)} files converted successfully")
+    if failed:
+        print("\n⚠️  Some files failed to convert.")
+        print("Make sure poppler is installed: brew install poppler")
+        sys.exit(1)
 
-if success_count < len(pdf_files):
-    print("\n⚠️  Some files failed to convert.")
-    print("Make sure poppler is installed: brew install poppler")
 
+if __name__ == "__main__":
+    main()
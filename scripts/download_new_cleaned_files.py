@@ -8,6 +8,9 @@ import os
 import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent / "utilities"))
+from plan_incremental_rebuild import detect_changes, plan_rebuild, print_plan
+
 try:
     import gdown
 except ImportError:
@@ -80,7 +83,7 @@ def download_folder_selective(folder_url, local_dir, existing_files):
         else:
             print("\nNo new files downloaded (all files already exist)")
         
-        return len(new_files)
+        return new_files
         
     except Exception as e:
         print(f"\nError downloading folder: {e}")
@@ -89,23 +92,34 @@ def download_folder_selective(folder_url, local_dir, existing_files):
         print(f"   {folder_url}")
         print("2. Use rclone (if configured):")
         print(f"   rclone copy gdrive:/{DRIVE_FOLDER_ID} {local_path} --drive-acknowledge-abuse")
-        return 0
+        return set()
 
 if __name__ == "__main__":
     # Get existing files
     existing = get_existing_files()
     
     # Download new files
-    new_count = download_folder_selective(DRIVE_FOLDER_URL, LOCAL_DIR, existing)
+    new_files = download_folder_selective(DRIVE_FOLDER_URL, LOCAL_DIR, existing)
+    new_count = len(new_files)
     
     if new_count > 0:
         print(f"\n✓ Successfully downloaded {new_count} new file(s)")
-        print(f"\nNext step: Run the MATLAB pipeline to process new files")
-        print("Then run: 01_data_preprocessing/r/Create merged flat file.R")
-    else:
+
+    # Plan from the rebuild planner's hash cache, so re-downloaded (changed)
+    # files and _logP.txt files count too, not just new .mat names
+    if LOCAL_DIR.exists():
+        raw_files, changed, removed = detect_changes(LOCAL_DIR)
+        plan = plan_rebuild(raw_files, changed, removed)
+        print()
+        print_plan(plan)
+        if plan['stages']:
+            print("\nRebuild these with the MATLAB pipeline and 01_data_preprocessing/r/Create merged flat file.R,")
+            print("or schedule them with: python scripts/utilities/plan_incremental_rebuild.py --execute --command KIND=TEMPLATE ...")
+            print("(or record an existing rebuild with: python scripts/utilities/plan_incremental_rebuild.py --mark-built)")
+    elif new_count == 0:
         print("\n✓ All files are up to date")
     
-    sys.exit(0 if new_count >= 0 else 1)
+    sys.exit(0)
 
 
 
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Vectorized trial-history features for serial-dependence models.
+
+Python counterpart of the arrange() + group_by() + lag() blocks in
+history_modeling.R. The trial table is sorted once by
+(subject, task, run, trial); every history segment (a run, or a whole
+subject x task when resets are off) is then a contiguous slice, and all
+variables are handled together as one matrix:
+
+    - lags of any depth: one shifted copy per lag, masked where the lag
+      would reach back past the segment start
+    - exponentially weighted histories (EWMA of previous trials only) for
+      several decay rates: one vectorized step per trial position across
+      all segments, variables and rates at once
+
+so sweeping several lag depths and decay rates costs about as much as a
+single lag did per variable in R.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+GROUP_COLS = ('subject_id', 'task')
+RUN_COL = 'run'
+TRIAL_COL = 'trial_index'
+DEFAULT_VARIABLES = ('choice_binary',)
+
+
+def sort_trials(df, group_cols=GROUP_COLS, run_col=RUN_COL, trial_col=TRIAL_COL):
+    """Stable sort by (group..., run, trial); the history functions expect this order"""
+    order = list(group_cols) + [c for c in (run_col, trial_col) if c]
+    return df.sort_values(order, kind='mergesort')
+
+
+def segment_positions(df, group_cols=GROUP_COLS, run_col=RUN_COL, reset_on_run=True):
+    """
+    Segment id and position within segment for a sorted trial table.
+
+    A new segment starts wherever a group column (or, with reset_on_run, the
+    run) changes from the previous row, so history never crosses a
+    subject/task boundary and optionally not a run boundary.
+
+    Returns:
+        (segment_id, position, starts) arrays; starts[s] is the first row of
+        segment s.
+    """
+    cols = list(group_cols) + ([run_col] if reset_on_run and run_col else [])
+    n = len(df)
+    boundary = np.zeros(n, dtype=bool)
+    if n:
+        boundary[0] = True
+    for col in cols:
+        codes = pd.factorize(df[col], use_na_sentinel=False)[0]
+        boundary[1:] |= codes[1:] != codes[:-1]
+    starts = np.flatnonzero(boundary)
+    segment_id = np.cumsum(boundary) - 1
+    position = np.arange(n) - starts[segment_id]
+    return segment_id, position, starts
+
+
+def lag_matrix(values, position, lags, fill_value=np.nan):
+    """
+    Lagged copies of a (n_trials x n_vars) matrix.
+
+    Returns an array of shape (len(lags), n_trials, n_vars) where
+    out[i, t] = values[t - lags[i]] if that trial is in the same segment,
+    else fill_value.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    out = np.full((len(lags),) + values.shape, fill_value, dtype=float)
+    for i, lag in enumerate(lags):
+        if lag <= 0:
+            raise ValueError("lags must be positive")
+        ok = np.flatnonzero(position >= lag)
+        out[i, ok] = values[ok - lag]
+    return out
+
+
+def ewma_matrix(values, segment_id, position, alphas, init=0.0):
+    """
+    Exponentially weighted history of previous trials, per segment.
+
+    h[t] = (1 - alpha) * h[t-1] + alpha * x[t-1], with h = init at the first
+    trial of each segment; a missing x[t-1] carries h[t-1] forward. Only
+    trials before t contribute, so the feature is safe as a predictor of
+    trial t.
+
+    Returns an array of shape (len(alphas), n_trials, n_vars).
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    alphas = np.asarray(alphas, dtype=float)
+    n_trials, n_vars = values.shape
+    out = np.full((len(alphas), n_trials, n_vars), np.nan)
+    if n_trials == 0 or len(alphas) == 0:
+        return out
+
+    # Padded (segments x positions x vars) layout; one step per position
+    n_segments = segment_id.max() + 1
+    max_len = position.max() + 1
+    padded = np.full((n_segments, max_len, n_vars), np.nan)
+    padded[segment_id, position] = values
+
+    a = alphas[:, None, None]
+    state = np.full((len(alphas), n_segments, n_vars), float(init))
+    history = np.empty((len(alphas), n_segments, max_len, n_vars))
+    for p in range(max_len):
+        history[:, :, p] = state
+        x = padded[None, :, p]
+        state = np.where(np.isnan(x), state, (1.0 - a) * state + a * x)
+
+    out[:] = history[:, segment_id, position]
+    return out
+
+
+def history_features(df, variables=DEFAULT_VARIABLES, lags=(1,), alphas=(), group_cols=GROUP_COLS,
+                     run_col=RUN_COL, trial_col=TRIAL_COL, reset_on_run=True, fill_value=np.nan,
+                     presorted=False):
+    """
+    Lag and EWMA history columns for many variables in one pass.
+
+    Args:
+        df: Trial table
+        variables: Columns to build histories for (numeric / boolean)
+        lags: Lag depths, e.g. (1, 2, 3) -> {var}_lag1, {var}_lag2, ...
+        alphas: EWMA decay rates, e.g. (0.5, 0.2) -> {var}_ewm0.5, ...
+        group_cols: History never crosses these (subject, task)
+        run_col / trial_col: Order within a group; run_col also drives resets
+        reset_on_run: Restart histories at each run. history_modeling.R
+            lags across runs within subject x task (reset_on_run=False).
+        fill_value: Value where a lag has no previous trial
+        presorted: Skip the sort when df is already in (group, run, trial) order
+
+    Returns:
+        DataFrame aligned to df.index with the history columns plus
+        trial_in_segment (0 = first trial after a reset).
+    """
+    variables = list(variables)
+    ordered = df if presorted else sort_trials(df, group_cols, run_col, trial_col)
+    segment_id, position, _ = segment_positions(ordered, group_cols, run_col, reset_on_run)
+    values = ordered[variables].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+    columns = {'trial_in_segment': position}
+    if lags:
+        lagged = lag_matrix(values, position, lags, fill_value)
+        for i, lag in enumerate(lags):
+            for j, var in enumerate(variables):
+                columns[f'{var}_lag{lag}'] = lagged[i, :, j]
+    if len(alphas):
+        smoothed = ewma_matrix(values, segment_id, position, alphas)
+        for i, alpha in enumerate(alphas):
+            for j, var in enumerate(variables):
+                columns[f'{var}_ewm{alpha:g}'] = smoothed[i, :, j]
+
+    features = pd.DataFrame(columns, index=ordered.index)
+    return features.reindex(df.index)
+
+
+def scale_binary(values):
+    """1 -> 1, 0 -> -1, anything else -> 0 (the prev_*_scaled coding)"""
+    values = np.asarray(values, dtype=float)
+    return np.select([values == 1, values == 0], [1.0, -1.0], default=0.0)
+
+
+def add_prev_columns(df, choice_col='choice_binary', outcome_col='choice_binary'):
+    """
+    prev_choice / prev_outcome and their -1/1 scaled versions, as history_modeling.R.
+
+    Lags run across runs within subject x task and missing history is 0.
+    """
+    variables = list(dict.fromkeys([choice_col, outcome_col]))
+    features = history_features(df, variables, lags=(1,), reset_on_run=False, fill_value=np.nan)
+    out = df.copy()
+    out['prev_choice'] = features[f'{choice_col}_lag1'].fillna(0)
+    out['prev_outcome'] = features[f'{outcome_col}_lag1'].fillna(0)
+    out['prev_choice_scaled'] = scale_binary(out['prev_choice'])
+    out['prev_outcome_scaled'] = scale_binary(out['prev_outcome'])
+    return out
+
+
+def simulate_serial_choices(n_subj, n_trials, history_weight=0.2, alpha=1.0, trials_per_run=30, seed=None):
+    """
+    Choice sequences with a true serial bias, simulated for all subjects at once.
+
+    Unlike the random prev_choice draw in power_sim_serial_bias.R, each choice
+    depends on the subject's own previous choices through an EWMA history
+    (alpha=1 is a pure lag-1 effect): p(choice=1) = logistic(bias + w * h),
+    with h coded -1/1 and reset at run boundaries.
+
+    Returns a trial table (subject_id, task, run, trial_index, choice_binary)
+    ready for history_features().
+    """
+    rng = np.random.default_rng(seed)
+    subject_bias = rng.normal(0.0, 0.3, n_subj)
+    choices = np.zeros((n_subj, n_trials))
+    state = np.zeros(n_subj)
+    for t in range(n_trials):
+        if t % trials_per_run == 0:
+            state[:] = 0.0
+        p = 1.0 / (1.0 + np.exp(-(subject_bias + history_weight * state)))
+        choices[:, t] = rng.random(n_subj) < p
+        state = (1.0 - alpha) * state + alpha * (2 * choices[:, t] - 1)
+
+    trial = np.tile(np.arange(n_trials), n_subj)
+    return pd.DataFrame({
+        'subject_id': np.repeat([f'SIM{i + 1:03d}' for i in range(n_subj)], n_trials),
+        'task': 'SIM',
+        'run': trial // trials_per_run + 1,
+        'trial_index': trial % trials_per_run + 1,
+        'choice_binary': choices.reshape(-1).astype(int),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add lag / EWMA trial-history features to a trial table")
+    parser.add_argument('input', help='Trial-level CSV')
+    parser.add_argument('--out', help='Output CSV (default: <input>_history.csv)')
+    parser.add_argument('--vars', nargs='+', default=list(DEFAULT_VARIABLES), help='Variables to build histories for')
+    parser.add_argument('--lags', nargs='+', type=int, default=[1], help='Lag depths (default: 1)')
+    parser.add_argument('--alphas', nargs='*', type=float, default=[], help='EWMA decay rates')
+    parser.add_argument('--group-cols', nargs='+', default=list(GROUP_COLS), help='History grouping columns')
+    parser.add_argument('--run-col', default=RUN_COL, help='Run column')
+    parser.add_argument('--trial-col', default=TRIAL_COL, help='Trial column')
+    parser.add_argument('--no-run-reset', action='store_true',
+                        help='Let histories cross runs (as history_modeling.R does)')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, low_memory=False)
+    features = history_features(df, args.vars, args.lags, args.alphas, args.group_cols,
+                                args.run_col, args.trial_col, reset_on_run=not args.no_run_reset)
+    out = pd.concat([df, features], axis=1)
+
+    out_path = args.out or args.input.rsplit('.', 1)[0] + '_history.csv'
+    out.to_csv(out_path, index=False)
+    print(f"Added {features.shape[1] - 1} history columns for {len(out)} trials")
+    for col in features.columns[1:]:
+        print(f"  {col}: {features[col].notna().mean() * 100:.1f}% available")
+    print(f"Saved to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+PSIS-LOO model comparison over memory-mapped log-likelihood matrices.
+
+Python counterpart of the loo() / loo_compare() steps in compare_models.R and
+difficulty_mapping_loo.R. Each model's draws x observations log-likelihood
+matrix is opened as a memory-mapped .npy file and processed in column chunks
+on a thread pool, so only (workers x chunk) columns are ever resident no
+matter how many trials or models are compared.
+
+Export the matrices from R once per fit, e.g.
+
+    RcppCNPy::npySave("models/ddm_base_loglik.npy", log_lik(fit_base))
+
+The smoothing follows the loo package (Vehtari, Gelman & Gabry 2017;
+Vehtari et al. 2024): tail length ceil(min(0.2 S, 3 sqrt(S / r_eff))),
+generalized Pareto fit by Zhang & Stephens (2009) with the weakly informative
+prior on k, truncation at the largest raw weight.
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import logsumexp, softmax
+
+DEFAULT_MEMORY_BUDGET_MB = 512
+KHAT_BREAKS = (0.5, 0.7, 1.0)
+
+
+def open_loglik(path):
+    """Memory-mapped (draws x observations) log-likelihood matrix"""
+    matrix = np.load(path, mmap_mode='r')
+    if matrix.ndim != 2:
+        raise ValueError(f"{path}: expected a 2-D draws x observations matrix, got shape {matrix.shape}")
+    return matrix
+
+
+def tail_length(n_draws, r_eff=1.0):
+    """Number of draws in the Pareto-smoothed tail"""
+    return int(np.ceil(min(0.2 * n_draws, 3.0 * np.sqrt(n_draws / r_eff))))
+
+
+def khat_threshold(n_draws):
+    """Sample-size dependent k-hat threshold for reliable estimates"""
+    return min(1.0 - 1.0 / np.log10(n_draws), 0.7)
+
+
+def gpd_fit(x, min_grid_pts=30, prior=3.0):
+    """
+    Generalized Pareto fit for every column of x (sorted ascending along axis 0).
+
+    Zhang & Stephens (2009) profile-likelihood grid estimate with the
+    weakly informative prior on k used by the loo package.
+
+    Returns (k, sigma) arrays of length x.shape[1].
+    """
+    n = x.shape[0]
+    n_grid = min_grid_pts + int(np.floor(np.sqrt(n)))
+    jj = np.arange(1, n_grid + 1)[:, None]
+    xstar = x[int(np.floor(n / 4 + 0.5)) - 1]
+    theta = 1.0 / x[-1] + (1.0 - np.sqrt(n_grid / (jj - 0.5))) / prior / xstar
+
+    l_theta = np.empty_like(theta)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for j in range(n_grid):
+            k_j = np.mean(np.log1p(-theta[j] * x), axis=0)
+            l_theta[j] = n * (np.log(-theta[j] / k_j) - k_j - 1.0)
+        weights = np.exp(l_theta - logsumexp(l_theta, axis=0))
+        theta_hat = np.nansum(theta * weights, axis=0)
+        k = np.mean(np.log1p(-theta_hat * x), axis=0)
+        sigma = -k / theta_hat
+    k = (k * n + 0.5 * 10) / (n + 10)
+    return np.where(np.isnan(k), np.inf, k), sigma
+
+
+def psis_log_weights(log_ratios, r_eff=1.0):
+    """
+    Pareto-smoothed log importance weights for a (draws x columns) block.
+
+    Returns (log_weights normalized per column, k_hat per column).
+    """
+    lr = np.asarray(log_ratios, dtype=float)
+    n_draws, n_cols = lr.shape
+    lw = lr - lr.max(axis=0)
+    k_hat = np.full(n_cols, np.inf)
+
+    m = tail_length(n_draws, r_eff)
+    if m >= 5:
+        order = np.argsort(lw, axis=0, kind='stable')
+        tail_idx = order[-m:]
+        tail = np.take_along_axis(lw, tail_idx, axis=0)
+        cutoff = np.take_along_axis(lw, order[-m - 1:-m], axis=0)[0]
+        fit_ok = np.abs(tail[-1] - tail[0]) >= np.finfo(float).eps / 100
+
+        exp_cutoff = np.exp(cutoff)
+        k, sigma = gpd_fit(np.exp(tail) - exp_cutoff)
+        smooth = fit_ok & np.isfinite(k)
+        if smooth.any():
+            p = ((np.arange(1, m + 1) - 0.5) / m)[:, None]
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+                q = sigma * np.expm1(-k * np.log1p(-p)) / k + exp_cutoff
+                smoothed = np.log(q)
+            tail = np.where(smooth, smoothed, tail)
+            np.put_along_axis(lw, tail_idx, tail, axis=0)
+        k_hat = np.where(fit_ok, k, np.inf)
+
+    # Truncate at the largest raw weight, then normalize
+    lw = np.minimum(lw, 0.0)
+    lw -= logsumexp(lw, axis=0)
+    return lw, k_hat
+
+
+def _loo_chunk(loglik, start, stop, r_eff):
+    """Pointwise elpd_loo, p_loo and k_hat for columns [start, stop)"""
+    block = np.asarray(loglik[:, start:stop], dtype=float)
+    lw, k_hat = psis_log_weights(-block, r_eff)
+    elpd = logsumexp(lw + block, axis=0)
+    lpd = logsumexp(block, axis=0) - np.log(block.shape[0])
+    return start, elpd, lpd - elpd, k_hat
+
+
+def chunk_columns(n_draws, workers, memory_budget_mb):
+    """Columns per chunk so that all in-flight chunks fit the memory budget"""
+    # Per column: the block, log weights, sort order, tail work arrays (~6 float64 copies)
+    per_column = n_draws * 8 * 6
+    return max(1, int(memory_budget_mb * 2 ** 20 // (per_column * max(workers, 1))))
+
+
+def psis_loo(loglik, r_eff=1.0, workers=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    PSIS-LOO for one model.
+
+    Args:
+        loglik: (draws x observations) array or memmap
+        r_eff: Relative efficiency of the draws (1 = independent draws)
+        workers: Threads (numpy releases the GIL for the heavy work)
+        memory_budget_mb: Upper bound on resident chunk data
+
+    Returns:
+        dict with estimates (elpd_loo, se_elpd_loo, p_loo, se_p_loo, looic,
+        se_looic) and pointwise arrays elpd_loo_i, p_loo_i, k_hat.
+    """
+    n_draws, n_obs = loglik.shape
+    workers = workers or os.cpu_count() or 1
+    size = chunk_columns(n_draws, workers, memory_budget_mb)
+
+    elpd_i = np.empty(n_obs)
+    p_i = np.empty(n_obs)
+    k_hat = np.empty(n_obs)
+    bounds = [(start, min(start + size, n_obs)) for start in range(0, n_obs, size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Bounded submission keeps at most `workers` chunks in memory
+        pending = []
+        for start, stop in bounds:
+            pending.append(pool.submit(_loo_chunk, loglik, start, stop, r_eff))
+            if len(pending) >= workers:
+                _collect(pending.pop(0), elpd_i, p_i, k_hat)
+        for future in pending:
+            _collect(future, elpd_i, p_i, k_hat)
+
+    # Sample variance of the pointwise values (ddof=1), as in loo and ArviZ
+    se = lambda x: np.sqrt(n_obs * np.var(x, ddof=1))  # noqa: E731
+    elpd = elpd_i.sum()
+    return {
+        'elpd_loo': elpd,
+        'se_elpd_loo': se(elpd_i),
+        'p_loo': p_i.sum(),
+        'se_p_loo': se(p_i),
+        'looic': -2 * elpd,
+        'se_looic': 2 * se(elpd_i),
+        'n_draws': n_draws,
+        'n_obs': n_obs,
+        'elpd_loo_i': elpd_i,
+        'p_loo_i': p_i,
+        'k_hat': k_hat,
+    }
+
+
+def _collect(future, elpd_i, p_i, k_hat):
+    start, elpd, p, k = future.result()
+    stop = start + len(elpd)
+    elpd_i[start:stop] = elpd
+    p_i[start:stop] = p
+    k_hat[start:stop] = k
+
+
+def khat_summary(k_hat, n_draws):
+    """Counts of observations per k-hat range and above the reliability threshold"""
+    edges = (-np.inf,) + KHAT_BREAKS + (np.inf,)
+    labels = ['k<=0.5', '0.5<k<=0.7', '0.7<k<=1', 'k>1']
+    counts = {label: int(((k_hat > lo) & (k_hat <= hi)).sum()) for label, lo, hi in zip(labels, edges[:-1], edges[1:])}
+    counts['n_khat_bad'] = int((k_hat > khat_threshold(n_draws)).sum())
+    return counts
+
+
+def stacking_weights(elpd_pointwise):
+    """Stacking weights maximizing sum_i log sum_k w_k exp(elpd_ik)"""
+    lp = np.column_stack(elpd_pointwise)
+    n_models = lp.shape[1]
+
+    def objective(z):
+        w = softmax(np.r_[z, 0.0])
+        return -logsumexp(lp + np.log(np.maximum(w, 1e-300)), axis=1).sum()
+
+    result = minimize(objective, np.zeros(n_models - 1), method='BFGS')
+    return softmax(np.r_[result.x, 0.0])
+
+
+def compare(results):
+    """
+    loo_compare()-style table sorted by elpd, with pseudo-BMA and stacking weights.
+
+    elpd_diff / se_diff are relative to the best model, from pointwise
+    differences.
+    """
+    names = list(results)
+    elpd = np.array([results[n]['elpd_loo'] for n in names])
+    best = names[int(np.argmax(elpd))]
+    n_obs = len(results[best]['elpd_loo_i'])
+
+    weights_stack = stacking_weights([results[n]['elpd_loo_i'] for n in names]) if len(names) > 1 else np.ones(1)
+    weights_pbma = softmax(elpd)
+
+    rows = []
+    for i, name in enumerate(names):
+        r = results[name]
+        diff = r['elpd_loo_i'] - results[best]['elpd_loo_i']
+        row = {
+            'model': name,
+            'elpd': r['elpd_loo'],
+            'se': r['se_elpd_loo'],
+            'p_loo': r['p_loo'],
+            'looic': r['looic'],
+            'weight_stack': weights_stack[i],
+            'weight_pbma': weights_pbma[i],
+            'elpd_diff_from_best': diff.sum(),
+            'se_diff': np.sqrt(n_obs * np.var(diff, ddof=1)),
+        }
+        row.update(khat_summary(r['k_hat'], r['n_draws']))
+        rows.append(row)
+    return pd.DataFrame(rows).sort_values('elpd', ascending=False, ignore_index=True)
+
+
+def parse_models(specs):
+    """['name=path.npy', 'path.npy'] -> {name: path}"""
+    models = {}
+    for spec in specs:
+        name, sep, path = spec.partition('=')
+        if not sep:
+            path = spec
+            name = os.path.splitext(os.path.basename(spec))[0].removesuffix('_loglik')
+        models[name] = path
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PSIS-LOO comparison of memory-mapped log-likelihood matrices")
+    parser.add_argument('models', nargs='+', help='NAME=path.npy (draws x observations) per model')
+    parser.add_argument('--r-eff', type=float, default=1.0, help='Relative efficiency of the draws (default: 1)')
+    parser.add_argument('--workers', type=int, help='Worker threads')
+    parser.add_argument('--memory-mb', type=float, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help=f'Memory budget for resident chunks (default: {DEFAULT_MEMORY_BUDGET_MB})')
+    parser.add_argument('--out', default='output/modelcomp/loo_compare.csv', help='Comparison table CSV')
+    parser.add_argument('--pointwise', help='Write pointwise elpd_loo / k_hat per model to this CSV')
+    args = parser.parse_args()
+
+    models = parse_models(args.models)
+    results = {}
+    n_obs = None
+    for name, path in models.items():
+        if not os.path.exists(path):
+            print(f"❌ {name}: file not found: {path}")
+            sys.exit(1)
+        loglik = open_loglik(path)
+        if n_obs is not None and loglik.shape[1] != n_obs:
+            print(f"❌ {name}: {loglik.shape[1]} observations, expected {n_obs} (models must share data)")
+            sys.exit(1)
+        n_obs = loglik.shape[1]
+
+        print(f"Computing LOO for {name} ({loglik.shape[0]} draws x {n_obs} observations)...")
+        results[name] = psis_loo(loglik, args.r_eff, args.workers, args.memory_mb)
+        r = results[name]
+        k = khat_summary(r['k_hat'], r['n_draws'])
+        flag = '✓' if k['n_khat_bad'] == 0 else '⚠'
+        print(f"  {flag} elpd = {r['elpd_loo']:.2f}, SE = {r['se_elpd_loo']:.2f}, p_loo = {r['p_loo']:.1f}, "
+              f"k-hat > {khat_threshold(r['n_draws']):.2f}: {k['n_khat_bad']}")
+
+    table = compare(results)
+    print("\nModel comparison:")
+    print(table[['model', 'elpd_diff_from_best', 'se_diff', 'elpd', 'se', 'p_loo', 'weight_stack', 'weight_pbma']]
+          .to_string(index=False, float_format=lambda x: f'{x:.2f}'))
+
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    table.to_csv(args.out, index=False)
+    print(f"\n✓ LOO results saved to: {args.out}")
+
+    if args.pointwise:
+        pointwise = pd.DataFrame({'obs': np.arange(n_obs)})
+        for name, r in results.items():
+            pointwise[f'{name}_elpd_loo'] = r['elpd_loo_i']
+            pointwise[f'{name}_k_hat'] = r['k_hat']
+        pointwise.to_csv(args.pointwise, index=False)
+        print(f"✓ Pointwise values saved to: {args.pointwise}")
+
+
+if __name__ == "__main__":
+    main()
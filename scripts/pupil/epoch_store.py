@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Target-locked epoch tensors, memory-mapped per subject and task.
+
+Builds, once, for every (sub, task) in a set of flat files:
+
+    <store>/<sub>_<task>/epochs.npy    float32 (trials x time), NaN-padded,
+                                       on a fixed grid relative to target onset
+    <store>/<sub>_<task>/trials.csv    one row of trial keys / conditions per
+                                       tensor row (row order = tensor order)
+    <store>/<sub>_<task>/grid.json     fs, grid start, n_times, source files
+
+Samples are placed by their position within the trial, as in
+trial_matrix_from_flat() (t = TRIAL_START_REL + i / fs relative to squeeze
+onset), then shifted to the target-locked grid using the trial's
+target_onset column if present, otherwise TARGET_ONSET_DEFAULT.
+
+Trials are stored sorted by SORT_KEYS, so the usual condition filters
+(grip, oddball, level) select contiguous row blocks. EpochSet.select()
+then returns NumPy views into the memory map (no copy, no read until the
+pages are touched); time windows are column slices, which are views too.
+
+Usage:
+    python epoch_store.py BAP*_flat.csv --store data/epochs
+"""
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from window_features import FS_TARGET, TARGET_ONSET_DEFAULT, TRIAL_KEYS, TRIAL_START_REL
+
+# Target-locked grid: the whole trial (-3 s baseline to 10.7 s after squeeze onset)
+GRID_START = TRIAL_START_REL - TARGET_ONSET_DEFAULT
+GRID_END = 10.7 - TARGET_ONSET_DEFAULT
+
+# Trial order inside a tensor; conditions first so filters hit contiguous blocks
+SORT_KEYS = ['isStrength', 'isOddball', 'stimLev', 'session_used', 'run_used', 'trial_index']
+
+# Columns that vary within a trial and are not carried into the trial index
+SAMPLE_COLUMNS = {'pupil', 'time', 'time_ptb', 'trial_pupilTime', 'time_sec', 'pupilSize',
+                  'trial_label', 'duration_index', 'phase', 'label', 'time_rel', 't_rel', 't_from_target'}
+
+# Column name alternatives, as in window_features.main()
+COLUMN_ALTERNATIVES = {
+    'session_used': ['session_used', 'ses', 'session'],
+    'run_used': ['run_used', 'run'],
+    'pupil': ['pupil', 'pupilSize', 'pupil_diameter'],
+}
+
+
+def grid_times(fs=FS_TARGET, start=GRID_START, end=GRID_END):
+    """Time points of the fixed grid (s from target onset)"""
+    return start + np.arange(int(round((end - start) * fs)) + 1) / fs
+
+
+def standardize_columns(df):
+    """Add canonical session_used / run_used / pupil columns from their alternatives"""
+    for target, candidates in COLUMN_ALTERNATIVES.items():
+        if target not in df.columns:
+            source = next((c for c in candidates if c in df.columns), None)
+            if source is not None:
+                df[target] = df[source]
+    return df
+
+
+def epoch_tensor(df, fs=FS_TARGET, start=GRID_START, end=GRID_END):
+    """
+    (trial table, float32 trials x time tensor) for one subject / task.
+
+    Rows are sorted by the SORT_KEYS present in the data.
+    """
+    keys = [k for k in TRIAL_KEYS if k in df.columns]
+    df = df.sort_values(keys + (['time'] if 'time' in df.columns else []), kind='mergesort')
+    grouped = df.groupby(keys, sort=False, observed=True)
+    trial_id = grouped.ngroup().to_numpy()
+    position = grouped.cumcount().to_numpy()
+
+    first_rows = np.unique(trial_id, return_index=True)[1]
+    meta_cols = [c for c in df.columns if c not in SAMPLE_COLUMNS]
+    trials = df.iloc[first_rows][meta_cols].reset_index(drop=True)
+    onset = (pd.to_numeric(trials['target_onset'], errors='coerce').fillna(TARGET_ONSET_DEFAULT).to_numpy()
+             if 'target_onset' in trials else np.full(len(trials), TARGET_ONSET_DEFAULT))
+
+    times = grid_times(fs, start, end)
+    t_from_target = TRIAL_START_REL + position / fs - onset[trial_id]
+    column = np.rint((t_from_target - start) * fs).astype(np.int64)
+    keep = (column >= 0) & (column < len(times))
+
+    tensor = np.full((len(trials), len(times)), np.nan, dtype=np.float32)
+    pupil = pd.to_numeric(df['pupil'], errors='coerce').to_numpy(dtype=np.float32)
+    tensor[trial_id[keep], column[keep]] = pupil[keep]
+
+    sort_keys = [k for k in SORT_KEYS if k in trials.columns]
+    order = np.lexsort([trials[k].to_numpy() for k in reversed(sort_keys)]) if sort_keys else np.arange(len(trials))
+    trials = trials.iloc[order].reset_index(drop=True)
+    tensor = tensor[order]
+
+    valid = np.isfinite(tensor)
+    trials['n_valid'] = valid.sum(axis=1)
+    trials['coverage'] = trials['n_valid'] / tensor.shape[1]
+    return trials, tensor
+
+
+def write_epoch_set(directory, trials, tensor, fs, start, sources=()):
+    """Write one epoch set atomically (into a temp directory, then renamed)"""
+    tmp_dir = directory + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    out = np.lib.format.open_memmap(os.path.join(tmp_dir, 'epochs.npy'), mode='w+',
+                                    dtype=np.float32, shape=tensor.shape)
+    out[...] = tensor
+    out.flush()
+    del out
+    trials.to_csv(os.path.join(tmp_dir, 'trials.csv'), index=False)
+    with open(os.path.join(tmp_dir, 'grid.json'), 'w') as f:
+        json.dump({'fs': fs, 'start': start, 'n_times': tensor.shape[1], 'n_trials': tensor.shape[0],
+                   'sort_keys': [k for k in SORT_KEYS if k in trials.columns],
+                   'sources': [os.path.basename(s) for s in sources]}, f, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+
+
+def _read_flat(path, columns=None):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, low_memory=False)
+
+
+def _file_groups(path):
+    """(sub, task) pairs in one flat file, reading only those two columns"""
+    keys = _read_flat(path, ['sub', 'task']).drop_duplicates()
+    return path, [(str(sub), str(task)) for sub, task in keys.itertuples(index=False)]
+
+
+def _build_group(store, sub, task, sources, fs, start, end):
+    """Read only this group's files (and rows), then build and write its epoch set"""
+    frames = []
+    for path in sources:
+        df = standardize_columns(_read_flat(path))
+        frames.append(df[(df['sub'].astype(str) == sub) & (df['task'].astype(str) == task)])
+    trials, tensor = epoch_tensor(pd.concat(frames, ignore_index=True), fs, start, end)
+    write_epoch_set(os.path.join(store, f'{sub}_{task}'), trials, tensor, fs, start, sources)
+    return sub, task, tensor.shape
+
+
+def build_store(flat_files, store, fs=FS_TARGET, start=GRID_START, end=GRID_END, workers=None):
+    """
+    Build epoch sets for every (sub, task) found in the flat files.
+
+    Files are first mapped to the (sub, task) groups they contain (reading
+    only those columns); each worker then reads just its group's files, so
+    memory holds one subject / task at a time per worker, not the cohort.
+
+    Returns:
+        list of (sub, task, tensor shape)
+    """
+    os.makedirs(store, exist_ok=True)
+    sources = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, keys in pool.map(_file_groups, flat_files):
+            for key in keys:
+                sources.setdefault(key, []).append(path)
+
+        futures = [pool.submit(_build_group, store, sub, task, paths, fs, start, end)
+                   for (sub, task), paths in sorted(sources.items())]
+        return [future.result() for future in futures]
+
+
+class EpochSet:
+    """
+    One subject / task: memory-mapped tensor plus its trial index.
+
+    Attributes:
+        data: np.memmap (trials x time), read-only
+        trials: DataFrame, row i describes data[i]
+        times: grid time points (s from target onset)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'grid.json')) as f:
+            self.grid = json.load(f)
+        self.data = np.load(os.path.join(directory, 'epochs.npy'), mmap_mode='r')
+        self.trials = pd.read_csv(os.path.join(directory, 'trials.csv'), low_memory=False)
+        self.fs = self.grid['fs']
+        self.times = self.grid['start'] + np.arange(self.data.shape[1]) / self.fs
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def columns(self, window=None):
+        """Column slice for a (start, end) window in s from target onset (inclusive)"""
+        if window is None:
+            return slice(None)
+        lo = int(np.ceil((window[0] - self.grid['start']) * self.fs - 1e-9))
+        hi = int(np.floor((window[1] - self.grid['start']) * self.fs + 1e-9)) + 1
+        return slice(max(lo, 0), min(hi, self.data.shape[1]))
+
+    def mask(self, **conditions):
+        """Boolean trial mask; values may be scalars or lists of accepted values"""
+        keep = np.ones(len(self.trials), dtype=bool)
+        for col, value in conditions.items():
+            values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+            keep &= self.trials[col].isin(values).to_numpy()
+        return keep
+
+    def blocks(self, window=None, **conditions):
+        """
+        Zero-copy views for the trials matching the conditions.
+
+        Yields (trial index rows, view) per contiguous run of matching rows.
+        """
+        keep = self.mask(**conditions)
+        cols = self.columns(window)
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], keep.astype(np.int8), [0]])))
+        for lo, hi in zip(edges[::2], edges[1::2]):
+            yield self.trials.iloc[lo:hi], self.data[lo:hi, cols]
+
+    def select(self, window=None, **conditions):
+        """
+        (trial index rows, trials x time array) for the matching trials.
+
+        A view into the memory map when the matching rows are contiguous
+        (any filter on a prefix of the sort keys), otherwise a copy.
+        """
+        parts = list(self.blocks(window, **conditions))
+        if not parts:
+            return self.trials.iloc[:0], self.data[:0, self.columns(window)]
+        if len(parts) == 1:
+            return parts[0]
+        return (pd.concat([p[0] for p in parts]),
+                np.concatenate([p[1] for p in parts]))
+
+
+class EpochStore:
+    """All epoch sets under a store directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def keys(self):
+        """(sub, task) of every epoch set"""
+        keys = []
+        for name in sorted(os.listdir(self.root)):
+            if os.path.exists(os.path.join(self.root, name, 'grid.json')):
+                sub, _, task = name.rpartition('_')
+                keys.append((sub, task))
+        return keys
+
+    def open(self, sub, task):
+        return EpochSet(os.path.join(self.root, f'{sub}_{task}'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build memory-mapped target-locked epoch tensors")
+    parser.add_argument('flat_files', nargs='+', help='Sample-level flat files (CSV or parquet)')
+    parser.add_argument('--store', required=True, help='Output store directory')
+    parser.add_argument('--start', type=float, default=GRID_START, help='Grid start (s from target)')
+    parser.add_argument('--end', type=float, default=GRID_END, help='Grid end (s from target)')
+    parser.add_argument('--workers', type=int, help='Worker processes')
+    args = parser.parse_args()
+
+    results = build_store(args.flat_files, args.store, FS_TARGET, args.start, args.end, args.workers)
+    for sub, task, shape in results:
+        print(f"  ✓ {sub} {task}: {shape[0]} trials x {shape[1]} samples")
+    print(f"✓ {len(results)} epoch sets saved to: {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Batched phasic features for all trials at once.
+
+Python counterpart of the per-trial lm() in compute_phasic_features_from_flat.R
+and the peak search in ch3_window_selection_v3.R. Every feature is computed
+from a NaN-padded (trials x samples) matrix with boolean masks instead of a
+group_by/summarise per trial:
+
+    - masked least-squares slope (and intercept) within a window
+    - peak amplitude and latency within a search window
+    - time to half peak (from target onset, first sample reaching half the
+      peak before it)
+"""
+
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from window_features import (B1_WIN, FS_TARGET, TARGET_ONSET_DEFAULT, TRIAL_KEYS,
+                             TRIAL_START_REL, trial_matrix_from_flat)
+
+SLOPE_WINDOW = (0.2, 0.9)  # 200-900 ms phasic window (s from target)
+PEAK_WINDOW = (0.3, 3.3)  # Peak search window (s from target)
+MIN_SLOPE_SAMPLES = 5  # lm() was skipped below this in the R script
+
+
+def time_from_target(n_trials, n_samples, fs=FS_TARGET, t0=TRIAL_START_REL, target_onset=TARGET_ONSET_DEFAULT):
+    """(trials x samples) time relative to each trial's target onset"""
+    onset = np.broadcast_to(np.asarray(target_onset, dtype=float), (n_trials,))
+    t_grid = t0 + np.arange(n_samples) / fs
+    return t_grid[None, :] - onset[:, None]
+
+
+def window_mask(t, window):
+    """Inclusive window mask (t >= start & t <= end)"""
+    return (t >= window[0] - 1e-9) & (t <= window[1] + 1e-9)
+
+
+def window_columns(t, window):
+    """
+    Column slice covering a window in any trial.
+
+    Windows span a small part of the trial, so restricting the work to these
+    columns keeps cohort-wide extraction well under a second.
+    """
+    hit = np.flatnonzero(window_mask(t, window).any(axis=0))
+    if hit.size == 0:
+        return slice(0, 0)
+    return slice(hit[0], hit[-1] + 1)
+
+
+def masked_slopes(y, t, mask=None, min_samples=MIN_SLOPE_SAMPLES):
+    """
+    OLS slope and intercept of y on t per row, using only masked valid samples.
+
+    Args:
+        y: (trials x samples) values, NaN = invalid
+        t: (samples,) or (trials x samples) predictor
+        mask: Optional boolean (trials x samples) selection
+        min_samples: Rows with fewer usable samples get NaN
+
+    Returns:
+        (slope, intercept, n) arrays of length n_trials
+    """
+    y = np.asarray(y, dtype=float)
+    t = np.broadcast_to(np.asarray(t, dtype=float), y.shape)
+    use = np.isfinite(y) & np.isfinite(t)
+    if mask is not None:
+        use &= mask
+
+    w = use.astype(float)
+    n = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = (w * np.where(use, t, 0.0)).sum(axis=1) / n
+        y_mean = (w * np.where(use, y, 0.0)).sum(axis=1) / n
+        dt = np.where(use, t - t_mean[:, None], 0.0)
+        dy = np.where(use, y - y_mean[:, None], 0.0)
+        sxx = (dt * dt).sum(axis=1)
+        sxy = (dt * dy).sum(axis=1)
+        slope = np.where((n >= min_samples) & (sxx > 0), sxy / sxx, np.nan)
+    intercept = y_mean - slope * t_mean
+    return slope, intercept, n.astype(np.int64)
+
+
+def peak_features(y, t, window=PEAK_WINDOW):
+    """
+    Peak amplitude, latency and time to half peak per row.
+
+    Args:
+        y: (trials x samples) baseline-corrected values, NaN = invalid
+        t: (trials x samples) time relative to target onset
+        window: (start, end) peak search window in the units of t
+
+    Returns:
+        dict of arrays: peak_amplitude, peak_latency, time_to_half_peak.
+        Latencies are measured from target onset (t = 0), not from the start
+        of the search window. Rows without valid samples in the window are
+        NaN. Time to half peak is NaN when the peak is not positive.
+    """
+    y = np.asarray(y, dtype=float)
+    in_window = window_mask(t, window) & np.isfinite(y)
+    has_data = in_window.any(axis=1)
+    rows = np.arange(y.shape[0])
+
+    search = np.where(in_window, y, -np.inf)
+    peak_idx = search.argmax(axis=1)
+    peak_amplitude = np.where(has_data, search[rows, peak_idx], np.nan)
+    peak_latency = np.where(has_data, t[rows, peak_idx], np.nan)
+
+    # First in-window sample before the peak that reaches half the peak
+    columns = np.arange(y.shape[1])[None, :]
+    with np.errstate(invalid='ignore'):
+        reached = in_window & (columns <= peak_idx[:, None]) & (y >= 0.5 * peak_amplitude[:, None])
+    half_idx = reached.argmax(axis=1)
+    half_ok = has_data & reached[rows, half_idx] & (peak_amplitude > 0)
+    time_to_half_peak = np.where(half_ok, t[rows, half_idx], np.nan)
+
+    return {
+        'peak_amplitude': peak_amplitude,
+        'peak_latency': peak_latency,
+        'time_to_half_peak': time_to_half_peak,
+    }
+
+
+def phasic_features(pupil, fs=FS_TARGET, t0=TRIAL_START_REL, target_onset=TARGET_ONSET_DEFAULT,
+                    slope_window=SLOPE_WINDOW, peak_window=PEAK_WINDOW, baseline=B1_WIN):
+    """
+    All phasic features for a (trials x samples) matrix in one pass.
+
+    Slopes are returned per millisecond (phasic_slope), the unit of
+    compute_phasic_features_from_flat.R, which regressed on time_ms.
+    Peaks are measured on the baseline-corrected trace (baseline window
+    relative to target onset; None for raw values).
+    """
+    pupil = np.asarray(pupil, dtype=float)
+    t = time_from_target(*pupil.shape, fs=fs, t0=t0, target_onset=target_onset)
+
+    cols = window_columns(t, slope_window)
+    slope_mask = window_mask(t[:, cols], slope_window)
+    slope, _, n_samples = masked_slopes(pupil[:, cols], t[:, cols], slope_mask)
+    with np.errstate(invalid='ignore'):
+        phasic_mean = np.nanmean(np.where(slope_mask, pupil[:, cols], np.nan), axis=1)
+
+    cols = window_columns(t, peak_window)
+    corrected = pupil[:, cols]
+    baseline_mean = np.full(pupil.shape[0], np.nan)
+    if baseline is not None:
+        b_cols = window_columns(t, baseline)
+        with np.errstate(invalid='ignore'):
+            baseline_mean = np.nanmean(
+                np.where(window_mask(t[:, b_cols], baseline), pupil[:, b_cols], np.nan), axis=1
+            )
+        corrected = corrected - baseline_mean[:, None]
+
+    features = {
+        'n_samples': n_samples,
+        'phasic_slope': slope / 1000.0,
+        'phasic_mean': phasic_mean,
+        'baseline_mean': baseline_mean,
+    }
+    features.update(peak_features(corrected, t[:, cols], peak_window))
+    return features
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched phasic slope / peak features from flat pupil files")
+    parser.add_argument('flat_files', nargs='+', help='Sample-level flat CSV files')
+    parser.add_argument('--out', default='phasic_features.csv', help='Output CSV')
+    args = parser.parse_args()
+
+    frames = []
+    for path in args.flat_files:
+        df = pd.read_csv(path, low_memory=False)
+        # Fill session_used / run_used from ses / run only where missing
+        for target, candidates in {'session_used': ['ses', 'session'], 'run_used': ['run']}.items():
+            source = next((c for c in candidates if c in df.columns), None)
+            if target not in df.columns and source is not None:
+                df[target] = df[source]
+        frames.append(df)
+    samples = pd.concat(frames, ignore_index=True)
+
+    trial_table, matrix = trial_matrix_from_flat(samples, TRIAL_KEYS)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN windows
+        features = phasic_features(matrix)
+
+    out = trial_table.copy()
+    for name, values in features.items():
+        out[name] = values
+    # Standardize phasic slope within subject, as in the R script
+    grouped = out.groupby('sub')['phasic_slope']
+    out['phasic_slope_z'] = (out['phasic_slope'] - grouped.transform('mean')) / grouped.transform('std')
+
+    out.to_csv(args.out, index=False)
+    print(f"Computed phasic features for {len(out)} trials")
+    print(f"  Phasic slope (200-900ms) computed for {out['phasic_slope'].notna().sum()} trials")
+    print(f"  Data saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
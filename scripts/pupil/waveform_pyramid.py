@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Multi-resolution waveform pyramid for plotting at any zoom.
+
+Each level reduces the one below it by block factor 5, as
+generate_waveform_summaries.R does for 250 -> 50 Hz, but with block means
+(over valid samples) and min / max envelopes instead of every fifth row:
+
+    250 Hz    samples (the epoch tensor itself, or stored for runs)
+     50 Hz    mean / min / max / n_valid per 5-sample block
+     10 Hz    mean / min / max / n_valid per 25-sample block
+
+Coarser levels are computed from the finer level (count-weighted means,
+min of mins, max of maxes), so each level costs one pass over the level
+below. Pyramids are built for:
+
+    epochs   <store>/<sub>_<task>/pyramid.npz next to an epoch_store.py set,
+             one row per tensor row
+    runs     <output>/<sub>_<task>_ses<S>_run<R>_pyramid.npz, one row per run,
+             samples placed on a regular grid from the run's first sample
+             by an absolute clock (time_ptb, trial_start_time_ptb + time, or
+             an absolute time column); trial-relative input is rejected
+
+Pyramid.fetch(width_px) returns the coarsest level that still has at least
+one point per pixel over the requested window, so plotting hundreds of
+traces reads a few KB each instead of the full-rate data.
+
+Usage:
+    python waveform_pyramid.py --epoch-store data/epochs
+    python waveform_pyramid.py --flat-files BAP*_flat.csv --output data/pyramids
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from epoch_store import COLUMN_ALTERNATIVES, EpochSet, standardize_columns
+from window_features import FS_TARGET
+
+FACTORS = (5, 5)  # 250 -> 50 -> 10 Hz
+RUN_KEYS = ['sub', 'task', 'session_used', 'run_used']
+# Absolute clocks for run traces, in order of preference; MATLAB flat files
+# store time relative to each trial's squeeze onset plus trial_start_time_ptb
+CLOCK_COLUMNS = ['time_ptb', 'trial_start_time_ptb']
+READ_COLUMNS = ({'sub', 'task', 'time', 'trial_index'} | set(CLOCK_COLUMNS) |
+                {c for names in COLUMN_ALTERNATIVES.values() for c in names})
+
+
+def level_rates(fs=FS_TARGET, factors=FACTORS):
+    """Sampling rate of every level, finest first"""
+    rates = [fs]
+    for factor in factors:
+        rates.append(rates[-1] / factor)
+    return rates
+
+
+def _blocks(x, factor, fill=np.nan):
+    """View x (..., n) as (..., n_blocks, factor), padding the last partial block with fill"""
+    pad = -x.shape[-1] % factor
+    if pad:
+        x = np.concatenate([x, np.full(x.shape[:-1] + (pad,), fill, dtype=x.dtype)], axis=-1)
+    return x.reshape(x.shape[:-1] + (-1, factor))
+
+
+def reduce_level(mean, lo, hi, count, factor):
+    """
+    One pyramid step: block-reduce (mean, min, max, n_valid) arrays by factor.
+
+    Means are weighted by the number of valid samples behind each point;
+    blocks without any valid sample are NaN.
+    """
+    count_b = _blocks(count.astype(np.float32), factor, fill=0)
+    valid = count_b > 0
+    total = np.where(valid, _blocks(mean, factor) * count_b, 0).sum(axis=-1)
+    n = count_b.sum(axis=-1)
+    empty = n == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        new_mean = np.where(empty, np.nan, total / n).astype(np.float32)
+    new_lo = np.where(valid, _blocks(lo, factor), np.inf).min(axis=-1)
+    new_hi = np.where(valid, _blocks(hi, factor), -np.inf).max(axis=-1)
+    new_lo[empty] = np.nan
+    new_hi[empty] = np.nan
+    return new_mean, new_lo.astype(np.float32), new_hi.astype(np.float32), n.astype(np.uint16)
+
+
+def build_pyramid(samples, fs=FS_TARGET, factors=FACTORS, include_base=True):
+    """
+    Pyramid arrays for a (rows x samples) array at fs.
+
+    Returns:
+        dict of arrays keyed '<stat>_<level>' (level 0 = full rate), plus
+        'fs' and 'factors'
+    """
+    base = np.asarray(samples, dtype=np.float32)
+    if base.ndim == 1:
+        base = base[None, :]
+    count = np.isfinite(base).astype(np.uint16)
+    mean = lo = hi = np.where(count > 0, base, np.nan).astype(np.float32)
+
+    levels = {'fs': np.float64(fs), 'factors': np.asarray(factors)}
+    if include_base:
+        levels['mean_0'] = mean
+    for i, factor in enumerate(factors, start=1):
+        mean, lo, hi, count = reduce_level(mean, lo, hi, count, factor)
+        levels.update({f'mean_{i}': mean, f'min_{i}': lo, f'max_{i}': hi, f'count_{i}': count})
+    return levels
+
+
+class Pyramid:
+    """
+    Read side of a stored pyramid.
+
+    Levels are loaded from the .npz lazily, one array at a time, so fetching
+    a coarse level never reads the finer ones. For epoch pyramids the full
+    rate level is the epoch tensor (memory map) rather than a stored copy.
+
+    Args:
+        path: pyramid .npz file
+        base: Full-rate array, required when the file has no 'mean_0'
+        rows: Optional DataFrame describing the rows (trials or runs)
+    """
+
+    def __init__(self, path, base=None, rows=None):
+        self.path = path
+        self.npz = np.load(path)
+        self.fs = float(self.npz['fs'])
+        self.factors = [int(f) for f in self.npz['factors']]
+        self.rates = level_rates(self.fs, self.factors)
+        self.start = float(self.npz['start'])
+        self.n_samples = int(self.npz['n_samples'])
+        self.base = base
+        self.rows = rows
+        self._cache = {}
+
+    def array(self, key):
+        """One stored array, read from the .npz on first use"""
+        if key == 'mean_0' and self.base is not None:
+            return self.base
+        if key not in self._cache:
+            self._cache[key] = self.npz[key]
+        return self._cache[key]
+
+    def times(self, level):
+        """Block-centre times (s) of a level"""
+        step = int(np.prod(self.factors[:level]))
+        n = -(-self.n_samples // step)
+        return self.start + (np.arange(n) * step + (step - 1) / 2) / self.fs
+
+    def level_for(self, width_px, window=None):
+        """Coarsest level with at least one point per pixel over the window"""
+        span = (window[1] - window[0]) if window is not None else self.n_samples / self.fs
+        for level in range(len(self.rates) - 1, -1, -1):
+            if span * self.rates[level] >= width_px:
+                return level
+        return 0
+
+    def fetch(self, width_px, window=None, rows=slice(None)):
+        """
+        (times, mean, min, max) at the coarsest level that fills width_px.
+
+        At full rate min and max are the samples themselves.
+        """
+        level = self.level_for(width_px, window)
+        times = self.times(level)
+        cols = slice(None)
+        if window is not None:
+            cols = slice(np.searchsorted(times, window[0]), np.searchsorted(times, window[1], side='right'))
+        times = times[cols]
+        if level == 0:
+            mean = self.array('mean_0')[rows, cols]
+            return times, mean, mean, mean
+        return (times, self.array(f'mean_{level}')[rows, cols],
+                self.array(f'min_{level}')[rows, cols], self.array(f'max_{level}')[rows, cols])
+
+
+def build_epoch_pyramid(epoch_dir, factors=FACTORS):
+    """Write pyramid.npz (coarse levels only) next to an epoch set"""
+    epochs = EpochSet(epoch_dir)
+    levels = build_pyramid(epochs.data, epochs.fs, factors, include_base=False)
+    levels.update({'start': np.float64(epochs.grid['start']), 'n_samples': np.int64(epochs.data.shape[1])})
+    np.savez(os.path.join(epoch_dir, 'pyramid.npz'), **levels)
+    return epoch_dir, epochs.data.shape
+
+
+def open_epoch_pyramid(epoch_dir):
+    """Pyramid for an epoch set; level 0 reads the epoch tensor's memory map"""
+    epochs = EpochSet(epoch_dir)
+    return Pyramid(os.path.join(epoch_dir, 'pyramid.npz'), epochs.data, epochs.trials)
+
+
+def absolute_time(run_df):
+    """
+    Absolute sample times (s) for one run.
+
+    Uses time_ptb, else trial_start_time_ptb + time (MATLAB flat files, where
+    time is trial-relative), else time itself if it is absolute, i.e. the
+    trials' time ranges do not overlap.
+
+    Raises:
+        ValueError: time is trial-relative and there is no absolute clock
+    """
+    if 'time_ptb' in run_df.columns and run_df['time_ptb'].notna().any():
+        return pd.to_numeric(run_df['time_ptb'], errors='coerce').to_numpy(dtype=float)
+    time = pd.to_numeric(run_df['time'], errors='coerce').to_numpy(dtype=float)
+    if 'trial_start_time_ptb' in run_df.columns and run_df['trial_start_time_ptb'].notna().any():
+        return pd.to_numeric(run_df['trial_start_time_ptb'], errors='coerce').to_numpy(dtype=float) + time
+    if 'trial_index' in run_df.columns:
+        spans = pd.Series(time).groupby(run_df['trial_index'].to_numpy()).agg(['min', 'max']).sort_values('min')
+        if (spans['min'].to_numpy()[1:] < spans['max'].to_numpy()[:-1]).any():
+            raise ValueError("time is trial-relative and no absolute clock (time_ptb / trial_start_time_ptb) "
+                             "is available; use the epoch pyramid (--epoch-store) instead")
+    return time
+
+
+def run_trace(run_df, fs=FS_TARGET):
+    """
+    One run's samples on a regular grid from its first sample.
+
+    Returns:
+        (start time, float32 trace) - gaps between trials are NaN
+    """
+    time = absolute_time(run_df)
+    valid = np.isfinite(time)
+    run_df, time = run_df[valid], time[valid]
+    start = np.min(time)
+    index = np.rint((time - start) * fs).astype(np.int64)
+    trace = np.full(index.max() + 1, np.nan, dtype=np.float32)
+    trace[index] = pd.to_numeric(run_df['pupil'], errors='coerce').to_numpy(dtype=np.float32)
+    return start, trace
+
+
+def build_run_pyramid(run_df, path, fs=FS_TARGET, factors=FACTORS):
+    start, trace = run_trace(run_df, fs)
+    levels = build_pyramid(trace, fs, factors)
+    levels.update({'start': np.float64(start), 'n_samples': np.int64(len(trace))})
+    np.savez(path, **levels)
+    return path, trace.shape
+
+
+def build_run_pyramids(flat_files, output_dir, fs=FS_TARGET, factors=FACTORS, workers=None):
+    """Write one pyramid per (sub, task, session, run) found in the flat files"""
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for flat_file in flat_files:
+            df = pd.read_csv(flat_file, usecols=lambda c: c in READ_COLUMNS, low_memory=False)
+            df = standardize_columns(df)
+            for (sub, task, ses, run), run_df in df.groupby(RUN_KEYS, observed=True):
+                path = os.path.join(output_dir, f'{sub}_{task}_ses{int(ses)}_run{int(run)}_pyramid.npz')
+                columns = [c for c in ['time', 'pupil', 'trial_index'] + CLOCK_COLUMNS if c in run_df.columns]
+                futures.append(pool.submit(build_run_pyramid, run_df[columns], path, fs, factors))
+        for future in futures:
+            results.append(future.result())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build multi-resolution waveform pyramids")
+    parser.add_argument('--epoch-store', help='epoch_store.py directory; one pyramid per epoch set')
+    parser.add_argument('--flat-files', nargs='+', help='Sample-level flat CSVs; one pyramid per run')
+    parser.add_argument('--output', help='Output directory for run pyramids')
+    parser.add_argument('--workers', type=int, help='Worker processes')
+    args = parser.parse_args()
+
+    if not args.epoch_store and not args.flat_files:
+        parser.error('give --epoch-store and/or --flat-files')
+
+    if args.epoch_store:
+        epoch_dirs = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(args.epoch_store, '*', 'grid.json')))
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for epoch_dir, shape in pool.map(build_epoch_pyramid, epoch_dirs):
+                print(f"  ✓ {os.path.basename(epoch_dir)}: {shape[0]} epochs x {shape[1]} samples")
+        print(f"✓ {len(epoch_dirs)} epoch pyramids saved under: {args.epoch_store}")
+
+    if args.flat_files:
+        if not args.output:
+            parser.error('--flat-files needs --output')
+        results = build_run_pyramids(args.flat_files, args.output, workers=args.workers)
+        for path, shape in results:
+            print(f"  ✓ {os.path.basename(path)}: {shape[0]} samples")
+        print(f"✓ {len(results)} run pyramids saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Prefix-sum window features for target-locked pupil analysis windows.
+
+Python counterpart of the per-window filtering in ch3_window_selection_v3.R
+and compute_phasic_features_from_flat.R. Per-trial cumulative sums of the
+valid-sample count, pupil, time, time x pupil, time^2, pupil^2 and of the
+trapezoid terms between adjacent valid samples are built once on the 250 Hz
+grid. Mean, SD, AUC, OLS slope and coverage for any (start, end) window
+relative to target onset then cost two lookups per trial, so sweeping
+hundreds of candidate windows costs barely more than one.
+
+Note on AUC: trapezoids are summed only between adjacent valid samples, so
+gaps (blinks, dropouts) are not bridged by linear interpolation the way
+compute_auc() in make_quick_share_v7.R does.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Timing constants (seconds relative to squeeze onset), as in make_quick_share_v7.R
+FS_TARGET = 250
+TRIAL_START_REL = -3.0
+TARGET_ONSET_DEFAULT = 4.35
+RESP_END_DEFAULT = 7.70
+
+# Candidate windows (seconds relative to target onset)
+CH3_WINDOWS = {
+    'W1.3': (0.3, 1.3),
+    'W2.0': (0.3, 2.3),
+    'W2.5': (0.3, 2.8),
+    'W3.0': (0.3, 3.3),
+    'RespWin': (0.3, RESP_END_DEFAULT - TARGET_ONSET_DEFAULT),
+    'phasic': (0.2, 0.9),
+}
+B1_WIN = (-0.5, 0.0)  # Pre-target baseline
+
+TRIAL_KEYS = ['sub', 'task', 'session_used', 'run_used', 'trial_index']
+
+
+def trial_matrix_from_flat(df, keys=TRIAL_KEYS, time_col='time', pupil_col='pupil'):
+    """
+    Pivot a long-format sample table into a NaN-padded (trials x samples) matrix.
+
+    Samples are ordered by time within each trial and placed by position, as
+    the R pipeline does when it reconstructs t_rel from the sample index.
+
+    Returns (trial_table, pupil_matrix) where trial_table holds one row of
+    keys per matrix row.
+    """
+    df = df.sort_values(keys + [time_col], kind='mergesort')
+    trial_id = df.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    position = df.groupby(keys, sort=False, observed=True).cumcount().to_numpy()
+
+    n_trials = trial_id.max() + 1 if len(trial_id) else 0
+    n_samples = position.max() + 1 if len(position) else 0
+    matrix = np.full((n_trials, n_samples), np.nan)
+    values = pd.to_numeric(df[pupil_col], errors='coerce').to_numpy(dtype=float)
+    matrix[trial_id, position] = values
+
+    first_rows = np.unique(trial_id, return_index=True)[1]
+    trial_table = df.iloc[first_rows][keys].reset_index(drop=True)
+    return trial_table, matrix
+
+
+class WindowFeatureEngine:
+    """
+    O(1)-per-window features over a (trials x samples) pupil matrix.
+
+    Args:
+        pupil: (n_trials, n_samples) array on a regular grid; NaN/inf = invalid
+        fs: Sampling rate of the grid (Hz)
+        t0: Time of sample 0 relative to squeeze onset (s)
+        target_onset: Target onset relative to squeeze onset (s), scalar or per trial
+    """
+
+    def __init__(self, pupil, fs=FS_TARGET, t0=TRIAL_START_REL, target_onset=TARGET_ONSET_DEFAULT):
+        pupil = np.asarray(pupil, dtype=float)
+        if pupil.ndim != 2:
+            raise ValueError("pupil must be a 2-D (trials x samples) array")
+        self.n_trials, self.n_samples = pupil.shape
+        self.fs = float(fs)
+        self.dt = 1.0 / self.fs
+        self.t0 = float(t0)
+        self.target_onset = np.broadcast_to(
+            np.asarray(target_onset, dtype=float), (self.n_trials,)
+        ).copy()
+
+        valid = np.isfinite(pupil)
+        y = np.where(valid, pupil, 0.0)
+        t = self.t0 + np.arange(self.n_samples) * self.dt
+        w = valid.astype(float)
+
+        # Trapezoid terms between adjacent valid samples: pair i spans samples i and i+1
+        pair_valid = valid[:, :-1] & valid[:, 1:]
+        pair_area = np.where(pair_valid, (y[:, :-1] + y[:, 1:]) * (self.dt / 2.0), 0.0)
+
+        self._n = self._prefix(w)
+        self._y = self._prefix(y)
+        self._t = self._prefix(w * t)
+        self._ty = self._prefix(y * t)
+        self._tt = self._prefix(w * t * t)
+        self._yy = self._prefix(y * y)
+        self._pairs = self._prefix(pair_valid.astype(float))
+        self._area = self._prefix(pair_area)
+
+    @staticmethod
+    def _prefix(values):
+        """Cumulative sum along samples with a leading zero column"""
+        out = np.zeros((values.shape[0], values.shape[1] + 1))
+        np.cumsum(values, axis=1, out=out[:, 1:])
+        return out
+
+    def _bounds(self, windows):
+        """
+        Sample index bounds [lo, hi) per trial and window.
+
+        Window edges are inclusive, matching t >= start & t <= end filters.
+        """
+        windows = np.atleast_2d(np.asarray(windows, dtype=float))
+        onset = self.target_onset[:, None]
+        start = (onset + windows[None, :, 0] - self.t0) * self.fs
+        end = (onset + windows[None, :, 1] - self.t0) * self.fs
+        lo = np.clip(np.ceil(start - 1e-9), 0, self.n_samples).astype(np.intp)
+        hi = np.clip(np.floor(end + 1e-9) + 1, 0, self.n_samples).astype(np.intp)
+        return lo, np.maximum(hi, lo)
+
+    @staticmethod
+    def _range_sum(prefix, lo, hi):
+        """Sum over samples [lo, hi) for each (trial, window) from a prefix array"""
+        return np.take_along_axis(prefix, hi, axis=1) - np.take_along_axis(prefix, lo, axis=1)
+
+    def evaluate(self, windows, baseline=None, min_samples=2):
+        """
+        Features for every trial x window.
+
+        Args:
+            windows: (n_windows, 2) array of (start, end) relative to target onset (s)
+            baseline: Optional (start, end) baseline window relative to target
+                onset; its mean is subtracted from mean and AUC
+            min_samples: Minimum valid samples for mean/SD/slope (else NaN)
+
+        Returns:
+            dict of (n_trials, n_windows) arrays: n_valid, coverage, mean, sd,
+            auc, slope (pupil units per second) and, with a baseline,
+            baseline_mean.
+        """
+        windows = np.atleast_2d(np.asarray(windows, dtype=float))
+        lo, hi = self._bounds(windows)
+        n_expected = hi - lo
+
+        n = self._range_sum(self._n, lo, hi)
+        sy = self._range_sum(self._y, lo, hi)
+        st = self._range_sum(self._t, lo, hi)
+        sty = self._range_sum(self._ty, lo, hi)
+        stt = self._range_sum(self._tt, lo, hi)
+        syy = self._range_sum(self._yy, lo, hi)
+        # Pairs start at lo and end before hi - 1
+        pair_hi = np.maximum(hi - 1, lo)
+        n_pairs = self._range_sum(self._pairs, lo, pair_hi)
+        area = self._range_sum(self._area, lo, pair_hi)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            enough = n >= min_samples
+            mean = np.where(n > 0, sy / n, np.nan)
+            var = np.where(n > 1, (syy - n * mean ** 2) / (n - 1), np.nan)
+            sd = np.sqrt(np.clip(var, 0.0, None))
+            sxx = stt - st ** 2 / np.where(n > 0, n, 1)
+            sxy = sty - st * sy / np.where(n > 0, n, 1)
+            slope = np.where(enough & (sxx > 0), sxy / sxx, np.nan)
+            coverage = np.where(n_expected > 0, n / np.maximum(n_expected, 1), 0.0)
+            auc = np.where(n_pairs > 0, area, np.nan)
+
+        features = {
+            'n_valid': n.astype(np.int64),
+            'coverage': coverage,
+            'mean': np.where(enough, mean, np.nan),
+            'sd': np.where(enough, sd, np.nan),
+            'auc': auc,
+            'slope': slope,
+        }
+
+        if baseline is not None:
+            b_lo, b_hi = self._bounds([baseline])
+            b_n = self._range_sum(self._n, b_lo, b_hi)
+            b_sum = self._range_sum(self._y, b_lo, b_hi)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                b_mean = np.where(b_n > 0, b_sum / b_n, np.nan)
+            features['baseline_mean'] = np.broadcast_to(b_mean, mean.shape).copy()
+            features['mean'] = features['mean'] - b_mean
+            features['auc'] = features['auc'] - b_mean * n_pairs * self.dt
+
+        return features
+
+    def sweep(self, starts, ends, baseline=None, min_duration=0.0):
+        """
+        Evaluate every (start, end) combination with end - start > min_duration.
+
+        Returns (windows, features) as from evaluate().
+        """
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        grid_start, grid_end = np.meshgrid(starts, ends, indexing='ij')
+        keep = (grid_end - grid_start) > min_duration
+        windows = np.column_stack([grid_start[keep], grid_end[keep]])
+        return windows, self.evaluate(windows, baseline=baseline)
+
+
+def features_to_frame(trial_table, windows, features, window_names=None):
+    """Long-format DataFrame with one row per trial x window"""
+    n_trials, n_windows = features['mean'].shape
+    names = window_names or [f'{start:.3f}_{end:.3f}' for start, end in windows]
+    frame = trial_table.loc[np.repeat(np.arange(n_trials), n_windows)].reset_index(drop=True)
+    frame['window'] = np.tile(names, n_trials)
+    frame['window_start'] = np.tile(np.asarray(windows)[:, 0], n_trials)
+    frame['window_end'] = np.tile(np.asarray(windows)[:, 1], n_trials)
+    for name, values in features.items():
+        frame[name] = values.reshape(-1)
+    return frame
+
+
+def summarize_sweep(trial_table, windows, features, group_col='task', min_coverage=0.6):
+    """
+    Per-window summary for window selection plots.
+
+    For each window (and group_col level) reports the share of trials with
+    coverage >= min_coverage, the mean coverage and the mean feature value.
+    """
+    rows = []
+    groups = trial_table[group_col].to_numpy() if group_col in trial_table else np.zeros(len(trial_table))
+    for level in pd.unique(groups):
+        mask = groups == level
+        coverage = features['coverage'][mask]
+        with np.errstate(invalid='ignore'):
+            summary = pd.DataFrame({
+                group_col: level,
+                'window_start': windows[:, 0],
+                'window_end': windows[:, 1],
+                'n_trials': int(mask.sum()),
+                'share_covered': (coverage >= min_coverage).mean(axis=0),
+                'mean_coverage': coverage.mean(axis=0),
+                'mean_value': np.nanmean(features['mean'][mask], axis=0),
+                'mean_auc': np.nanmean(features['auc'][mask], axis=0),
+            })
+        rows.append(summary)
+    return pd.concat(rows, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Window features from flat pupil files via prefix sums")
+    parser.add_argument('flat_files', nargs='+', help='Sample-level flat CSV files')
+    parser.add_argument('--windows', default=','.join(CH3_WINDOWS),
+                        help=f'Named windows to compute (default: {",".join(CH3_WINDOWS)})')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Also sweep all start/end pairs on a 50 ms grid (0-2 s starts, 0.5-3.35 s ends)')
+    parser.add_argument('--no-baseline', action='store_true', help='Skip pre-target baseline correction')
+    parser.add_argument('--out', default='window_features.csv', help='Per-trial output CSV')
+    parser.add_argument('--sweep-out', default='window_sweep_summary.csv', help='Sweep summary CSV')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.windows.split(',') if name.strip()]
+    unknown = [name for name in names if name not in CH3_WINDOWS]
+    if unknown:
+        print(f"Error: unknown window(s): {', '.join(unknown)}")
+        sys.exit(1)
+
+    frames = []
+    for path in args.flat_files:
+        df = pd.read_csv(path, low_memory=False)
+        for target, candidates in {'session_used': ['session_used', 'ses', 'session'],
+                                   'run_used': ['run_used', 'run'],
+                                   'time': ['time', 'time_ptb', 'trial_pupilTime']}.items():
+            for cand in candidates:
+                if cand in df.columns:
+                    df[target] = df[cand]
+                    break
+        frames.append(df)
+    samples = pd.concat(frames, ignore_index=True)
+
+    trial_table, matrix = trial_matrix_from_flat(samples)
+    print(f"Built {matrix.shape[0]} trials x {matrix.shape[1]} samples")
+
+    engine = WindowFeatureEngine(matrix)
+    baseline = None if args.no_baseline else B1_WIN
+    windows = np.array([CH3_WINDOWS[name] for name in names])
+    features = engine.evaluate(windows, baseline=baseline)
+    features_to_frame(trial_table, windows, features, names).to_csv(args.out, index=False)
+    print(f"Saved {args.out}")
+
+    if args.sweep:
+        sweep_windows, sweep_features = engine.sweep(np.arange(0.0, 2.0, 0.05), np.arange(0.5, 3.4, 0.05),
+                                                     baseline=baseline, min_duration=0.2)
+        summarize_sweep(trial_table, sweep_windows, sweep_features).to_csv(args.sweep_out, index=False)
+        print(f"Swept {len(sweep_windows)} windows; saved {args.sweep_out}")
+
+
+if __name__ == "__main__":
+    main()
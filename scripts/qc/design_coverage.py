@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Sparse design-coverage cube over subject x task x session x run x condition.
+
+compute_design_coverage.R, identify_canonical_sessions.R and
+compute_attrition.R each reload raw_manifest.csv, processed_manifest.csv and
+the whole TRIALLEVEL CSV to recount the same groups. Here every input is
+reduced once to counts per occupied cell of one sparse cube, with one count
+layer per stage:
+
+    raw_files            logP files per run (raw_manifest.csv)
+    processed_trials     trials found in processed flat files
+    trials               rows of the trial-level table
+    has_behavioral_data  / rt_ok / gate_pupil_primary / ddm_ready
+                         trial-level stages, when the columns exist
+    rt_pupil_ok          rt_ok & gate_pupil_primary (attrition end point)
+
+Coverage, canonical sessions and attrition are then groupby slices of the
+few thousand occupied cells. Each input file is a separate source keyed by
+(size, mtime), so after processing new runs only the changed flat files are
+recounted and the saved cube is updated in place.
+"""
+
+import argparse
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+COVERAGE_DIR = REPO_ROOT / "data" / "qc" / "coverage"
+TRIALLEVEL_FILE = REPO_ROOT / "data" / "analysis_ready" / "BAP_analysis_ready_TRIALLEVEL.csv"
+PROCESSED_DIR = "/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_processed"
+CUBE_FILENAME = "coverage_cube.npz"
+CUBE_VERSION = 2  # Bump when level spellings or counting rules change
+
+DIMS = ('subject_id', 'task', 'ses', 'run', 'condition')
+DIM_BITS = (16, 8, 8, 8, 16)
+ALL_CONDITIONS = 'all'
+
+# Design assumptions (compute_design_coverage.R)
+N_TASKS = 2
+RUNS_PER_TASK = 5
+TRIALS_PER_SUBJECT_TASK = 150
+CANONICAL_RUNS = (1, 2, 3, 4, 5)
+RT_BOUNDS = (0.2, 3.0)
+
+# Column name alternatives (first match wins)
+COLUMN_CANDIDATES = {
+    'subject_id': ['subject_id', 'sub', 'subject'],
+    'task': ['task', 'task_name', 'task_modality'],
+    'ses': ['ses', 'session_used', 'ses_value', 'session', 'session_num'],
+    'run': ['run', 'run_used', 'run_num'],
+    'trial': ['trial_index', 'trial_in_run_raw', 'trial_in_run', 'trial_num', 'trial'],
+}
+# Canonical task names (ADT / VDT), as in rebuild_from_behavioral_trialdata.R
+TASK_NAMES = {'adt': 'ADT', 'aud': 'ADT', 'auditory': 'ADT', 'aoddball': 'ADT',
+              'vdt': 'VDT', 'vis': 'VDT', 'visual': 'VDT', 'voddball': 'VDT'}
+CONDITION_CANDIDATES = (
+    ['effort_condition', 'effort'],
+    ['difficulty_level', 'stimulus_condition'],
+)
+STAGE_COLUMNS = ('has_behavioral_data', 'gate_pupil_primary', 'ddm_ready')
+
+
+def _pick(columns, candidates):
+    return next((c for c in candidates if c in columns), None)
+
+
+def canonical_subject(values):
+    """Subject IDs as BAP### (101, '101' and 'BAP101' all become 'BAP101')"""
+    sub = pd.Series(values).astype(str).str.strip()
+    digits = sub.str.extract(r'^(?:BAP)?(\d+)(?:\.0)?$', flags=re.IGNORECASE, expand=False)
+    return sub.where(digits.isna(), 'BAP' + digits.fillna('').str.zfill(3))
+
+
+def canonical_task(values):
+    """Task names as ADT / VDT (aud, vis, Aoddball, ... mapped; others kept)"""
+    task = pd.Series(values).astype(str).str.strip()
+    return task.str.lower().map(TASK_NAMES).fillna(task)
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+class CoverageCube:
+    """
+    Count cube stored as per-source sparse contributions.
+
+    Cells are packed int64 keys over dimension codes; levels per dimension
+    only ever grow, so keys stay valid across incremental updates. Each
+    source (an input file) holds (keys, layer codes, counts); adding a source
+    again replaces its previous contribution.
+    """
+
+    def __init__(self):
+        self.levels = {dim: [] for dim in DIMS}
+        self._codes = {dim: {} for dim in DIMS}
+        self.layers = []
+        self.sources = {}
+        self.version = CUBE_VERSION
+        self._cells = None
+
+    # ---- encoding ---------------------------------------------------------
+
+    def _encode(self, dim, values):
+        codes, uniques = pd.factorize(pd.Series(values).astype(str), sort=False)
+        lookup = self._codes[dim]
+        for value in uniques:
+            if value not in lookup:
+                if len(self.levels[dim]) >= 2 ** DIM_BITS[DIMS.index(dim)]:
+                    raise ValueError(f"Too many levels for {dim}")
+                lookup[value] = len(self.levels[dim])
+                self.levels[dim].append(value)
+        mapping = np.array([lookup[v] for v in uniques], dtype=np.int64)
+        return mapping[codes]
+
+    def _pack(self, frame):
+        key = np.zeros(len(frame), dtype=np.int64)
+        for dim, bits in zip(DIMS, DIM_BITS):
+            key = (key << bits) | self._encode(dim, frame[dim].to_numpy())
+        return key
+
+    def _unpack(self, keys):
+        out = {}
+        shift = 0
+        for dim, bits in reversed(list(zip(DIMS, DIM_BITS))):
+            codes = (keys >> shift) & ((1 << bits) - 1)
+            out[dim] = np.asarray(self.levels[dim], dtype=object)[codes] if len(codes) else np.array([], dtype=object)
+            shift += bits
+        return {dim: out[dim] for dim in DIMS}
+
+    def _layer_code(self, layer):
+        if layer not in self.layers:
+            self.layers.append(layer)
+        return self.layers.index(layer)
+
+    # ---- updates ----------------------------------------------------------
+
+    def add(self, source, frame, layers, stamp=None):
+        """
+        Count rows of frame per cell for each layer, replacing any earlier
+        contribution of the same source.
+
+        Args:
+            source: Source name (usually the input path)
+            frame: DataFrame with the DIMS columns
+            layers: {layer name: boolean mask or None for all rows}
+            stamp: Change stamp stored with the source (see is_current)
+        """
+        keys = self._pack(frame) if len(frame) else np.zeros(0, dtype=np.int64)
+        parts = []
+        for layer, mask in layers.items():
+            selected = keys if mask is None else keys[np.asarray(mask, dtype=bool)]
+            cell_keys, counts = np.unique(selected, return_counts=True)
+            parts.append((cell_keys, np.full(len(cell_keys), self._layer_code(layer), dtype=np.int16), counts))
+        self.sources[source] = {
+            'stamp': stamp or '',
+            'keys': np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype=np.int64),
+            'layer': np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.int16),
+            'count': np.concatenate([p[2] for p in parts]).astype(np.int64) if parts else np.zeros(0, dtype=np.int64),
+        }
+        self._cells = None
+
+    def remove(self, source):
+        if self.sources.pop(source, None) is not None:
+            self._cells = None
+
+    def is_current(self, source, stamp):
+        entry = self.sources.get(source)
+        return entry is not None and entry['stamp'] == stamp
+
+    # ---- queries ----------------------------------------------------------
+
+    def cells(self):
+        """Wide table of occupied cells: DIMS columns plus one count column per layer"""
+        if self._cells is None:
+            if self.sources:
+                keys = np.concatenate([s['keys'] for s in self.sources.values()])
+                layer = np.concatenate([s['layer'] for s in self.sources.values()]).astype(np.int64)
+                count = np.concatenate([s['count'] for s in self.sources.values()])
+            else:
+                keys = np.zeros(0, dtype=np.int64)
+                layer = count = np.zeros(0, dtype=np.int64)
+            cell_keys, cell_idx = np.unique(keys, return_inverse=True)
+            table = np.zeros((len(cell_keys), len(self.layers)), dtype=np.int64)
+            np.add.at(table, (cell_idx, layer), count)
+            cells = pd.DataFrame(self._unpack(cell_keys))
+            for i, name in enumerate(self.layers):
+                cells[name] = table[:, i]
+            for dim in ('ses', 'run'):
+                cells[dim] = pd.to_numeric(cells[dim], errors='coerce').astype('Int64')
+            self._cells = cells
+        return self._cells
+
+    def count(self, by, layers=None, **filters):
+        """
+        Counts summed over all dimensions not in `by`.
+
+        Filters are dimension=value or dimension=[values] restrictions.
+        """
+        cells = self.cells()
+        for dim, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            cells = cells[cells[dim].isin(values)]
+        layers = list(layers) if layers else [l for l in self.layers if l in cells.columns]
+        return cells.groupby(list(by), sort=True)[layers].sum().reset_index()
+
+    # ---- persistence ------------------------------------------------------
+
+    def save(self, path):
+        names = list(self.sources)
+        sizes = [len(self.sources[n]['keys']) for n in names]
+        empty = np.zeros(0)
+        arrays = {f'levels_{dim}': np.array(self.levels[dim], dtype=str) for dim in DIMS}
+        np.savez_compressed(
+            path,
+            version=np.int64(self.version),
+            layers=np.array(self.layers, dtype=str),
+            source_names=np.array(names, dtype=str),
+            source_stamps=np.array([self.sources[n]['stamp'] for n in names], dtype=str),
+            source_sizes=np.array(sizes, dtype=np.int64),
+            keys=np.concatenate([self.sources[n]['keys'] for n in names]) if names else empty.astype(np.int64),
+            layer=np.concatenate([self.sources[n]['layer'] for n in names]) if names else empty.astype(np.int16),
+            count=np.concatenate([self.sources[n]['count'] for n in names]) if names else empty.astype(np.int64),
+            **arrays,
+        )
+
+    @classmethod
+    def load(cls, path):
+        cube = cls()
+        with np.load(path) as data:
+            cube.version = int(data['version']) if 'version' in data else 1
+            for dim in DIMS:
+                cube.levels[dim] = [str(v) for v in data[f'levels_{dim}']]
+                cube._codes[dim] = {v: i for i, v in enumerate(cube.levels[dim])}
+            cube.layers = [str(v) for v in data['layers']]
+            bounds = np.r_[0, np.cumsum(data['source_sizes'])]
+            for i, (name, stamp) in enumerate(zip(data['source_names'], data['source_stamps'])):
+                sl = slice(bounds[i], bounds[i + 1])
+                cube.sources[str(name)] = {'stamp': str(stamp), 'keys': data['keys'][sl],
+                                           'layer': data['layer'][sl], 'count': data['count'][sl]}
+        return cube
+
+
+# ---- inputs -----------------------------------------------------------------
+
+def design_frame(df, condition_cols=None):
+    """DIMS columns from a table with any of the usual column spellings"""
+    out = pd.DataFrame(index=df.index)
+    for dim in ('subject_id', 'task', 'ses', 'run'):
+        col = _pick(df.columns, COLUMN_CANDIDATES[dim])
+        values = df[col] if col else pd.Series(1 if dim == 'ses' else np.nan, index=df.index)
+        if dim in ('ses', 'run'):
+            values = pd.to_numeric(values, errors='coerce').astype('Int64').astype(str)
+        out[dim] = values.astype(str)
+    out['subject_id'] = canonical_subject(out['subject_id']).to_numpy()
+    out['task'] = canonical_task(out['task']).to_numpy()
+
+    if condition_cols is None:
+        condition_cols = [c for c in (_pick(df.columns, cands) for cands in CONDITION_CANDIDATES) if c]
+    if condition_cols:
+        out['condition'] = df[condition_cols].astype(str).agg('|'.join, axis=1)
+    else:
+        out['condition'] = ALL_CONDITIONS
+    return out
+
+
+def add_raw_manifest(cube, path):
+    """raw_files layer: one count per logP file in raw_manifest.csv"""
+    manifest = pd.read_csv(path)
+    cube.add(str(path), design_frame(manifest, condition_cols=[]), {'raw_files': None}, _stamp(path))
+    return len(manifest)
+
+
+def add_trial_table(cube, path, condition_cols=None, rt_bounds=RT_BOUNDS):
+    """trials plus stage layers from a trial-level CSV"""
+    df = pd.read_csv(path, low_memory=False)
+    layers = {'trials': None}
+    if 'rt' in df.columns:
+        rt = pd.to_numeric(df['rt'], errors='coerce')
+        layers['rt_ok'] = rt.between(*rt_bounds).to_numpy()
+    for col in STAGE_COLUMNS:
+        if col in df.columns:
+            layers[col] = df[col].astype(str).str.upper().isin(['TRUE', '1', '1.0']).to_numpy()
+    if 'rt_ok' in layers and 'gate_pupil_primary' in layers:
+        # Pupil QC applied after RT filtering, as in the attrition stages
+        layers['rt_pupil_ok'] = layers['rt_ok'] & layers['gate_pupil_primary']
+    cube.add(str(path), design_frame(df, condition_cols), layers, _stamp(path))
+    return len(df), list(layers)
+
+
+def add_flat_file(cube, path):
+    """
+    processed_trials layer: distinct trials in one processed flat file.
+
+    Only key columns are read. Samples are reduced to one row per trial key
+    (canonical subject, task, ses, run, trial), so the same trial spelled
+    BAP101/aud in one file and 101/ADT in another is one cell. Files without
+    a trial column are recorded with no trials (samples are not trials).
+
+    Returns:
+        Number of trials, or None when the file has no trial column
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    cols = {dim: _pick(header, cands) for dim, cands in COLUMN_CANDIDATES.items()}
+    if not cols['trial']:
+        cube.add(str(path), design_frame(pd.DataFrame(columns=header), condition_cols=[]),
+                 {'processed_trials': None}, _stamp(path))
+        return None
+
+    df = pd.read_csv(path, usecols=[c for c in cols.values() if c], low_memory=False)
+    frame = design_frame(df, condition_cols=[])
+    frame['trial'] = pd.to_numeric(df[cols['trial']], errors='coerce').to_numpy()
+    frame = frame.drop_duplicates().drop(columns='trial')
+    cube.add(str(path), frame, {'processed_trials': None}, _stamp(path))
+    return len(frame)
+
+
+def update_from_flat_dir(cube, processed_dir):
+    """
+    Recount only new or changed flat files; drop sources whose files disappeared.
+
+    Returns:
+        (n_changed, n_files, n_stale, no_trial_files)
+    """
+    flat_files = sorted(str(p) for p in Path(processed_dir).rglob('*_flat.csv'))
+    changed = [p for p in flat_files if not cube.is_current(p, _stamp(p))]
+    no_trial = [path for path in changed if add_flat_file(cube, path) is None]
+    present = set(flat_files)
+    stale = [s for s in cube.sources if s.endswith('_flat.csv') and s not in present]
+    for source in stale:
+        cube.remove(source)
+    return len(changed), len(flat_files), len(stale), no_trial
+
+
+# ---- analyses ---------------------------------------------------------------
+
+def expected_vs_observed(cube, layer='trials', n_tasks=N_TASKS, runs_per_task=RUNS_PER_TASK,
+                         trials_per_subject_task=TRIALS_PER_SUBJECT_TASK):
+    """design_expected_vs_observed.csv of compute_design_coverage.R"""
+    units = cube.count(['subject_id', 'task', 'ses', 'run'], [layer])
+    units = units[units[layer] > 0]
+    n_subjects = units['subject_id'].nunique()
+    expected = np.array([n_subjects * n_tasks * runs_per_task, n_subjects * n_tasks * trials_per_subject_task])
+    observed = np.array([len(units), units[layer].sum()])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({
+            'metric': ['units', 'trials'],
+            'expected': expected,
+            'observed': observed,
+            'coverage_pct': np.round(100 * observed / expected, 2),
+            'missing': expected - observed,
+            'missing_pct': np.round(100 * (expected - observed) / expected, 2),
+        })
+
+
+def trials_per_subject_task(cube, layer='trials', expected=TRIALS_PER_SUBJECT_TASK):
+    """trials_per_subject_task_observed.csv of compute_design_coverage.R"""
+    table = cube.count(['subject_id', 'task'], [layer]).rename(columns={layer: 'n_trials'})
+    table = table[table['n_trials'] > 0].reset_index(drop=True)
+    table['expected_trials_per_combo'] = expected
+    table['coverage_pct'] = np.round(100 * table['n_trials'] / expected, 2)
+    return table
+
+
+def canonical_sessions(cube, layer='raw_files', runs=CANONICAL_RUNS):
+    """
+    canonical_session_by_subject_task.csv of identify_canonical_sessions.R:
+    most unique runs, then most files, then ses 2/3, then the higher session.
+    """
+    per_run = cube.count(['subject_id', 'task', 'ses', 'run'], [layer], run=list(runs))
+    per_run = per_run[per_run[layer] > 0]
+    stats = (per_run.groupby(['subject_id', 'task', 'ses'])
+             .agg(n_unique_runs=('run', 'nunique'), n_files=(layer, 'sum'),
+                  runs=('run', lambda r: ','.join(str(v) for v in sorted(r.unique()))))
+             .reset_index())
+    stats['_preferred'] = stats['ses'].isin([2, 3])
+    ranked = stats.sort_values(['subject_id', 'task', 'n_unique_runs', 'n_files', '_preferred', 'ses'],
+                               ascending=[True, True, False, False, False, False], kind='mergesort')
+    best = ranked.drop_duplicates(['subject_id', 'task'])
+    return (best.rename(columns={'ses': 'canonical_ses'})
+            [['subject_id', 'task', 'canonical_ses', 'n_unique_runs', 'n_files', 'runs']]
+            .reset_index(drop=True))
+
+
+def attrition(cube, raw_layer='trials', rt_layer='rt_ok', pupil_layer='rt_pupil_ok'):
+    """
+    attrition_table.csv of compute_attrition.R from layer counts per subject.
+
+    Missing stage layers fall back to the previous stage (no loss recorded).
+    """
+    layers = [l for l in (raw_layer, rt_layer, pupil_layer) if l in cube.layers]
+    per_subject = cube.count(['subject_id'], layers)
+    raw = per_subject[raw_layer] if raw_layer in per_subject else pd.Series(np.nan, index=per_subject.index)
+    after_rt = per_subject[rt_layer] if rt_layer in per_subject else raw
+    after_pupil = per_subject[pupil_layer] if pupil_layer in per_subject else after_rt
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({
+            'subj': per_subject['subject_id'],
+            'trials_raw': raw,
+            'trials_after_rt': after_rt,
+            'trials_after_pupil': after_pupil,
+            'trials_lost': raw - after_pupil,
+            'percent_retained': 100 * after_pupil / raw.where(raw > 0),
+            'percent_lost': 100 * (raw - after_pupil) / raw.where(raw > 0),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Design coverage, canonical sessions and attrition from one count cube")
+    parser.add_argument('--coverage-dir', default=str(COVERAGE_DIR), help='Manifest / output directory')
+    parser.add_argument('--raw-manifest', help='raw_manifest.csv (default: <coverage-dir>/raw_manifest.csv)')
+    parser.add_argument('--triallevel', default=str(TRIALLEVEL_FILE), help='Trial-level CSV')
+    parser.add_argument('--flat-dir', help=f'Processed flat-file directory to add incrementally (e.g. {PROCESSED_DIR})')
+    parser.add_argument('--condition-cols', nargs='*', help='Condition columns (default: effort x difficulty)')
+    parser.add_argument('--rebuild', action='store_true', help='Ignore the saved cube')
+    args = parser.parse_args()
+
+    coverage_dir = Path(args.coverage_dir)
+    coverage_dir.mkdir(parents=True, exist_ok=True)
+    cube_path = coverage_dir / CUBE_FILENAME
+    cube = CoverageCube.load(cube_path) if cube_path.exists() and not args.rebuild else CoverageCube()
+    if cube.version != CUBE_VERSION:
+        print(f"⚠ Saved cube is format v{cube.version} (current v{CUBE_VERSION}); rebuilding from scratch\n")
+        cube = CoverageCube()
+
+    print("=== DESIGN COVERAGE CUBE ===\n")
+    raw_manifest = Path(args.raw_manifest) if args.raw_manifest else coverage_dir / "raw_manifest.csv"
+    if raw_manifest.exists():
+        if cube.is_current(str(raw_manifest), _stamp(raw_manifest)):
+            print(f"⏭ raw manifest unchanged: {raw_manifest.name}")
+        else:
+            print(f"✓ raw manifest: {add_raw_manifest(cube, raw_manifest)} files")
+    else:
+        print(f"⚠ raw manifest not found: {raw_manifest}")
+
+    triallevel = Path(args.triallevel)
+    if triallevel.exists():
+        if cube.is_current(str(triallevel), _stamp(triallevel)) and args.condition_cols is None:
+            print(f"⏭ trial-level table unchanged: {triallevel.name}")
+        else:
+            n, layers = add_trial_table(cube, triallevel, args.condition_cols)
+            print(f"✓ trial-level table: {n} trials (layers: {', '.join(layers)})")
+    else:
+        print(f"⚠ trial-level table not found: {triallevel}")
+
+    if args.flat_dir:
+        n_changed, n_files, n_stale, no_trial = update_from_flat_dir(cube, args.flat_dir)
+        print(f"✓ flat files: {n_changed} of {n_files} recounted, {n_stale} removed")
+        for path in no_trial:
+            print(f"  ⚠ no trial column, counted no trials: {path}")
+
+    cube.save(cube_path)
+    cells = cube.cells()
+    print(f"\nCube: {len(cells)} occupied cells, layers: {', '.join(cube.layers)}\n")
+    if not len(cells):
+        return
+
+    outputs = {}
+    count_layer = 'trials' if 'trials' in cube.layers else cube.layers[0]
+    design = expected_vs_observed(cube, count_layer)
+    print("Expected vs Observed Summary:")
+    print(design.to_string(index=False))
+    outputs['design_expected_vs_observed.csv'] = design
+    outputs['trials_per_subject_task_observed.csv'] = trials_per_subject_task(cube, count_layer)
+
+    if 'raw_files' in cube.layers:
+        canonical = canonical_sessions(cube)
+        n_ses1 = int((canonical['canonical_ses'] == 1).sum())
+        print(f"\nCanonical sessions: {len(canonical)} subject×task pairs")
+        print(canonical['canonical_ses'].value_counts().rename('n_subject_task_pairs').to_string())
+        if n_ses1:
+            print(f"⚠ WARNING: Found {n_ses1} subject×task pairs with ses=1 (should be near zero)")
+        else:
+            print("✓ No subject×task pairs selected ses=1")
+        outputs['canonical_session_by_subject_task.csv'] = canonical
+
+    if 'trials' in cube.layers:
+        table = attrition(cube)
+        print(f"\nAttrition: mean retention {table['percent_retained'].mean():.1f}% "
+              f"over {len(table)} subjects")
+        outputs['attrition_table.csv'] = table
+
+    print()
+    for name, table in outputs.items():
+        table.to_csv(coverage_dir / name, index=False)
+        print(f"✓ Saved {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+RT-cutoff sensitivity engine over RTs sorted once per subject x condition.
+
+examine_rt_filtering.R and ddm_sensitivity_analyses.R reload and refilter the
+behavioral table for every RT threshold. Here RTs are sorted once per group
+(subject x condition) with prefix sums of correct responses and RT, so for
+any (lower, upper) pair:
+
+    - retained trials    = searchsorted(upper) - searchsorted(lower)
+    - correct / mean RT  = prefix-sum differences
+    - RT quantiles       = interpolation inside the contiguous sorted slice
+    - the subset itself  = a slice (view) of the sorted arrays
+
+Whole retention / accuracy surfaces over dense threshold grids are a couple
+of searchsorted calls and broadcasted subtractions.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+DATA_FILE = "data/analysis_ready/bap_ddm_ready.csv"
+OUTPUT_DIR = "output/sensitivity"
+GROUP_COLS = ('subject_id', 'difficulty_level')
+
+# Cutoff pairs used across the R scripts
+STANDARD_CUTOFFS = ((0.2, 3.0), (0.25, 3.0), (0.25, 2.5))
+QUANTILES = (0.1, 0.3, 0.5, 0.7, 0.9)
+
+
+class RTCutoffIndex:
+    """
+    Trials sorted by (group, rt) with per-group offsets and prefix sums.
+
+    Args:
+        df: Trial table
+        group_cols: Grouping columns (subject x condition)
+        rt_col: RT column (s); rows with missing RT are dropped
+        correct_col: 0/1 accuracy column (optional)
+        extra_cols: Further columns carried along in sorted order, so that
+            subsets for fitting back ends are plain slices
+    """
+
+    def __init__(self, df, group_cols=GROUP_COLS, rt_col='rt', correct_col='accuracy', extra_cols=()):
+        self.group_cols = list(group_cols)
+        rt = pd.to_numeric(df[rt_col], errors='coerce').to_numpy(dtype=float)
+        valid = np.isfinite(rt)
+        for col in self.group_cols:
+            valid &= df[col].notna().to_numpy()
+        rows = np.flatnonzero(valid)
+
+        frame = df.iloc[rows][self.group_cols]
+        if len(self.group_cols) == 1:
+            codes, groups = pd.factorize(frame.iloc[:, 0], sort=True)
+            self.groups = pd.Index(groups, name=self.group_cols[0])
+        else:
+            codes, self.groups = pd.MultiIndex.from_frame(frame).factorize(sort=True)
+        order = np.lexsort((rt[rows], codes))
+        self.rows = rows[order]              # positions into df
+        self.rt = rt[self.rows]
+        codes = codes[order]
+
+        n_groups = len(self.groups)
+        self.starts = np.searchsorted(codes, np.arange(n_groups), side='left')
+        self.stops = np.searchsorted(codes, np.arange(n_groups), side='right')
+        self.codes = codes
+
+        # Composite key: groups laid end to end on one monotone axis
+        self._rt_min = self.rt.min() if len(self.rt) else 0.0
+        self._span = (self.rt.max() - self._rt_min + 1.0) if len(self.rt) else 1.0
+        self._key = codes * self._span + (self.rt - self._rt_min)
+
+        if correct_col and correct_col in df.columns:
+            correct = pd.to_numeric(df[correct_col], errors='coerce').to_numpy(dtype=float)[self.rows]
+            self.correct = correct
+            self._cum_correct = np.r_[0.0, np.cumsum(np.nan_to_num(correct))]
+            self._cum_scored = np.r_[0, np.cumsum(np.isfinite(correct))]
+        else:
+            self.correct = None
+        self._cum_rt = np.r_[0.0, np.cumsum(self.rt)]
+        self.columns = {col: df[col].to_numpy()[self.rows] for col in extra_cols}
+
+    def __len__(self):
+        return len(self.rt)
+
+    def _search(self, cutoffs, side):
+        """Per-group searchsorted of cutoffs, shape (n_groups,) + cutoffs.shape"""
+        cutoffs = np.asarray(cutoffs, dtype=float)
+        shape = (-1,) + (1,) * cutoffs.ndim
+        offset = np.arange(len(self.groups)).reshape(shape) * self._span
+        pos = np.searchsorted(self._key, offset + (cutoffs - self._rt_min), side=side)
+        return np.clip(pos, self.starts.reshape(shape), self.stops.reshape(shape))
+
+    def bounds(self, lower, upper):
+        """
+        Sorted-array slice bounds of lower <= rt <= upper for every group.
+
+        lower / upper may be scalars or equally shaped arrays; results have
+        shape (n_groups,) + lower.shape.
+        """
+        left = self._search(lower, 'left')
+        right = np.maximum(self._search(upper, 'right'), left)
+        return left, right
+
+    def counts(self, lower, upper):
+        left, right = self.bounds(lower, upper)
+        return right - left
+
+    def summary(self, lower, upper):
+        """Per-group retention, accuracy and mean RT for one cutoff pair"""
+        left, right = self.bounds(lower, upper)
+        n_total = self.stops - self.starts
+        n = right - left
+        out = pd.DataFrame({'n_total': n_total, 'n_retained': n}, index=self.groups)
+        out['pct_retained'] = 100 * n / np.maximum(n_total, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['mean_rt'] = (self._cum_rt[right] - self._cum_rt[left]) / n
+            if self.correct is not None:
+                scored = self._cum_scored[right] - self._cum_scored[left]
+                out['accuracy'] = (self._cum_correct[right] - self._cum_correct[left]) / scored
+        return out
+
+    def quantiles(self, lower, upper, probs=QUANTILES):
+        """Per-group RT quantiles (R type 7) of the retained trials"""
+        left, right = self.bounds(lower, upper)
+        n = right - left
+        probs = np.asarray(probs, dtype=float)
+        pos = left[:, None] + probs[None, :] * np.maximum(n - 1, 0)[:, None]
+        lo = np.floor(pos).astype(int)
+        hi = np.minimum(lo + 1, np.maximum(right - 1, left)[:, None])
+        lo = np.minimum(lo, len(self.rt) - 1)
+        hi = np.minimum(hi, len(self.rt) - 1)
+        frac = pos - np.floor(pos)
+        q = self.rt[lo] * (1 - frac) + self.rt[hi] * frac
+        q[n == 0] = np.nan
+        return pd.DataFrame(q, index=self.groups, columns=[f'q{int(round(p * 100)):02d}' for p in probs])
+
+    def surface(self, lowers, uppers):
+        """
+        Retention and accuracy over a (lower x upper) threshold grid.
+
+        Returns a dict of arrays shaped (n_groups, len(lowers), len(uppers)):
+        n_retained, n_correct (if accuracy is known) and n_total (n_groups,).
+        """
+        lowers = np.asarray(lowers, dtype=float)
+        uppers = np.asarray(uppers, dtype=float)
+        left = self._search(lowers, 'left')[:, :, None]
+        right = np.maximum(self._search(uppers, 'right')[:, None, :], left)
+        out = {'n_total': self.stops - self.starts, 'n_retained': right - left}
+        if self.correct is not None:
+            out['n_correct'] = self._cum_correct[right] - self._cum_correct[left]
+            out['n_scored'] = self._cum_scored[right] - self._cum_scored[left]
+        return out
+
+    def group_views(self, lower, upper):
+        """
+        Yield (group, slice) for the retained trials of every group.
+
+        Index self.rt, self.correct, self.columns[...] or self.rows with the
+        slice to get views of the subset without copying.
+        """
+        left, right = self.bounds(lower, upper)
+        for group, lo, hi in zip(self.groups, left, right):
+            yield group, slice(int(lo), int(hi))
+
+    def subset_rows(self, lower, upper):
+        """Positions into the original table of all retained trials (grouped, RT-sorted)"""
+        left, right = self.bounds(lower, upper)
+        keep = np.zeros(len(self.rt) + 1, dtype=np.int8)
+        np.add.at(keep, left, 1)
+        np.add.at(keep, right, -1)
+        return self.rows[np.cumsum(keep[:-1]).astype(bool)]
+
+
+def surface_table(surface, lowers, uppers, min_trials=10):
+    """Long table of the pooled retention / accuracy surface"""
+    n_total = surface['n_total'].sum()
+    retained = surface['n_retained']
+    lo_grid, hi_grid = np.meshgrid(lowers, uppers, indexing='ij')
+    table = pd.DataFrame({
+        'rt_lower': lo_grid.ravel(),
+        'rt_upper': hi_grid.ravel(),
+        'n_retained': retained.sum(axis=0).ravel(),
+        'pct_retained': 100 * retained.sum(axis=0).ravel() / max(n_total, 1),
+        'n_groups_below_min': (retained < min_trials).sum(axis=0).ravel(),
+    })
+    if 'n_correct' in surface:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table['accuracy'] = (surface['n_correct'].sum(axis=0) / surface['n_scored'].sum(axis=0)).ravel()
+    return table
+
+
+def load_behavioral(path):
+    """Trial table with rt / accuracy / subject_id / difficulty_level harmonized as in the R scripts"""
+    data = pd.read_csv(path, low_memory=False)
+    if 'rt' not in data.columns:
+        for alt in ('resp1RT', 'same_diff_resp_secs'):
+            if alt in data.columns:
+                data['rt'] = data[alt]
+                break
+    if 'accuracy' not in data.columns:
+        for alt in ('iscorr', 'resp_is_correct'):
+            if alt in data.columns:
+                data['accuracy'] = data[alt]
+                break
+    if 'subject_id' not in data.columns and 'sub' in data.columns:
+        data['subject_id'] = data['sub'].astype(str)
+    if 'difficulty_level' not in data.columns and 'stimulus_condition' in data.columns:
+        data['difficulty_level'] = data['stimulus_condition'].map({'Standard': 'Easy', 'Oddball': 'Hard'})
+    if 'accuracy' in data.columns:
+        data['accuracy'] = pd.to_numeric(data['accuracy'].replace({True: 1, False: 0}), errors='coerce')
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RT-cutoff retention / accuracy sensitivity")
+    parser.add_argument('--data', default=DATA_FILE, help=f'Behavioral trial CSV (default: {DATA_FILE})')
+    parser.add_argument('--group-cols', nargs='+', default=list(GROUP_COLS))
+    parser.add_argument('--lower', nargs=3, type=float, default=[0.10, 0.40, 0.01], metavar=('START', 'STOP', 'STEP'),
+                        help='Lower-cutoff grid (default: 0.10 0.40 0.01)')
+    parser.add_argument('--upper', nargs=3, type=float, default=[1.5, 5.0, 0.05], metavar=('START', 'STOP', 'STEP'),
+                        help='Upper-cutoff grid (default: 1.5 5.0 0.05)')
+    parser.add_argument('--min-trials', type=int, default=10, help='Flag groups with fewer retained trials')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.data):
+        print(f"❌ Data file not found: {args.data}")
+        return
+
+    data = load_behavioral(args.data)
+    missing = [c for c in ['rt'] + args.group_cols if c not in data.columns]
+    if missing:
+        print(f"❌ Missing columns: {missing}")
+        return
+
+    t0 = time.perf_counter()
+    index = RTCutoffIndex(data, args.group_cols)
+    t_build = time.perf_counter() - t0
+    print(f"Indexed {len(index)} trials in {len(index.groups)} groups ({t_build * 1000:.1f} ms)")
+
+    lowers = np.round(np.arange(args.lower[0], args.lower[1] + args.lower[2] / 2, args.lower[2]), 6)
+    uppers = np.round(np.arange(args.upper[0], args.upper[1] + args.upper[2] / 2, args.upper[2]), 6)
+    t0 = time.perf_counter()
+    surface = index.surface(lowers, uppers)
+    t_surface = time.perf_counter() - t0
+    table = surface_table(surface, lowers, uppers, args.min_trials)
+    print(f"Surface over {len(lowers)} x {len(uppers)} cutoffs in {t_surface * 1000:.1f} ms")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    surface_path = os.path.join(args.output_dir, 'rt_cutoff_surface.csv')
+    table.to_csv(surface_path, index=False)
+
+    group_tables = []
+    print("\nStandard cutoffs:")
+    for lower, upper in STANDARD_CUTOFFS:
+        summary = index.summary(lower, upper).join(index.quantiles(lower, upper))
+        summary.insert(0, 'rt_upper', upper)
+        summary.insert(0, 'rt_lower', lower)
+        group_tables.append(summary.reset_index())
+        n = summary['n_retained'].sum()
+        line = f"  {lower:.2f}-{upper:.2f}s: {n} trials ({100 * n / len(index):.1f}%)"
+        if 'accuracy' in summary:
+            line += f", accuracy {np.nansum(summary['accuracy'] * summary['n_retained']) / max(n, 1):.3f}"
+        n_low = int((summary['n_retained'] < args.min_trials).sum())
+        print(line + (f", ⚠️  {n_low} groups < {args.min_trials} trials" if n_low else ""))
+
+    groups_path = os.path.join(args.output_dir, 'rt_cutoff_by_group.csv')
+    pd.concat(group_tables, ignore_index=True).to_csv(groups_path, index=False)
+
+    print("\n✓ Saved:")
+    print(f"  - {surface_path}")
+    print(f"  - {groups_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Plan (and optionally run) the minimal rebuild after a data sync.
+
+Artifacts form a dependency graph:
+
+    raw .mat / _logP.txt  ->  per-run flat output  ->  per-subject features  ->  merged trial-level dataset
+
+Given the files that are new or changed after a sync, only the downstream
+artifacts reachable from them are scheduled, stage by stage, across a pool of
+workers. Two new runs therefore rebuild two run outputs, one or two subjects'
+features and the merged table instead of the whole cohort.
+"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from verify_file_hashes import DEFAULT_LOCAL_DIR, verify_tree
+
+# Raw file naming: subjectBAP{ID}_{Aoddball|Voddball}_session{S}_run{R}_..._{eyetrack_cleaned.mat|logP.txt}
+RAW_PATTERN = re.compile(
+    r'subjectBAP(\d+)_([A-Za-z]+)_session(\d+)_run(\d+).*_(eyetrack_cleaned\.mat|logP\.txt)$'
+)
+RAW_GLOBS = ("*_eyetrack_cleaned.mat", "*_logP.txt")
+TASK_MAP = {'aoddball': 'ADT', 'voddball': 'VDT'}
+
+# Build order of artifact kinds (raw files are inputs, never rebuilt)
+STAGES = ('run', 'subject', 'merged')
+MERGED_NODE = 'merged:triallevel'
+
+# Own hash cache (.hash_cache.rebuild.sqlite), separate from manual verification
+CACHE_CONSUMER = 'rebuild'
+
+
+def parse_raw_filename(filename):
+    """Return (subject, task, session, run) for a raw file name, or None"""
+    match = RAW_PATTERN.search(os.path.basename(filename))
+    if not match:
+        return None
+    task = TASK_MAP.get(match.group(2).lower())
+    if task is None:
+        return None
+    return f'BAP{match.group(1)}', task, int(match.group(3)), int(match.group(4))
+
+
+def node_kind(node):
+    """Artifact kind of a node id ('raw', 'run', 'subject' or 'merged')"""
+    return node.split(':', 1)[0]
+
+
+class DependencyGraph:
+    """Directed graph from inputs to the artifacts derived from them"""
+
+    def __init__(self):
+        self.downstream = defaultdict(set)
+        self.upstream = defaultdict(set)
+        self.nodes = set()
+
+    def add_edge(self, source, target):
+        self.nodes.update((source, target))
+        self.downstream[source].add(target)
+        self.upstream[target].add(source)
+
+    def affected(self, changed):
+        """All nodes reachable from the changed nodes (excluding the changed nodes themselves)"""
+        seen = set()
+        stack = [node for node in changed if node in self.nodes]
+        while stack:
+            node = stack.pop()
+            for child in self.downstream[node]:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def stages(self, nodes):
+        """
+        Split nodes into topologically ordered stages.
+
+        Every node in a stage only depends on nodes in earlier stages (or on
+        nodes outside the set), so each stage can run fully in parallel.
+        """
+        nodes = set(nodes)
+        indegree = {node: len(self.upstream[node] & nodes) for node in nodes}
+        ready = sorted(node for node, degree in indegree.items() if degree == 0)
+        stages = []
+        while ready:
+            stages.append(ready)
+            next_ready = []
+            for node in ready:
+                for child in self.downstream[node]:
+                    if child in indegree:
+                        indegree[child] -= 1
+                        if indegree[child] == 0:
+                            next_ready.append(child)
+            ready = sorted(next_ready)
+        return stages
+
+
+def build_graph(raw_files):
+    """
+    Build the artifact graph for a set of raw files.
+
+    Run nodes are 'run:BAP178:ADT:2:1', subject nodes 'subject:BAP178' and the
+    merged dataset is a single 'merged:triallevel' node.
+    """
+    graph = DependencyGraph()
+    for raw_file in raw_files:
+        parsed = parse_raw_filename(raw_file)
+        if parsed is None:
+            continue
+        subject, task, session, run = parsed
+        run_node = f'run:{subject}:{task}:{session}:{run}'
+        subject_node = f'subject:{subject}'
+        graph.add_edge(f'raw:{os.path.basename(raw_file)}', run_node)
+        graph.add_edge(run_node, subject_node)
+        graph.add_edge(subject_node, MERGED_NODE)
+    return graph
+
+
+def plan_rebuild(raw_files, changed_files, removed_files=()):
+    """
+    Compute the minimal rebuild plan.
+
+    Args:
+        raw_files: All raw files currently present (.mat and _logP.txt)
+        changed_files: Files that are new or changed since the last build
+        removed_files: Files that were built before but are gone now; their
+            run, subject and merged artifacts are rebuilt too (a run action
+            whose inputs are all gone should remove its stale output)
+
+    Returns:
+        dict with 'changed' and 'removed' (raw node ids), 'ignored'
+        (unrecognized files), 'stages' (list of lists of artifact node ids in
+        build order) and 'downstream' ({raw node id: artifact node ids
+        rebuilt because of it}).
+    """
+    graph = build_graph(set(raw_files) | set(changed_files) | set(removed_files))
+    nodes = {'changed': [], 'removed': []}
+    ignored = []
+    for key, paths in (('changed', changed_files), ('removed', removed_files)):
+        for path in paths:
+            node = f'raw:{os.path.basename(path)}'
+            if node in graph.nodes:
+                nodes[key].append(node)
+            else:
+                ignored.append(path)
+
+    invalidated = nodes['changed'] + nodes['removed']
+    return {
+        'changed': sorted(nodes['changed']),
+        'removed': sorted(nodes['removed']),
+        'ignored': sorted(ignored),
+        'stages': graph.stages(graph.affected(invalidated)),
+        'downstream': {node: sorted(graph.affected([node])) for node in invalidated},
+    }
+
+
+def detect_changes(cleaned_dir):
+    """
+    Raw files added, changed or removed since the last successful rebuild.
+
+    Reads the planner's own hash cache without consuming it.
+
+    Returns:
+        (raw_files, changed, removed) lists of file names
+    """
+    raw_files = [p.name for p in Path(cleaned_dir).iterdir() if parse_raw_filename(p.name)]
+    report = verify_tree(cleaned_dir, patterns=RAW_GLOBS, update=False, consumer=CACHE_CONSUMER)
+    return raw_files, report['new'] + report['changed'] + report['corrupted'], report['removed']
+
+
+def mark_built(cleaned_dir):
+    """Record the current raw files as built (seeds or resets the planner's cache)"""
+    return verify_tree(cleaned_dir, patterns=RAW_GLOBS, consumer=CACHE_CONSUMER)
+
+
+def execute_plan(plan, actions, workers=None):
+    """
+    Run a rebuild plan stage by stage.
+
+    Args:
+        plan: Output of plan_rebuild()
+        actions: {kind: callable(node_id)} for 'run', 'subject' and 'merged';
+            kinds without an action are reported as skipped
+        workers: Worker threads per stage (actions usually spawn subprocesses)
+
+    Returns:
+        {node_id: 'ok' | 'failed' | 'skipped'}. After a failure, or a stage
+        with nodes that had no action, later stages are skipped because they
+        would consume stale inputs.
+    """
+    status = {}
+    blocked = False
+    workers = workers or os.cpu_count() or 1
+
+    for stage in plan['stages']:
+        if blocked:
+            status.update({node: 'skipped' for node in stage})
+            continue
+
+        runnable = [node for node in stage if node_kind(node) in actions]
+        status.update({node: 'skipped' for node in stage if node not in runnable})
+        blocked = len(runnable) < len(stage)
+
+        def _run(node):
+            try:
+                actions[node_kind(node)](node)
+                return node, 'ok'
+            except Exception as e:
+                print(f"  ✗ {node}: {e}")
+                return node, 'failed'
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for node, result in pool.map(_run, runnable):
+                status[node] = result
+                blocked = blocked or result == 'failed'
+
+    return status
+
+
+def rebuilt_raw_files(plan, status):
+    """Changed / removed raw files whose every downstream artifact was rebuilt ('ok')"""
+    return sorted(node.split(':', 1)[1] for node in plan['changed'] + plan.get('removed', [])
+                  if all(status.get(target) == 'ok' for target in plan['downstream'].get(node, [])))
+
+
+def command_action(template):
+    """
+    Turn a shell command template into an action.
+
+    The template is formatted with the node's fields ({node}, {subject},
+    {task}, {session}, {run}), e.g. 'Rscript features.R {subject}' for
+    subject nodes.
+    """
+    def _action(node):
+        parts = node.split(':')[1:]
+        fields = dict(zip(('subject', 'task', 'session', 'run'), parts))
+        fields['node'] = node
+        subprocess.run(shlex.split(template.format(**fields)), check=True)
+    return _action
+
+
+def print_plan(plan):
+    """Print a rebuild plan"""
+    print("=" * 70)
+    print("Incremental Rebuild Plan")
+    print("=" * 70)
+    print(f"Changed raw files: {len(plan['changed'])}")
+    for node in plan['changed']:
+        print(f"  ~ {node.split(':', 1)[1]}")
+    if plan.get('removed'):
+        print(f"Removed raw files: {len(plan['removed'])}")
+        for node in plan['removed']:
+            print(f"  - {node.split(':', 1)[1]}")
+    if plan['ignored']:
+        print(f"Unrecognized files (no downstream artifacts): {len(plan['ignored'])}")
+
+    if not plan['stages']:
+        print("\n✓ Nothing to rebuild")
+        return
+
+    for i, stage in enumerate(plan['stages'], 1):
+        kinds = sorted({node_kind(node) for node in stage})
+        print(f"\nStage {i} ({', '.join(kinds)}): {len(stage)} artifact(s)")
+        for node in stage:
+            print(f"  → {node}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan the minimal rebuild after syncing new raw files")
+    parser.add_argument("--cleaned-dir", default=str(DEFAULT_LOCAL_DIR), help="Directory with cleaned .mat files")
+    parser.add_argument("--changed", nargs="*", default=None,
+                        help="Changed files (default: detect via the rebuild hash cache in --cleaned-dir)")
+    parser.add_argument("--json", help="Write the plan to this JSON file")
+    parser.add_argument("--command", action="append", default=[], metavar="KIND=TEMPLATE",
+                        help="Shell command template for a stage kind (run, subject, merged)")
+    parser.add_argument("--execute", action="store_true", help="Run the plan with the given --command templates")
+    parser.add_argument("--workers", type=int, help="Parallel workers per stage")
+    parser.add_argument("--mark-built", action="store_true",
+                        help="Record the current raw files as built without rebuilding "
+                             "(seed the cache when the derived outputs are already up to date)")
+    args = parser.parse_args()
+
+    cleaned_dir = Path(args.cleaned_dir)
+    if not cleaned_dir.is_dir():
+        print(f"ERROR: Directory not found: {cleaned_dir}")
+        sys.exit(1)
+
+    if args.mark_built:
+        report = mark_built(cleaned_dir)
+        print(f"✓ Marked {len(report['digests'])} raw files as built "
+              f"({len(report['new']) + len(report['changed'])} new or changed, {len(report['removed'])} removed)")
+        return
+
+    detect_via_cache = args.changed is None
+    if detect_via_cache:
+        # Don't consume the changes until the rebuild has succeeded
+        raw_files, changed, removed = detect_changes(cleaned_dir)
+    else:
+        raw_files = [p.name for p in cleaned_dir.iterdir() if parse_raw_filename(p.name)]
+        changed, removed = args.changed, []
+
+    plan = plan_rebuild(raw_files, changed, removed)
+    print_plan(plan)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(plan, f, indent=2)
+        print(f"\nPlan written to {args.json}")
+
+    if args.execute:
+        actions = {}
+        for spec in args.command:
+            kind, _, template = spec.partition('=')
+            if kind not in STAGES or not template:
+                print(f"ERROR: Invalid --command '{spec}' (expected one of {', '.join(STAGES)}=TEMPLATE)")
+                sys.exit(1)
+            actions[kind] = command_action(template)
+        missing = sorted({node_kind(node) for stage in plan['stages'] for node in stage} - set(actions))
+        if missing:
+            print(f"⚠ No --command for: {', '.join(missing)}; those stages and everything after them are skipped")
+        status = execute_plan(plan, actions, args.workers)
+        n_failed = sum(1 for result in status.values() if result == 'failed')
+        print(f"\nExecuted: {sum(1 for r in status.values() if r == 'ok')} ok, "
+              f"{n_failed} failed, {sum(1 for r in status.values() if r == 'skipped')} skipped")
+        if detect_via_cache:
+            # Consume only the changes whose whole downstream chain was rebuilt
+            rebuilt = rebuilt_raw_files(plan, status)
+            if rebuilt:
+                verify_tree(cleaned_dir, patterns=RAW_GLOBS, update=set(rebuilt), consumer=CACHE_CONSUMER)
+            pending = len(plan['changed']) + len(plan['removed']) - len(rebuilt)
+            if pending:
+                print(f"⚠ {pending} changed / removed raw file(s) left pending; they will be replanned next time")
+        if n_failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
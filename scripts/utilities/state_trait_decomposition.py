@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Between-/within-person decomposition of pupil features in one grouped pass.
+
+Python counterpart of calculate_bp_wp() / zscore_wp() in
+state_trait_decomposition.R and the TONIC_BASELINE_wp / _bp scaling in
+tonic_alpha_analysis.R. Instead of a grouped mutate per feature, the rows are
+ordered by participant once and every feature column is reduced together:
+per-participant count, mean and sum of squared deviations (plus the same for
+odd and even trials) come from np.add.reduceat over the contiguous
+(trials x features) matrix.
+
+These moments are all that is needed for
+
+    {feature}_bp     participant mean (between-person component)
+    {feature}_wp     deviation from the participant mean (within-person)
+    {feature}_wp_z   within-person z-score (scale() within participant)
+    {feature}_bp_z   participant mean standardized across participants
+
+and for per-feature reliability (ICC(1), reliability of participant means
+ICC(k), odd/even split-half with Spearman-Brown). Moments from a new batch of
+participants (or new trials of existing ones) merge into the stored ones
+with the parallel-variance update, so appending subjects never recomputes
+the cohort.
+"""
+
+import argparse
+import fnmatch
+import os
+
+import numpy as np
+import pandas as pd
+
+PARTICIPANT_COL = 'subject_id'
+
+# Feature columns decomposed by default (state_trait_decomposition.R)
+FEATURE_PATTERNS = (
+    'TONIC_BASELINE_scaled',
+    'PHASIC_TER_*',
+    'PHASIC_SLOPE_scaled',
+    'PHASIC_EARLY_*',
+    'PHASIC_LATE_*',
+)
+DERIVED_SUFFIXES = ('_bp', '_wp', '_wp_z', '_bp_z', '_resid_wp', '_orthogonal_wp')
+
+
+def select_features(columns, patterns=FEATURE_PATTERNS):
+    """Feature columns matching the patterns, skipping already-derived columns"""
+    selected = []
+    for col in columns:
+        if col.endswith(DERIVED_SUFFIXES):
+            continue
+        if any(fnmatch.fnmatchcase(col, pattern) for pattern in patterns):
+            selected.append(col)
+    return selected
+
+
+def _block_moments(values, starts):
+    """
+    Count, mean and sum of squared deviations per contiguous block and column.
+
+    values: (n_rows x n_features) with NaN = missing; starts: first row of
+    each block. Returns (n, mean, m2), each (n_blocks x n_features).
+    """
+    valid = np.isfinite(values)
+    filled = np.where(valid, values, 0.0)
+    n = np.add.reduceat(valid.astype(float), starts, axis=0)
+    total = np.add.reduceat(filled, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, total / n, 0.0)
+    block = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(values))))
+    dev = np.where(valid, values - mean[block], 0.0)
+    m2 = np.add.reduceat(dev * dev, starts, axis=0)
+    return n, mean, m2
+
+
+def _combine(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Chan et al. parallel update of (n, mean, M2)"""
+    n = n_a + n_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(n > 0, mean_a + delta * np.where(n > 0, n_b / n, 0.0), 0.0)
+        m2 = m2_a + m2_b + np.where(n > 0, delta * delta * n_a * n_b / n, 0.0)
+    return n, mean, m2
+
+
+class PersonMoments:
+    """
+    Per-participant sufficient statistics for a set of features.
+
+    Arrays are (n_participants x n_features): n, mean, m2 over all trials and
+    separately over odd and even trials (split-half reliability). n_rows
+    counts rows per participant so trial parity continues across appends.
+    """
+
+    STAT_NAMES = ('n', 'mean', 'm2', 'n_odd', 'mean_odd', 'm2_odd', 'n_even', 'mean_even', 'm2_even')
+
+    def __init__(self, participants, features, stats, n_rows):
+        self.participants = pd.Index(participants)
+        self.features = list(features)
+        self.stats = stats
+        self.n_rows = np.asarray(n_rows, dtype=np.int64)
+
+    @classmethod
+    def from_frame(cls, df, features, participant_col=PARTICIPANT_COL, row_offset=None):
+        """
+        Moments of df in one grouped reduction.
+
+        row_offset optionally maps participant -> rows already seen, so odd/even
+        parity continues from an earlier batch. Rows without a participant ID
+        are left out.
+        """
+        df = df[df[participant_col].notna()]
+        codes, participants = pd.factorize(df[participant_col], sort=True)
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        values = df[features].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)[order]
+
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(order) else np.array([], int)
+        n_rows = np.diff(np.append(starts, len(order)))
+        within = np.arange(len(order)) - np.repeat(starts, n_rows)
+        if row_offset is not None:
+            within = within + np.repeat([row_offset.get(p, 0) for p in participants], n_rows)
+
+        stats = {}
+        stats['n'], stats['mean'], stats['m2'] = _block_moments(values, starts)
+        for parity, name in ((0, 'odd'), (1, 'even')):  # 1st, 3rd, ... trial = odd
+            masked = np.where((within % 2 == parity)[:, None], values, np.nan)
+            stats[f'n_{name}'], stats[f'mean_{name}'], stats[f'm2_{name}'] = _block_moments(masked, starts)
+        return cls(participants, features, stats, n_rows)
+
+    def merge(self, other):
+        """New PersonMoments combining self with other (same features)"""
+        if other.features != self.features:
+            raise ValueError("cannot merge moments over different feature sets")
+        participants = self.participants.union(other.participants)
+        a = self.participants.get_indexer(participants)
+        b = other.participants.get_indexer(participants)
+
+        def _aligned(stats, idx, name):
+            out = np.zeros((len(participants), len(self.features)))
+            present = idx >= 0
+            out[present] = stats[name][idx[present]]
+            return out
+
+        stats = {}
+        for suffix in ('', '_odd', '_even'):
+            args = [_aligned(s, idx, f'{stat}{suffix}')
+                    for s, idx in ((self.stats, a), (other.stats, b)) for stat in ('n', 'mean', 'm2')]
+            stats[f'n{suffix}'], stats[f'mean{suffix}'], stats[f'm2{suffix}'] = _combine(*args)
+
+        n_rows = np.where(a >= 0, self.n_rows[np.maximum(a, 0)], 0) + np.where(b >= 0, other.n_rows[np.maximum(b, 0)], 0)
+        return PersonMoments(participants, self.features, stats, n_rows)
+
+    def participant_ids(self, ids):
+        """ids cast like the stored participants (numeric IDs stay numeric, others str)"""
+        ids = pd.Series(ids)
+        if pd.api.types.is_numeric_dtype(self.participants):
+            return pd.to_numeric(ids, errors='coerce')
+        return ids.where(ids.isna(), ids.astype(str))
+
+    def append(self, df, participant_col=PARTICIPANT_COL):
+        """Merge in new rows (new participants or more trials of known ones)"""
+        df = df.assign(**{participant_col: self.participant_ids(df[participant_col]).to_numpy()})
+        offset = dict(zip(self.participants, self.n_rows))
+        return self.merge(PersonMoments.from_frame(df, self.features, participant_col, offset))
+
+    def save(self, path):
+        """Write to path as given (through a handle, so np.savez adds no .npz)"""
+        numeric = pd.api.types.is_numeric_dtype(self.participants)
+        participants = np.asarray(self.participants) if numeric else np.asarray(self.participants, dtype=str)
+        with open(path, 'wb') as f:
+            np.savez(f, participants=participants, features=np.asarray(self.features, dtype=str),
+                     n_rows=self.n_rows, **self.stats)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            stats = {name: data[name] for name in cls.STAT_NAMES}
+            return cls(data['participants'].tolist(), data['features'].tolist(), stats, data['n_rows'])
+
+    def participant_table(self):
+        """(participant x feature) means and within-person SDs (ddof=1)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(np.where(self.stats['n'] > 1, self.stats['m2'] / (self.stats['n'] - 1), np.nan))
+        mean = np.where(self.stats['n'] > 0, self.stats['mean'], np.nan)
+        return (pd.DataFrame(mean, index=self.participants, columns=self.features),
+                pd.DataFrame(sd, index=self.participants, columns=self.features))
+
+
+def decompose(df, moments, participant_col=PARTICIPANT_COL):
+    """
+    Add _bp, _wp, _wp_z and _bp_z columns for every feature in moments.
+
+    _bp_z standardizes participant means across participants (one value per
+    participant, as TONIC_BASELINE_bp in tonic_alpha_analysis.R), so it
+    shifts when participants are appended; the other columns do not.
+    Rows without a participant ID get NaN components.
+    """
+    means, sds = moments.participant_table()
+    ids = moments.participant_ids(df[participant_col])
+    idx = moments.participants.get_indexer(ids)
+    unknown = (idx < 0) & ids.notna().to_numpy()
+    if unknown.any():
+        raise KeyError(f"{unknown.sum()} rows belong to participants without moments")
+
+    def _rows(table):
+        # One trailing all-NaN row for rows without a participant (idx -1)
+        return np.vstack([table, np.full((1, table.shape[1]), np.nan)])[idx]
+
+    values = df[moments.features].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    bp = _rows(means.to_numpy())
+    wp = values - bp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wp_z = wp / _rows(sds.to_numpy())
+        bp_z = _rows(((means - means.mean()) / means.std(ddof=1)).to_numpy())
+
+    out = df.copy()
+    for j, feature in enumerate(moments.features):
+        out[f'{feature}_bp'] = bp[:, j]
+        out[f'{feature}_wp'] = wp[:, j]
+        out[f'{feature}_wp_z'] = wp_z[:, j]
+        out[f'{feature}_bp_z'] = bp_z[:, j]
+    return out
+
+
+def reliability(moments):
+    """
+    Per-feature variance decomposition and reliability.
+
+    One-way random-effects ANOVA with unequal group sizes: ICC(1) is the
+    share of single-trial variance between participants, ICC(k) the
+    reliability of a participant mean. The split-half estimate correlates
+    participant means of odd vs even trials (Spearman-Brown corrected).
+    """
+    s = moments.stats
+    rows = []
+    for j, feature in enumerate(moments.features):
+        n = s['n'][:, j]
+        keep = n > 0
+        n, mean, m2 = n[keep], s['mean'][keep, j], s['m2'][keep, j]
+        k, total = len(n), n.sum()
+        row = {'feature': feature, 'n_participants': int(k), 'n_obs': int(total)}
+        if k < 2 or total <= k:
+            rows.append(row)
+            continue
+
+        grand = (n * mean).sum() / total
+        ms_between = (n * (mean - grand) ** 2).sum() / (k - 1)
+        ms_within = m2.sum() / (total - k)
+        n0 = (total - (n ** 2).sum() / total) / (k - 1)
+        var_between = max((ms_between - ms_within) / n0, 0.0)
+
+        odd = s['n_odd'][keep, j] > 0
+        even = s['n_even'][keep, j] > 0
+        both = odd & even
+        r = np.nan
+        if both.sum() > 2:
+            r = np.corrcoef(s['mean_odd'][keep, j][both], s['mean_even'][keep, j][both])[0, 1]
+
+        row.update({
+            'grand_mean': grand,
+            'var_between': var_between,
+            'var_within': ms_within,
+            'icc1': (ms_between - ms_within) / (ms_between + (n0 - 1) * ms_within),
+            'icc_k': (ms_between - ms_within) / ms_between if ms_between > 0 else np.nan,
+            'split_half_r': r,
+            'split_half_sb': 2 * r / (1 + r) if np.isfinite(r) else np.nan,
+        })
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Between/within-person decomposition of pupil features")
+    parser.add_argument('input', help='Trial-level CSV with feature columns')
+    parser.add_argument('--out', help='Output CSV with _bp/_wp/_wp_z/_bp_z columns')
+    parser.add_argument('--participant-col', default=PARTICIPANT_COL, help='Participant column')
+    parser.add_argument('--features', nargs='+', help='Feature columns (default: TONIC/PHASIC patterns)')
+    parser.add_argument('--state', help='Moments file (.npz); with --append, input rows are merged into it')
+    parser.add_argument('--append', action='store_true', help='Append input rows to the moments in --state')
+    parser.add_argument('--reliability', help='Write per-feature reliability to this CSV')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, low_memory=False)
+
+    if args.append:
+        if not args.state or not os.path.exists(args.state):
+            parser.error("--append needs an existing --state file")
+        moments = PersonMoments.load(args.state).append(df, args.participant_col)
+        print(f"Appended {len(df)} rows; moments now cover {len(moments.participants)} participants")
+    else:
+        features = args.features or select_features(df.columns)
+        if not features:
+            parser.error("no feature columns found")
+        moments = PersonMoments.from_frame(df, features, args.participant_col)
+        print(f"Decomposing {len(features)} features for {len(moments.participants)} participants")
+
+    if args.state:
+        moments.save(args.state)
+        print(f"  Moments saved to {args.state}")
+
+    out = decompose(df, moments, args.participant_col)
+    out_path = args.out or args.input.rsplit('.', 1)[0] + '_decomposed.csv'
+    out.to_csv(out_path, index=False)
+    print(f"  Saved decomposed data to {out_path}")
+
+    table = reliability(moments)
+    print("\nReliability:")
+    print(table.to_string(index=False, float_format=lambda x: f'{x:.3f}'))
+    if args.reliability:
+        table.to_csv(args.reliability, index=False)
+        print(f"  Saved reliability table to {args.reliability}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,10 @@ Downloads only files that don't already exist locally or have different sizes.
 
 import os
 import sys
-import hashlib
 from pathlib import Path
 
+from verify_file_hashes import hash_file
+
 try:
     import gdown
 except ImportError:
@@ -18,12 +19,8 @@ except ImportError:
 
 
 def file_hash(filepath):
-    """Calculate MD5 hash of file"""
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    """Calculate MD5 hash of file (large buffered/mmap reads, see verify_file_hashes.py)"""
+    return hash_file(filepath, "md5")
 
 
 def get_file_info(folder_url, pattern="*"):
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Verify integrity of synced raw data using a persistent hash cache.
+
+Hashes are computed in parallel with large buffered (or mmap) reads and stored
+in a local SQLite database together with each file's size and mtime. On later
+runs only files whose size or mtime changed are rehashed, so checking an
+unchanged BAP_cleaned tree costs one stat() per file.
+
+Each consumer of the cache keeps its own file (.hash_cache.sqlite for manual
+verification, .hash_cache.<consumer>.sqlite otherwise), so one consumer
+recording new digests never hides changes another one has not acted on yet.
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import mmap
+import os
+import sqlite3
+import stat
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Configuration
+DEFAULT_LOCAL_DIR = Path("/Users/mohdasti/Documents/LC-BAP/BAP/BAP_Pupillometry/BAP/BAP_cleaned")
+CACHE_FILENAME = ".hash_cache.sqlite"
+CACHE_PREFIX = ".hash_cache"
+DEFAULT_ALGORITHM = "md5"  # Matches Google Drive / rclone md5 checksums
+CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB reads instead of 4 KB
+MMAP_THRESHOLD = 64 * 1024 * 1024  # mmap files larger than this
+
+
+def cache_filename(consumer=None):
+    """Cache file name for a consumer (None = manual verification)"""
+    return CACHE_FILENAME if consumer is None else f"{CACHE_PREFIX}.{consumer}.sqlite"
+
+
+def matches(rel_path, patterns):
+    """True if the file name of rel_path matches any of the glob patterns"""
+    name = rel_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def in_scope(rel_path, patterns, recursive=False):
+    """True if a scan with these patterns / recursion would have visited rel_path"""
+    return matches(rel_path, patterns) and (recursive or "/" not in rel_path)
+
+
+def hash_file(filepath, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE):
+    """
+    Hash a file with large reads.
+
+    Files above MMAP_THRESHOLD are mapped into memory and fed to the hash in
+    chunk_size views; smaller files are read into one reusable buffer. hashlib
+    releases the GIL on large updates, so this scales across threads.
+    """
+    digest = hashlib.new(algorithm)
+    size = os.path.getsize(filepath)
+
+    with open(filepath, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, size, chunk_size):
+                        digest.update(view[offset:offset + chunk_size])
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(min(chunk_size, max(size, 1)))
+            view = memoryview(buffer)
+            while True:
+                n_read = f.readinto(buffer)
+                if not n_read:
+                    break
+                digest.update(view[:n_read])
+
+    return digest.hexdigest()
+
+
+class HashCache:
+    """SQLite store of (path, size, mtime, hash) rows"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                hashed_at REAL NOT NULL,
+                PRIMARY KEY (path, algorithm)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, algorithm=DEFAULT_ALGORITHM):
+        """Return {path: (size, mtime_ns, digest)} for one algorithm"""
+        rows = self.conn.execute(
+            "SELECT path, size, mtime_ns, digest FROM file_hashes WHERE algorithm = ?",
+            (algorithm,)
+        )
+        return {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in rows}
+
+    def store(self, entries, algorithm=DEFAULT_ALGORITHM):
+        """Insert or replace (path, size, mtime_ns, digest) entries"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, algorithm, size, mtime_ns, digest, now)
+                 for path, size, mtime_ns, digest in entries]
+            )
+
+    def remove(self, paths, algorithm=DEFAULT_ALGORITHM):
+        """Drop cache rows for files that no longer exist"""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM file_hashes WHERE path = ? AND algorithm = ?",
+                [(path, algorithm) for path in paths]
+            )
+
+
+def scan_tree(local_dir, patterns=("*.mat",), recursive=False):
+    """
+    Stat all matching files under local_dir.
+
+    Returns {relative_posix_path: (size, mtime_ns)}.
+    """
+    local_dir = Path(local_dir)
+    found = {}
+    walker = os.walk(local_dir) if recursive else [(str(local_dir), [], os.listdir(local_dir))]
+
+    for dirpath, _, filenames in walker:
+        for name in filenames:
+            if name.startswith(CACHE_PREFIX):
+                continue
+            if not matches(name, patterns):
+                continue
+            full_path = os.path.join(dirpath, name)
+            st = os.stat(full_path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            rel_path = Path(full_path).relative_to(local_dir).as_posix()
+            found[rel_path] = (st.st_size, st.st_mtime_ns)
+
+    return found
+
+
+def read_expected_checksums(checksum_file):
+    """
+    Read an md5sum-style file ("<hash>  <path>" per line).
+
+    This is the format written by `rclone md5sum remote:path > md5sums.txt`.
+    """
+    expected = {}
+    with open(checksum_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            digest, _, rel_path = line.partition(" ")
+            expected[rel_path.strip().lstrip("*")] = digest.lower()
+    return expected
+
+
+def verify_tree(local_dir, patterns=("*.mat",), cache_path=None, algorithm=DEFAULT_ALGORITHM,
+                workers=None, force=False, recursive=False, expected=None, update=True, consumer=None):
+    """
+    Check the integrity of a directory tree against the hash cache.
+
+    Args:
+        local_dir: Directory to verify
+        patterns: Filename glob patterns to include
+        cache_path: SQLite cache location (default: <local_dir>/<cache_filename(consumer)>)
+        algorithm: hashlib algorithm name
+        workers: Number of hashing threads (default: min(8, cpu_count))
+        force: Rehash every file, even if size and mtime are unchanged
+        recursive: Descend into subdirectories
+        expected: Optional {relative_path: digest} to compare against
+        update: Write new digests to the cache (False reports changes without
+            consuming them, e.g. when planning a rebuild); a collection of
+            relative paths writes (and prunes) only those entries
+        consumer: Name of the tool using the cache; each consumer has its own
+            cache file (see cache_filename)
+
+    Returns:
+        dict with lists of relative paths under 'unchanged', 'new', 'changed',
+        'touched', 'corrupted', 'removed', 'mismatch' and 'missing', plus
+        'digests' ({path: digest}) and 'elapsed' (seconds).
+    """
+    start = time.perf_counter()
+    local_dir = Path(local_dir)
+    cache_path = Path(cache_path) if cache_path else local_dir / cache_filename(consumer)
+    workers = workers or min(8, os.cpu_count() or 1)
+
+    current = scan_tree(local_dir, patterns, recursive)
+
+    report = {key: [] for key in ("unchanged", "new", "changed", "touched",
+                                  "corrupted", "removed", "mismatch", "missing")}
+    digests = {}
+
+    with HashCache(cache_path) as cache:
+        cached = cache.load(algorithm)
+
+        to_hash = []
+        for rel_path, (size, mtime_ns) in current.items():
+            entry = cached.get(rel_path)
+            if entry is not None and not force and entry[0] == size and entry[1] == mtime_ns:
+                report["unchanged"].append(rel_path)
+                digests[rel_path] = entry[2]
+            else:
+                to_hash.append(rel_path)
+
+        def _hash(rel_path):
+            return rel_path, hash_file(local_dir / rel_path, algorithm)
+
+        updates = []
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for rel_path, digest in pool.map(_hash, to_hash):
+                    size, mtime_ns = current[rel_path]
+                    entry = cached.get(rel_path)
+                    if entry is None:
+                        report["new"].append(rel_path)
+                    elif entry[2] != digest:
+                        # Same size and mtime but different content: silent corruption
+                        stat_same = entry[0] == size and entry[1] == mtime_ns
+                        report["corrupted" if stat_same else "changed"].append(rel_path)
+                    elif entry[0] == size and entry[1] == mtime_ns:
+                        report["unchanged"].append(rel_path)
+                    else:
+                        report["touched"].append(rel_path)
+                    digests[rel_path] = digest
+                    updates.append((rel_path, size, mtime_ns, digest))
+            if update is True:
+                cache.store(updates, algorithm)
+            elif update:
+                cache.store([entry for entry in updates if entry[0] in update], algorithm)
+
+        # Only files this scan could have seen count as removed; rows for
+        # other patterns (or subdirectories, when not recursive) belong to
+        # other runs and are left alone
+        report["removed"] = sorted(path for path in set(cached) - set(current)
+                                   if in_scope(path, patterns, recursive))
+        if report["removed"] and update:
+            cache.remove([path for path in report["removed"] if update is True or path in update], algorithm)
+
+    if expected is not None:
+        for rel_path, digest in expected.items():
+            if rel_path not in digests:
+                report["missing"].append(rel_path)
+            elif digests[rel_path] != digest:
+                report["mismatch"].append(rel_path)
+
+    for key in report:
+        report[key].sort()
+    report["digests"] = digests
+    report["elapsed"] = time.perf_counter() - start
+    return report
+
+
+def print_report(report):
+    """Print a verification summary"""
+    print("=" * 70)
+    print("Integrity Check Summary")
+    print("=" * 70)
+    print(f"Files checked: {len(report['digests'])}")
+    print(f"Unchanged (cached): {len(report['unchanged'])}")
+    print(f"New: {len(report['new'])}")
+    print(f"Changed: {len(report['changed'])}")
+    print(f"Touched (mtime only): {len(report['touched'])}")
+    print(f"Removed: {len(report['removed'])}")
+    print(f"Elapsed: {report['elapsed']:.3f} s")
+
+    for key, symbol in (("new", "+"), ("changed", "~"), ("removed", "-")):
+        for rel_path in report[key]:
+            print(f"  {symbol} {rel_path}")
+
+    problems = report["corrupted"] + report["mismatch"] + report["missing"]
+    for rel_path in report["corrupted"]:
+        print(f"  ✗ Corrupted (content changed without size/mtime change): {rel_path}")
+    for rel_path in report["mismatch"]:
+        print(f"  ✗ Checksum mismatch vs. expected: {rel_path}")
+    for rel_path in report["missing"]:
+        print(f"  ✗ Missing locally: {rel_path}")
+
+    if not problems:
+        print("\n✓ All files verified")
+    return len(problems)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify synced files against a persistent hash cache")
+    parser.add_argument("local_dir", nargs="?", default=str(DEFAULT_LOCAL_DIR),
+                        help="Directory to verify (default: BAP_cleaned)")
+    parser.add_argument("--pattern", action="append", dest="patterns",
+                        help="Filename pattern to include (repeatable, default: *.mat)")
+    parser.add_argument("--cache", help="Path to SQLite hash cache")
+    parser.add_argument("--algorithm", default=DEFAULT_ALGORITHM, help="Hash algorithm (default: md5)")
+    parser.add_argument("--workers", type=int, help="Number of hashing threads")
+    parser.add_argument("--recursive", action="store_true", help="Descend into subdirectories")
+    parser.add_argument("--force", action="store_true", help="Rehash every file")
+    parser.add_argument("--expected", help="md5sum-style checksum file to compare against")
+    args = parser.parse_args()
+
+    if not Path(args.local_dir).is_dir():
+        print(f"ERROR: Directory not found: {args.local_dir}")
+        sys.exit(1)
+
+    expected = read_expected_checksums(args.expected) if args.expected else None
+    report = verify_tree(
+        args.local_dir,
+        patterns=tuple(args.patterns or ["*.mat"]),
+        cache_path=args.cache,
+        algorithm=args.algorithm,
+        workers=args.workers,
+        force=args.force,
+        recursive=args.recursive,
+        expected=expected
+    )
+    n_problems = print_report(report)
+    sys.exit(1 if n_problems else 0)
+
+
+if __name__ == "__main__":
+    main()